@@ -6,6 +6,7 @@
 
 import sys
 import argparse
+from despydmdb import desdmdbi
 import filemgmt.compare_utils as compare
 from filemgmt import fmutils
 
@@ -41,6 +42,14 @@ The following are all valid ways to select the files:
     --pfwid 123456
     --pfwid 123456,789012,345678
     --tag Y1A2_JUNK
+
+Alternatively --audit compares the whole archive (or everything below relpath) in a
+single pass whose memory use does not depend on the size of the archive.  Discrepancies
+are printed as they are found.  With --checkpoint the last fully compared path is
+recorded so that an interrupted audit resumes where it left off (the file is removed
+once the audit completes):
+    --audit --checkpoint desar2home.audit
+    --audit --relpath OPS/finalcut --md5sum
 """
 
     parser = argparse.ArgumentParser(description='Compare files on disk with their entry in the database, including file size and md5sum, if requested',
@@ -64,6 +73,9 @@ The following are all valid ways to select the files:
     parser.add_argument('--tag', action='store', help='Compare all data from a specific tag (this can take a long time)')
     parser.add_argument('--start_at', action='store', help='Index to start at (1 based), useful for doing checking in chunks.', type=int, default=1)
     parser.add_argument('--end_at', action='store', help='Index to end at (1 based), useful for doing checking in chunks.', type=int, default=0)
+    parser.add_argument('--parallel', action='store', help='Number of pfw_attempt_ids to compare concurrently (worker threads, each with its own DB connection)', type=int, default=1)
+    parser.add_argument('--audit', action='store_true', help='Audit the whole archive (or relpath) with a streaming merge of DB and disk')
+    parser.add_argument('--checkpoint', action='store', help='File used to record/resume the progress of an audit')
     parser.add_argument('--dbh', action='store', help=argparse.SUPPRESS) # used internally
     parser.add_argument('--log', action='store', help='Log file to write to, default is to write to sdtout')
     cargs = parser.parse_args(argv)
@@ -77,15 +89,22 @@ def main():
     """
     args = parse_cmd_line(sys.argv[1:])
     if args.log is not None:
-        stdp = compare.Print(args.log)
+        stdp = fmutils.Print(args.log)
         sys.stdout = stdp
-    (args, pfwids) = fmutils.determine_ids(args)
-    comp = compare.FileCompare(args, pfwids)
-    ret = compare.run()
+    if args.audit:
+        if args.dbh is None:
+            args.dbh = desdmdbi.DesDmDbi(args.des_services, args.section)
+        ret = compare.ArchiveAudit(args).run()
+    else:
+        (args, pfwids) = fmutils.determine_ids(args)
+        comp = compare.FileCompare(args, pfwids)
+        ret = comp.run()
     if args.log is not None:
         sys.stdout.flush()
         sys.stdout = stdp.close()
-    sys.exit(ret)
+    # ret is a count of failed attempts (which can be a multiple of 256) or None if run()
+    # died, exit with 1 for any of those
+    sys.exit(0 if ret == 0 else 1)
 
 if __name__ == "__main__":
     main()
@@ -11,29 +11,55 @@ import re
 import despydmdb.desdmdbi as desdmdbi
 import despymisc.miscutils as miscutils
 
+# number of bind variables in the in-list of select_using_in, short lists are padded with NULL
+# so every query uses the same statement
+IN_CHUNK = 500
+
 
 def delete_using_run_vals(dbh, tablename, reqnum, unitname, attnum, verbose=0):
     if verbose >= 1:
         print(f"{tablename:25s}")
-    sql = f"delete from {tablename} where unitname='{unitname}' and reqnum='{reqnum}' and attnum='{attnum}'"
+    sql = f"delete from {tablename} where unitname=:unitname and reqnum=:reqnum and attnum=:attnum"
     if verbose >= 2:
-        print(f"\n%{sql}\n")
+        print(f"\n{sql}\n")
     curs = dbh.cursor()
-    curs.execute(sql)
+    curs.execute(sql, run_binds(unitname, reqnum, attnum))
     if verbose >= 1:
-        print(f"{curs.rowcount:3s} deleted rows")
+        print(f"{curs.rowcount:3d} deleted rows")
 
 
 def delete_using_in(dbh, tablename, incol, inlist, verbose=0):
     if verbose >= 1:
         print(f"{tablename:25s}")
-    sql = f"delete from {tablename} where {incol} in ('" + "','".join(inlist) + "')"
+    sql = f"delete from {tablename} where {incol}=:val"
     if verbose >= 2:
         print(f"\n{sql}\n")
     curs = dbh.cursor()
-    curs.execute(sql)
+    if inlist:
+        curs.executemany(sql, [{'val': val} for val in inlist])
     if verbose >= 1:
-        print(f"{curs.rowcount:3s} deleted rows")
+        print(f"{curs.rowcount if inlist else 0:3d} deleted rows")
+
+
+def select_using_in(dbh, sql, inlist):
+    """ Run sql, whose in-list is given as {inlist}, over inlist in fixed size chunks of bind variables
+        and return the first column of the results as str
+    """
+    sql = sql.format(inlist=','.join(f":v{i}" for i in range(IN_CHUNK)))
+    curs = dbh.cursor()
+    results = []
+    for beg in range(0, len(inlist), IN_CHUNK):
+        chunk = list(inlist[beg:beg + IN_CHUNK])
+        chunk += [None] * (IN_CHUNK - len(chunk))
+        curs.execute(sql, {f"v{i}": val for i, val in enumerate(chunk)})
+        results.extend(str(line[0]) for line in curs)
+    return results
+
+
+def run_binds(unitname, reqnum, attnum):
+    return {'unitname': unitname,
+            'reqnum': reqnum,
+            'attnum': attnum}
 
 
 # verbose
@@ -46,11 +72,12 @@ def delete_db_run(dbh, unitname, reqnum, attnum, verbose=0):
     files2del = [] # all filenames that are being deleted
     del_by_table = {'genfile':[]}  # make the genfile entry to shorten log/wcl code
 
-    sql = f"select metadata_table, wgb.filename from wgb, ops_filetype where wgb.unitname='{unitname}' and wgb.reqnum='{reqnum}' and wgb.attnum='{attnum}' and wgb.filetype=ops_filetype.filetype"
+    binds = run_binds(unitname, reqnum, attnum)
+    sql = "select metadata_table, wgb.filename from wgb, ops_filetype where wgb.unitname=:unitname and wgb.reqnum=:reqnum and wgb.attnum=:attnum and wgb.filetype=ops_filetype.filetype"
     if verbose >= 2:
         print(sql)
     curs = dbh.cursor()
-    curs.execute(sql)
+    curs.execute(sql, binds)
     for line in curs:
         if line[0].lower() not in del_by_table:
             del_by_table[line[0].lower()] = []
@@ -58,22 +85,22 @@ def delete_db_run(dbh, unitname, reqnum, attnum, verbose=0):
         files2del.append(line[1])
 
 
-    sql = f"select log from pfw_wrapper where unitname='{unitname}' and reqnum='{reqnum}' and attnum='{attnum}'"
+    sql = "select log from pfw_wrapper where unitname=:unitname and reqnum=:reqnum and attnum=:attnum"
     if verbose >= 2:
         print(sql)
     curs = dbh.cursor()
-    curs.execute(sql)
+    curs.execute(sql, binds)
     for line in curs:
     #    print line
         if line[0] is not None:
             del_by_table['genfile'].append(line[0])
             files2del.append(line[0])
 
-    sql = f"select junktar from pfw_job where unitname='{unitname}' and reqnum='{reqnum}' and attnum='{attnum}'"
+    sql = "select junktar from pfw_job where unitname=:unitname and reqnum=:reqnum and attnum=:attnum"
     if verbose >= 2:
         print(sql)
     curs = dbh.cursor()
-    curs.execute(sql)
+    curs.execute(sql, binds)
     for line in curs:
     #    print line
         if line[0] is not None:
@@ -84,24 +111,23 @@ def delete_db_run(dbh, unitname, reqnum, attnum, verbose=0):
         miscutils.pretty_print_dict(del_by_table, None, True, 4)
         print("\n\n\n")
 
-    sql = f"select id from pfw_exec where unitname='{unitname}' and reqnum='{reqnum}' and attnum='{attnum}'"
-    curs.execute(sql)
+    sql = "select id from pfw_exec where unitname=:unitname and reqnum=:reqnum and attnum=:attnum"
+    curs.execute(sql, binds)
     execids = [str(line[0]) for line in curs]  # save as str so can easily do join
     if verbose >= 3:
         print(execids)
 
-    sql = f"select id from opm_artifact where name in ('" + "','".join(files2del) + "')"
+    sql = "select id from opm_artifact where name in ({inlist})"
     if verbose >= 2:
         print(sql)
-    curs.execute(sql)
-    artids = [str(line[0]) for line in curs]  # save as str so can easily do join
+    artids = select_using_in(dbh, sql, files2del)
     if verbose >= 3:
         print(artids)
 
-    sql = "select id from pfw_wrapper where unitname='%s' and reqnum='%s' and attnum='%s'" % (unitname, reqnum, attnum)
+    sql = "select id from pfw_wrapper where unitname=:unitname and reqnum=:reqnum and attnum=:attnum"
     if verbose >= 2:
         print(sql)
-    curs.execute(sql)
+    curs.execute(sql, binds)
     wrapids = [str(line[0]) for line in curs]  # save as str so can easily do join
     if verbose >= 3:
         print(wrapids)
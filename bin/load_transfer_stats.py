@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+""" Load the transfer stats files written by jobs (transfer_stats_nodb with transfer_stats_file)
+    into the TASK, TRANSFER_BATCH and TRANSFER_FILE tables
+"""
+
+import os
+import sys
+import glob
+import argparse
+import datetime
+
+from despydmdb import desdmdbi
+import despymisc.miscutils as miscutils
+import filemgmt.transfer_stats_nodb as tsnodb
+
+# suffix added to the stats files once loaded (unless deleting them)
+LOADED_SUFFIX = '.loaded'
+
+
+def parse_cmd_line(argv):
+    """ Parse command line arguments
+
+        Parameters
+        ----------
+        argv : command line arguments
+
+        Returns
+        -------
+        Dictionary of the command line arguments and their values
+    """
+    parser = argparse.ArgumentParser(description='Load transfer stats files written by jobs into the DB',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='Transfer stats files (or glob patterns)')
+    parser.add_argument('--des_services', action='store', help='Services file.')
+    parser.add_argument('--section', '-s', action='store', help='Must be specified if DES_DB_SECTION is not set in environment')
+    parser.add_argument('--parent_task_id', action='store', type=int, help='Parent task id for files that do not have one')
+    parser.add_argument('--root_task_id', action='store', type=int, help='Root task id for files that do not have one')
+    parser.add_argument('--chunk', action='store', type=int, default=100, help='Number of stats files per insert/commit')
+    parser.add_argument('--delete', action='store_true', help=f'Delete the stats files once loaded instead of adding {LOADED_SUFFIX} to their names')
+    parser.add_argument('--dry_run', action='store_true', help='Read the files and print what would be loaded')
+    return parser.parse_args(argv)
+
+
+def to_datetime(epoch):
+    """ datetime for the epoch time from a stats file """
+    if epoch is None:
+        return None
+    return datetime.datetime.fromtimestamp(epoch)
+
+
+def next_task_ids(dbh, count):
+    """ count new task ids from the task sequence, in one query """
+    curs = dbh.cursor()
+    curs.execute(f"select task_seq.nextval from dual connect by level <= {count:d}")
+    ids = [row[0] for row in curs]
+    curs.close()
+    return ids
+
+
+def make_rows(jobinfo, batches, task_ids, args):
+    """ TASK, TRANSFER_BATCH and TRANSFER_FILE rows for one stats file
+
+        Returns
+        -------
+        dict of table name to list of row dicts
+    """
+    parent_task_id = jobinfo.get('parent_task_id') or args.parent_task_id
+    root_task_id = jobinfo.get('root_task_id') or args.root_task_id
+    task_ids = iter(task_ids)
+    rows = {'task': [], 'transfer_batch': [], 'transfer_file': []}
+    for batch in batches:
+        batch_task_id = next(task_ids)
+        files = batch['filelist']
+        start = batch.get('start')
+        end = batch.get('end')
+        if start is None:
+            start = min((f['start'] for f in files if f.get('start') is not None), default=None)
+        rows['task'].append({'id': batch_task_id, 'name': batch.get('name') or 'transfer_batch',
+                             'info_table': 'transfer_batch', 'parent_task_id': parent_task_id,
+                             'root_task_id': root_task_id, 'label': None,
+                             'exec_host': jobinfo.get('host'), 'status': batch.get('status'),
+                             'start_time': to_datetime(start), 'end_time': to_datetime(end)})
+        brow = {'task_id': batch_task_id, 'src': batch.get('src'), 'dst': batch.get('dst'),
+                'transfer_class': batch.get('class'), 'parent_task_id': parent_task_id,
+                'total_num_files': batch.get('files', len(files)),
+                'total_num_bytes': batch.get('bytes', sum(f.get('bytes') or 0 for f in files))}
+        if batch.get('cache'):
+            brow.update(batch['cache'])
+        rows['transfer_batch'].append(brow)
+
+        for finfo in files:
+            file_task_id = next(task_ids)
+            rows['task'].append({'id': file_task_id, 'name': 'transfer_file',
+                                 'info_table': 'transfer_file', 'parent_task_id': batch_task_id,
+                                 'root_task_id': root_task_id, 'label': None,
+                                 'exec_host': jobinfo.get('host'), 'status': finfo.get('status'),
+                                 'start_time': to_datetime(finfo.get('start')),
+                                 'end_time': to_datetime(finfo.get('end'))})
+            frow = {'task_id': file_task_id, 'filename': finfo.get('name'),
+                    'batch_task_id': batch_task_id, 'bytes': finfo.get('bytes')}
+            if finfo.get('timing'):
+                frow.update(finfo['timing'])
+            rows['transfer_file'].append(frow)
+    return rows
+
+
+def table_columns(dbh, table):
+    """ Lower case names of the columns of a table """
+    curs = dbh.cursor()
+    curs.execute(f"select * from {table} where 0=1")
+    cols = {desc[0].lower() for desc in curs.description}
+    curs.close()
+    return cols
+
+
+def insert_rows(dbh, rows):
+    """ Array insert the rows of each table (tasks first, without commit)
+
+        The timing and cache values only go in the columns the tables have (they may not
+        exist in every schema).
+    """
+    for table in ('task', 'transfer_batch', 'transfer_file'):
+        if rows[table]:
+            # timing and cache columns can differ between rows
+            cols = sorted(set().union(*rows[table]) & table_columns(dbh, table))
+            dbh.insert_many(table, cols, [{c: row.get(c) for c in cols} for row in rows[table]])
+
+
+def load_chunk(dbh, filenames, args):
+    """ Load a chunk of stats files in one commit
+
+        Returns
+        -------
+        dict of table name to number of rows loaded
+    """
+    rows = {'task': [], 'transfer_batch': [], 'transfer_file': []}
+    parsed = []
+    for filename in filenames:
+        # one (jobinfo, batches) per run of the job that wrote to the file
+        parsed.extend(tsnodb.read_stats_file(filename))
+    numids = sum(len(b['filelist']) + 1 for (_, batches) in parsed for b in batches)
+    task_ids = next_task_ids(dbh, numids) if numids and not args.dry_run else list(range(numids))
+    for (jobinfo, batches) in parsed:
+        ntask = sum(len(b['filelist']) + 1 for b in batches)
+        for (table, trows) in make_rows(jobinfo, batches, task_ids[:ntask], args).items():
+            rows[table].extend(trows)
+        task_ids = task_ids[ntask:]
+
+    if not args.dry_run:
+        try:
+            insert_rows(dbh, rows)
+            dbh.commit()
+        except Exception:
+            dbh.rollback()
+            raise
+        for filename in filenames:
+            if args.delete:
+                os.remove(filename)
+            else:
+                os.rename(filename, filename + LOADED_SUFFIX)
+    return {table: len(trows) for (table, trows) in rows.items()}
+
+
+def main(argv):
+    """ Program entry point """
+    args = parse_cmd_line(argv)
+
+    filenames = []
+    for pattern in args.files:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print(f"No files match {pattern}")
+        filenames.extend(f for f in matches if not f.endswith(LOADED_SUFFIX))
+    if not filenames:
+        print("No transfer stats files to load")
+        return 0
+
+    dbh = None
+    if not args.dry_run:
+        dbh = desdmdbi.DesDmDbi(args.des_services, args.section)
+    totals = {'task': 0, 'transfer_batch': 0, 'transfer_file': 0}
+    status = 0
+    loaded = 0
+    try:
+        for i in range(0, len(filenames), args.chunk):
+            chunk = filenames[i:i + args.chunk]
+            try:
+                counts = load_chunk(dbh, chunk, args)
+            except Exception as err:
+                print(f"Error loading {chunk[0]} .. {chunk[-1]}: {err}")
+                status = 1
+                continue
+            if miscutils.fwdebug_check(3, 'LOAD_TRANSFER_STATS_DEBUG'):
+                miscutils.fwdebug_print(f"{chunk[0]} .. {chunk[-1]}: {counts}")
+            loaded += len(chunk)
+            for table, num in counts.items():
+                totals[table] += num
+    finally:
+        if dbh is not None:
+            dbh.close()
+
+    print(f"{'Would load' if args.dry_run else 'Loaded'} {loaded} files: "
+          f"{totals['transfer_batch']} batches, {totals['transfer_file']} file transfers")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -9,7 +9,9 @@
 __version__ = "$Rev: 41008 $"
 
 
+import os
 import copy
+from concurrent.futures import ThreadPoolExecutor
 import despymisc.miscutils as miscutils
 #import filemgmt.filemgmt_defs as fmdefs
 import filemgmt.disk_utils_local as disk_utils_local
@@ -30,7 +32,14 @@ class ArchiveTransferLocal:
         self.config = config
 
 
-    def blocking_transfer(self, filelist):
+    def blocking_transfer(self, filelist, replace=False):
+        """ Copy the files (src and dst relative to the archive roots)
+
+            If replace is True, dst files that already exist are replaced: each file is
+            copied to a temporary name and renamed over the dst, so the registered file is
+            never missing or partial.   The results then also have the filesize and md5sum
+            of each copy.
+        """
         miscutils.fwdebug_print(f"\tNumber files to transfer: {len(filelist)}")
         if miscutils.fwdebug_check(1, "ARCHIVETRANSFER_DEBUG"):
             miscutils.fwdebug_print(f"\tfilelist: {filelist}")
@@ -44,6 +53,89 @@ class ArchiveTransferLocal:
             finfo['src'] = f"{srcroot}/{finfo['src']}"
             finfo['dst'] = f"{dstroot}/{finfo['dst']}"
 
-        transresults = disk_utils_local.copyfiles(files2copy, None)
+        if replace:
+            for _, finfo in files2copy.items():
+                tmpname = f"{finfo['dst']}.{os.getpid()}.tmp"
+                try:
+                    path = os.path.dirname(finfo['dst'])
+                    if not os.path.exists(path):
+                        miscutils.coremakedirs(path)
+                    finfo['md5sum'] = disk_utils_local.copyfile_md5(finfo['src'], tmpname)
+                    finfo['filesize'] = os.path.getsize(tmpname)
+                    os.replace(tmpname, finfo['dst'])
+                except Exception as err:
+                    disk_utils_local.remove_file_if_exists(tmpname)
+                    finfo['err'] = str(err)
+            return files2copy
+
+        (_, transresults) = disk_utils_local.copyfiles(files2copy, None,
+                                                       methods=disk_utils_local.ARCHIVE_PLACEMENT)
 
         return transresults
+
+
+    def list_directory(self, relpath):
+        """ Files under relpath in the src archive
+
+            Returns
+            -------
+            dict of path relative to the archive root to (size, mtime in ns)
+        """
+        srcroot = self.src_archive_info['root']
+        files = {}
+        for (dirpath, _, filenames) in os.walk(os.path.join(srcroot, relpath)):
+            for name in filenames:
+                fullname = os.path.join(dirpath, name)
+                fstat = os.stat(fullname)
+                files[os.path.relpath(fullname, srcroot)] = (fstat.st_size, fstat.st_mtime_ns)
+        return files
+
+
+    def md5sum(self, path):
+        """ md5sum of a file in the src archive (path relative to the archive root) """
+        return disk_utils_local.get_md5sum_file(f"{self.src_archive_info['root']}/{path}")
+
+
+    def transfer_directory(self, relpath):
+        """ Copy all files under relpath, returns the results keyed by path within the archive """
+        return self.blocking_transfer({x: {'src': x, 'dst': x} for x in self.list_directory(relpath)})
+
+
+    def fanout_transfer(self, filelists, dst_archive_infos):
+        """ Copy files to several dst archives, reading each src file once
+
+            Parameters
+            ----------
+            filelists : dict
+                Per dst archive name, the files to copy (src and dst relative to the roots)
+            dst_archive_infos : dict
+                Archive info per dst archive name
+
+            Returns
+            -------
+            dict, per dst archive name the filelist with full src and dst and 'err' for failures
+        """
+        srcroot = self.src_archive_info['root']
+        results = {}
+        fanout = {}    # src -> list of (dst archive name, filename, full dst)
+        for dstname, filelist in filelists.items():
+            dstroot = dst_archive_infos[dstname]['root']
+            results[dstname] = copy.deepcopy(filelist)
+            for filename, finfo in results[dstname].items():
+                finfo['src'] = f"{srcroot}/{finfo['src']}"
+                finfo['dst'] = f"{dstroot}/{finfo['dst']}"
+                fanout.setdefault(finfo['src'], []).append((dstname, filename, finfo['dst']))
+        miscutils.fwdebug_print(f"\tNumber files to transfer: {len(fanout)} to {len(filelists)} archives")
+
+        with ThreadPoolExecutor(max_workers=max(1, len(filelists))) as pool:
+            for src, dsts in fanout.items():
+                try:
+                    # dst files already there (e.g., partial copies) are overwritten, a file of
+                    # the right size could still have other contents
+                    errors = disk_utils_local.copyfile_fanout(src, [x[2] for x in dsts], pool=pool)
+                except Exception as err:
+                    errors = {x[2]: str(err) for x in dsts}
+                for (dstname, filename, dst) in dsts:
+                    if dst in errors:
+                        results[dstname][filename]['err'] = errors[dst]
+        return results
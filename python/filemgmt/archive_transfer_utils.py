@@ -3,12 +3,55 @@
 # $LastChangedBy:: mgower                 $:  # Author of last commit.
 # $LastChangedDate:: 2015-12-11 09:55:43 #$:  # Date of last commit.
 
+import os
 import copy
-import sys
+import gzip
 import time
+import queue
+import threading
+import urllib.parse
 import despymisc.miscutils as miscutils
 import filemgmt.filemgmt_defs as fmdefs
 
+# optional config key, number of files transferred and registered (committed) at a time
+REGISTER_CHUNK = 'archive_register_chunk'
+DEFAULT_REGISTER_CHUNK = 500
+
+# optional config key, directory for the incremental archive_copy_dir manifests
+# (default is DEFAULT_SYNC_MANIFEST_DIR, outside of the archives so they aren't taken for
+# archive files)
+SYNC_MANIFEST_DIR = 'archive_sync_manifest_dir'
+DEFAULT_SYNC_MANIFEST_DIR = os.path.join('~', '.filemgmt', 'sync_manifests')
+
+
+def load_manifest(filename):
+    """ Read a directory sync manifest
+
+        Returns
+        -------
+        dict of path (relative to the archive root) to (size, mtime in ns, md5sum or None),
+        empty if there is no manifest
+    """
+    entries = {}
+    if not os.path.exists(filename):
+        return entries
+    with gzip.open(filename, 'rt', encoding='utf-8') as infh:
+        for line in infh:
+            (size, mtime, md5sum, path) = line.rstrip('\n').split('\t', 3)
+            entries[path] = (int(size), int(mtime), None if md5sum == '-' else md5sum)
+    return entries
+
+
+def save_manifest(filename, entries):
+    """ Write a directory sync manifest (atomically) """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmpname = f"{filename}.{os.getpid()}.tmp"
+    with gzip.open(tmpname, 'wt', encoding='utf-8') as outfh:
+        for path in sorted(entries):
+            (size, mtime, md5sum) = entries[path]
+            outfh.write(f"{size}\t{mtime}\t{md5sum or '-'}\t{path}\n")
+    os.replace(tmpname, filename)
+
 
 def get_config_vals(archive_info, config, keylist):
     """ Search given dicts for specific values """
@@ -28,41 +71,215 @@ def get_config_vals(archive_info, config, keylist):
 
 
 
-def archive_copy(src_archive_info, dst_archive_info, archive_transfer_info, filelist, config=None):
-    if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print("BEG")
-
-    src_archive = src_archive_info['name']
-    dst_archive = dst_archive_info['name']
-
-    ## check which files are already on dst
-    # dynamically load filemgmt class for dst
-    dstfilemgmt_class = miscutils.dynamically_load_class(dst_archive_info['filemgmt'])
+class ArchiveTransferSession:
+    """ Copies files between archives, loading the filemgmt and transfer classes and making
+        their objects (so DB connections) once and reusing them for every copy
+
+        Parameters
+        ----------
+        archive_transfer_info : dict
+            Transfer class info by src and dst archive names
+        config : dict
+            Config searched for values the classes need that aren't in the archive info
+    """
+    def __init__(self, archive_transfer_info, config=None):
+        self.archive_transfer_info = archive_transfer_info
+        self.config = config
+        self.classes = {}         # class path -> class
+        self.filemgmts = {}       # archive name -> filemgmt object
+        self.fm_objects = []      # (class path, config vals, filemgmt object)
+        self.transfers = {}       # (src archive name, dst archive name) -> transfer object
+        self.registrars = {}      # archive name -> filemgmt object used to register in the background
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Close the filemgmt objects' DB connections """
+        for fmobj in [x[2] for x in self.fm_objects] + list(self.registrars.values()):
+            if hasattr(fmobj, 'close'):
+                fmobj.close()
+        self.filemgmts = {}
+        self.fm_objects = []
+        self.transfers = {}
+        self.registrars = {}
+
+    def load_class(self, classpath):
+        """ The class for the given module path, loaded once """
+        if classpath not in self.classes:
+            self.classes[classpath] = miscutils.dynamically_load_class(classpath)
+        return self.classes[classpath]
+
+    def get_filemgmt(self, archive_info):
+        """ The filemgmt object for the archive, shared by archives needing the same class
+            and config values (e.g., the same DB) """
+        name = archive_info['name']
+        if name not in self.filemgmts:
+            classpath = archive_info['filemgmt']
+            fmclass = self.load_class(classpath)
+            valDict = get_config_vals(archive_info, self.config, fmclass.requested_config_vals())
+            for (cpath, vals, fmobj) in self.fm_objects:
+                if cpath == classpath and vals == valDict:
+                    self.filemgmts[name] = fmobj
+                    break
+            else:
+                fmobj = fmclass(config=valDict)
+                self.fm_objects.append((classpath, valDict, fmobj))
+                self.filemgmts[name] = fmobj
+        return self.filemgmts[name]
+
+    def get_transfer(self, src_archive_info, dst_archive_info):
+        """ The archive transfer object for the src and dst archives """
+        src_archive = src_archive_info['name']
+        dst_archive = dst_archive_info['name']
+        if (src_archive, dst_archive) in self.transfers:
+            return self.transfers[(src_archive, dst_archive)]
 
-    valDict = get_config_vals(dst_archive_info, config, dstfilemgmt_class.requested_config_vals())
-    dstfilemgmt = dstfilemgmt_class(config=valDict)
+        transinfo = None
+        if src_archive in self.archive_transfer_info and dst_archive in self.archive_transfer_info[src_archive]:
+            transinfo = self.archive_transfer_info[src_archive][dst_archive]
+        elif dst_archive in self.archive_transfer_info and src_archive in self.archive_transfer_info[dst_archive]:
+            transinfo = self.archive_transfer_info[dst_archive][src_archive]
+        else:
+            miscutils.fwdie(f"Error:  Could not determine transfer class for {src_archive} and {dst_archive}", 1)
 
-    if miscutils.fwdebug_check(0, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print(f"dst_archive = {dst_archive}")
-    dst_file_archive_info = dstfilemgmt.get_file_archive_info(filelist, dst_archive,
-                                                              fmdefs.FM_PREFER_UNCOMPRESSED)
-    if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print(f"number of files already at dst {len(dst_file_archive_info)}")
-    if miscutils.fwdebug_check(6, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print(f"dst_file_archive_info {dst_file_archive_info}")
-    files2stage = set(filelist) - set(dst_file_archive_info.keys())
+        # import archive 2 archive class
+        print(f"loading archive transfer class: {transinfo['transfer']}")
+        transobj = None
+        try:
+            transfer_class = self.load_class(transinfo['transfer'])
+            valDict = get_config_vals(transinfo, self.config, transfer_class.requested_config_vals())
+            transobj = transfer_class(src_archive_info, dst_archive_info, transinfo, valDict)
+        except Exception as err:
+            print(f"ERROR\nError: creating archive transfer object\n{err}")
+            raise
+        self.transfers[(src_archive, dst_archive)] = transobj
+        return transobj
+
+    def new_filemgmt(self, archive_info):
+        """ A new filemgmt object (own DB connection) for the archive, not shared """
+        fmclass = self.load_class(archive_info['filemgmt'])
+        valDict = get_config_vals(archive_info, self.config, fmclass.requested_config_vals())
+        return fmclass(config=valDict)
+
+    def get_registrar(self, archive_info):
+        """ The filemgmt object for registering files in the archive from the registering
+            thread (see transfer_and_register), with its own DB connection made on first use
+            and kept for the session """
+        name = archive_info['name']
+        if name not in self.registrars:
+            self.registrars[name] = self.new_filemgmt(archive_info)
+        return self.registrars[name]
+
+    def chunk_size(self):
+        """ Number of files to transfer and register at a time """
+        if self.config is not None and REGISTER_CHUNK in self.config:
+            return max(1, int(self.config[REGISTER_CHUNK]))
+        return DEFAULT_REGISTER_CHUNK
+
+    @staticmethod
+    def register_chunk(fmobj, dst_archive, files2register, problemfiles):
+        """ Register files in the dst archive and commit them.   If that fails, roll back and
+            register them one at a time so only the bad ones are added to problemfiles """
+        if not files2register:
+            return
+        try:
+            regprobs = fmobj.register_file_in_archive(files2register, dst_archive)
+            if not regprobs:
+                fmobj.commit()
+                return
+            err = regprobs
+        except (Exception, SystemExit) as exc:
+            err = exc
+        if hasattr(fmobj, 'rollback'):
+            fmobj.rollback()
+        if len(files2register) == 1:
+            (fname, finfo) = next(iter(files2register.items()))
+            if isinstance(err, dict):
+                err = err.get(fname, err)
+            problemfiles[fname] = dict(finfo, err=f"Could not register: {err}")
+            return
+        print(f"Error: registering {len(files2register)} files failed ({err}), registering them one at a time")
+        for fname, finfo in files2register.items():
+            ArchiveTransferSession.register_chunk(fmobj, dst_archive, {fname: finfo}, problemfiles)
+
+    @staticmethod
+    def split_results(results, problemfiles):
+        """ The transferred files to register, adding the failed transfers to problemfiles """
+        files2register = {}
+        for f, finfo in results.items():
+            if 'err' in finfo:
+                problemfiles[f] = finfo
+            else:
+                files2register[f] = finfo
+        return files2register
 
-    if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print(f"number of files to stage {len(files2stage)}")
-    if miscutils.fwdebug_check(6, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print(f"files to stage {files2stage}")
+    def transfer_and_register(self, transobj, dst_archive_info, chunks):
+        """ Transfer the chunks of files one after another while registering the ones
+            already transferred in another thread (with the session's registrar connection)
 
-    if files2stage is not None and files2stage:
-        ## Stage files not already on dst
-        # dynamically load filemgmt class for src
-        srcfilemgmt_class = miscutils.dynamically_load_class(src_archive_info['filemgmt'])
-        valDict = get_config_vals(src_archive_info, config, srcfilemgmt_class.requested_config_vals())
-        srcfilemgmt = srcfilemgmt_class(config=valDict)
+            Returns
+            -------
+            dict of the files that couldn't be transferred or registered
+        """
+        dst_archive = dst_archive_info['name']
+        problemfiles = {}
+        regproblems = {}
+        regqueue = queue.Queue()
+        failure = []
+
+        def registrar():
+            try:
+                fmobj = self.get_registrar(dst_archive_info)
+                while True:
+                    files2register = regqueue.get()
+                    if files2register is None:
+                        break
+                    self.register_chunk(fmobj, dst_archive, files2register, regproblems)
+            except BaseException as err:
+                failure.append(err)
+
+        thread = threading.Thread(target=registrar, name='archive_register')
+        thread.start()
+        try:
+            for chunk in chunks:
+                if failure:
+                    break
+                starttime = time.time()
+                results = transobj.blocking_transfer(chunk)
+                print(f"\tTransfering {len(chunk)} file(s) took {time.time() - starttime} seconds")
+                regqueue.put(self.split_results(results, problemfiles))
+        finally:
+            regqueue.put(None)
+            thread.join()
+        if failure:
+            raise failure[0]
+        problemfiles.update(regproblems)
+        return problemfiles
+
+    @staticmethod
+    def report_problems(problemfiles, return_problems=False):
+        """ Print the files that couldn't be transferred or registered, and die unless
+            return_problems (the caller takes them from the return value instead) """
+        if problemfiles:
+            print(f"ERROR\n\n\nError: {len(problemfiles)} file(s) not copied into the archive (the others were)")
+            for f, pinfo in sorted(problemfiles.items()):
+                print(f"\t{f} {pinfo.get('src')} -> {pinfo.get('dst')}: {pinfo['err']}")
+            if not return_problems:
+                miscutils.fwdie(f"Error: putting {len(problemfiles):d} files into archive", 1)
+
+    def src_files(self, src_archive_info, files2stage):
+        """ Look up the files in the src archive (dies if any are missing)
+
+            Returns
+            -------
+            dict of file info with src and dst relative to the archive roots
+        """
+        src_archive = src_archive_info['name']
+        srcfilemgmt = self.get_filemgmt(src_archive_info)
 
         # get archive paths for files in home archive
         src_file_archive_info = srcfilemgmt.get_file_archive_info(files2stage, src_archive, fmdefs.FM_PREFER_COMPRESSED)
@@ -75,161 +292,333 @@ def archive_copy(src_archive_info, dst_archive_info, archive_transfer_info, file
             miscutils.fwdie("Error: Missing files", 1)
 
         # dst rel path will be same as src rel path
-        # create full paths for home archive and target archive
-        #src_root = src_archive_info['root']
-        #dst_root = dst_archive_info['root']
         files2copy = {}
         for filename, fileinfo in src_file_archive_info.items():
             if miscutils.fwdebug_check(6, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
                 miscutils.fwdebug_print(f"{filename}: fileinfo = {fileinfo}")
             files2copy[filename] = copy.deepcopy(fileinfo)
-            #files2copy[filename]['src'] = "%s/%s" % (src_root, fileinfo['rel_filename'])
-            #iles2copy[filename]['dst'] = "%s/%s" % (dst_root, fileinfo['rel_filename'])
             files2copy[filename]['src'] = fileinfo['rel_filename']
             files2copy[filename]['dst'] = fileinfo['rel_filename']
+        return files2copy
+
+    def copy(self, src_archive_info, dst_archive_info, filelist, return_problems=False):
+        """ Copy the files in filelist not already in the dst archive from the src archive
+            and register them.   Dies if any file couldn't be, unless return_problems.
+
+            Returns
+            -------
+            dict of the files that couldn't be transferred or registered (with 'err')
+        """
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print("BEG")
+
+        src_archive = src_archive_info['name']
+        dst_archive = dst_archive_info['name']
+
+        ## check which files are already on dst
+        dstfilemgmt = self.get_filemgmt(dst_archive_info)
+
+        if miscutils.fwdebug_check(0, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print(f"dst_archive = {dst_archive}")
+        dst_file_archive_info = dstfilemgmt.get_file_archive_info(filelist, dst_archive,
+                                                                  fmdefs.FM_PREFER_UNCOMPRESSED)
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print(f"number of files already at dst {len(dst_file_archive_info)}")
+        if miscutils.fwdebug_check(6, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print(f"dst_file_archive_info {dst_file_archive_info}")
+        files2stage = set(filelist) - set(dst_file_archive_info.keys())
+
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print(f"number of files to stage {len(files2stage)}")
+        if miscutils.fwdebug_check(6, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print(f"files to stage {files2stage}")
 
+        problemfiles = {}
+        if files2stage is not None and files2stage:
+            ## Stage files not already on dst
+            files2copy = self.src_files(src_archive_info, files2stage)
+
+            transobj = self.get_transfer(src_archive_info, dst_archive_info)
+
+            # big stagings register chunks already transferred while the next ones transfer
+            names = list(files2copy)
+            size = self.chunk_size()
+            chunks = [{f: files2copy[f] for f in names[i:i + size]} for i in range(0, len(names), size)]
+            if len(chunks) > 1:
+                problemfiles = self.transfer_and_register(transobj, dst_archive_info, chunks)
+            else:
+                starttime = time.time()    # save start time
+                results = transobj.blocking_transfer(files2copy)
+                endtime = time.time()     # save end time
+                print(f"\tTransfering {len(files2copy)} file(s) took {endtime - starttime} seconds")
+                self.register_chunk(dstfilemgmt, dst_archive, self.split_results(results, problemfiles),
+                                    problemfiles)
+            self.report_problems(problemfiles, return_problems)
+
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print("END\n\n")
+        return problemfiles
+
+    def copy_multi(self, src_archive_info, dst_archive_infos, filelist, return_problems=False):
+        """ Copy the files in filelist to several dst archives (those not already there) and
+            register them, looking the files up in the src archive and reading them only once
+            if the transfer class has a fanout_transfer (otherwise copied to each dst in turn).
+            Dies if any file couldn't be, unless return_problems.
+
+            Returns
+            -------
+            dict, per dst archive name, of the files that couldn't be transferred or
+            registered (with 'err')
+        """
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print("BEG")
+
+        dstinfos = {x['name']: x for x in dst_archive_infos}
+        filelists = {}
+        for dst_archive, dst_archive_info in dstinfos.items():
+            dst_file_archive_info = self.get_filemgmt(dst_archive_info).get_file_archive_info(filelist, dst_archive,
+                                                                                              fmdefs.FM_PREFER_UNCOMPRESSED)
+            filelists[dst_archive] = set(filelist) - set(dst_file_archive_info.keys())
+            if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+                miscutils.fwdebug_print(f"number of files to stage to {dst_archive} {len(filelists[dst_archive])}")
+
+        problems = {x: {} for x in dstinfos}
+        files2stage = set().union(*filelists.values())
+        if files2stage:
+            files2copy = self.src_files(src_archive_info, files2stage)
+            for dst_archive in dstinfos:
+                filelists[dst_archive] = {f: files2copy[f] for f in filelists[dst_archive]}
+
+            transobjs = {x: self.get_transfer(src_archive_info, dstinfos[x]) for x in dstinfos if filelists[x]}
+            starttime = time.time()
+            # one transfer object can only do them all if they'd all be the same
+            first = next(iter(transobjs.values()))
+            if (hasattr(first, 'fanout_transfer') and
+                    all(type(x) is type(first) and
+                        getattr(x, 'archive_transfer_info', None) == getattr(first, 'archive_transfer_info', None) and
+                        getattr(x, 'config', None) == getattr(first, 'config', None)
+                        for x in transobjs.values())):
+                allresults = first.fanout_transfer({x: filelists[x] for x in transobjs}, dstinfos)
+            else:
+                allresults = {x: transobjs[x].blocking_transfer(filelists[x]) for x in transobjs}
+            print(f"\tTransfering {len(files2copy)} file(s) to {len(transobjs)} archive(s) took {time.time() - starttime} seconds")
+
+            size = self.chunk_size()
+            for dst_archive, results in allresults.items():
+                dstfilemgmt = self.get_filemgmt(dstinfos[dst_archive])
+                files2register = self.split_results(results, problems[dst_archive])
+                names = list(files2register)
+                for i in range(0, len(names), size):
+                    self.register_chunk(dstfilemgmt, dst_archive,
+                                        {f: files2register[f] for f in names[i:i + size]},
+                                        problems[dst_archive])
+                self.report_problems(problems[dst_archive], True)
+            if not return_problems and any(problems.values()):
+                miscutils.fwdie(f"Error: putting {sum(len(x) for x in problems.values()):d} files into archives", 1)
+
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print("END\n\n")
+        return problems
+
+    def copy_dir(self, src_archive_info, dst_archive_info, relpath, incremental=False, return_problems=False):
+        """ Copy a directory (relpath within the archive) from the src archive and register
+            its files.   Doesn't check which files already exist on dst, unless incremental
+            (see sync_dir).   Dies if any file couldn't be copied or registered, unless
+            return_problems.
+
+            Returns
+            -------
+            dict of the files that couldn't be transferred or registered (with 'err')
+        """
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print("BEG")
+
+        dst_archive = dst_archive_info['name']
+        dstfilemgmt = self.get_filemgmt(dst_archive_info)
+
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print(f"dst_archive = {dst_archive}")
 
-        ## call blocking transfer function
-        transinfo = None
-        if src_archive in archive_transfer_info and dst_archive in archive_transfer_info[src_archive]:
-            transinfo = archive_transfer_info[src_archive][dst_archive]
-        elif dst_archive in archive_transfer_info and src_archive in archive_transfer_info[dst_archive]:
-            transinfo = archive_transfer_info[dst_archive][src_archive]
-        else:
-            miscutils.fwdie(f"Error:  Could not determine transfer class for {src_archive} and {dst_archive}", 1)
-
-        # import archive 2 archive class
-        print(f"loading archive transfer class: {transinfo['transfer']}")
-        transobj = None
-        try:
-            transfer_class = miscutils.dynamically_load_class(transinfo['transfer'])
-            valDict = get_config_vals(transinfo, config, transfer_class.requested_config_vals())
-            transobj = transfer_class(src_archive_info, dst_archive_info, transinfo, valDict)
-        except Exception as err:
-            print(f"ERROR\nError: creating archive transfer object\n{err}")
-            raise
+        # dst rel path will be same as src rel path
+        transobj = self.get_transfer(src_archive_info, dst_archive_info)
+        if incremental:
+            if hasattr(transobj, 'list_directory'):
+                return self.sync_dir(src_archive_info, dst_archive_info, relpath, return_problems)
+            print(f"{transobj.__class__.__name__} can't list directories, copying all of {relpath}")
 
         starttime = time.time()    # save start time
-        results = transobj.blocking_transfer(files2copy)
+        transresults = transobj.transfer_directory(relpath)
         endtime = time.time()     # save end time
-        print(f"\tTransfering {len(files2copy)} file(s) took {endtime - starttime} seconds")
+        print(f"\tTransfering directory {relpath} took {endtime - starttime} seconds")
 
-        files2register = {}
         problemfiles = {}
-        for f, finfo in results.items():
-            if 'err' in finfo:
-                problemfiles[f] = finfo
-            else:
-                files2register[f] = finfo
+        files2register = self.split_results(transresults, problemfiles)
+        names = list(files2register)
+        size = self.chunk_size()
+        for i in range(0, len(names), size):
+            self.register_chunk(dstfilemgmt, dst_archive,
+                                {f: files2register[f] for f in names[i:i + size]}, problemfiles)
+        self.report_problems(problemfiles, return_problems)
+
+        if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
+            miscutils.fwdebug_print("END\n\n")
+        return problemfiles
+
+    def manifest_name(self, src_archive_info, dst_archive_info, relpath):
+        """ Filename of the sync manifest for a directory """
+        if self.config is not None and SYNC_MANIFEST_DIR in self.config:
+            mdir = self.config[SYNC_MANIFEST_DIR]
+        else:
+            mdir = os.path.expanduser(DEFAULT_SYNC_MANIFEST_DIR)
+        name = urllib.parse.quote(relpath.strip('/'), safe='')
+        return os.path.join(mdir, dst_archive_info['name'], src_archive_info['name'], f"{name}.manifest.gz")
+
+    @staticmethod
+    def dst_md5sums(dstfilemgmt, dst_archive, paths):
+        """ The md5sums in the dst archive's DB of the files (paths relative to the archive
+            root) registered there at that path
+
+            Returns
+            -------
+            dict of path to md5sum
+        """
+        byname = {os.path.basename(x): x for x in paths}
+        dstinfo = dstfilemgmt.get_file_archive_info(list(byname), dst_archive, fmdefs.FM_PREFER_UNCOMPRESSED)
+        return {byname[fname]: finfo.get('md5sum') for fname, finfo in dstinfo.items()
+                if fname in byname and finfo.get('rel_filename') == byname[fname]}
+
+    @staticmethod
+    def update_replaced(dstfilemgmt, results, problemfiles):
+        """ Update the filesize and md5sum in the DB of the files replaced in the dst archive,
+            adding the ones that failed (to copy or update) to problemfiles """
+        replaced = ArchiveTransferSession.split_results(results, problemfiles)
+        if not replaced:
+            return
+        parsemask = miscutils.CU_PARSE_PATH | miscutils.CU_PARSE_FILENAME | miscutils.CU_PARSE_COMPRESSION
+        updates = []
+        for path, finfo in replaced.items():
+            (_, filename, compression) = miscutils.parse_fullname(path, parsemask)
+            updates.append({'filename': filename, 'compression': compression,
+                            'filesize': finfo['filesize'], 'md5sum': finfo['md5sum']})
+        try:
+            dstfilemgmt.update_file_size_md5(updates)
+            dstfilemgmt.commit()
+        except Exception as err:
+            if hasattr(dstfilemgmt, 'rollback'):
+                dstfilemgmt.rollback()
+            for path, finfo in replaced.items():
+                problemfiles[path] = dict(finfo, err=f"Could not update filesize and md5sum: {err}")
+
+    def sync_dir(self, src_archive_info, dst_archive_info, relpath, return_problems=False):
+        """ Copy to the dst archive only the files under relpath that are new or changed
+            since the last sync (by size and mtime, and md5sum when only the mtime changed),
+            using a manifest of the files synced last time.   New files are registered,
+            changed ones are replaced (they are already registered, their filesize and md5sum
+            are updated).   Dies if any file couldn't be synced, unless return_problems.
+
+            Returns
+            -------
+            dict of the files that couldn't be transferred or registered (with 'err')
+        """
+        dst_archive = dst_archive_info['name']
+        dstfilemgmt = self.get_filemgmt(dst_archive_info)
+        transobj = self.get_transfer(src_archive_info, dst_archive_info)
+        manifest_name = self.manifest_name(src_archive_info, dst_archive_info, relpath)
+        manifest = load_manifest(manifest_name)
+        current = transobj.list_directory(relpath)
+
+        newfiles = []
+        changed = []
+        for path, (size, mtime) in current.items():
+            if path not in manifest:
+                newfiles.append(path)
+            elif manifest[path][:2] != (size, mtime):
+                md5sum = manifest[path][2]
+                if size == manifest[path][0] and md5sum and hasattr(transobj, 'md5sum') and \
+                        transobj.md5sum(path) == md5sum:
+                    manifest[path] = (size, mtime, md5sum)    # only touched
+                else:
+                    changed.append(path)
+        deleted = set(manifest) - set(current)
+        for path in deleted:
+            del manifest[path]
+
+        # files not in the manifest (e.g., first sync) may already be in the dst archive
+        if newfiles:
+            for path, md5sum in self.dst_md5sums(dstfilemgmt, dst_archive, newfiles).items():
+                newfiles.remove(path)
+                manifest[path] = current[path] + (md5sum,)
+
+        print(f"\tSync {relpath}: {len(newfiles)} new, {len(changed)} changed, {len(deleted)} deleted, "
+              f"{len(current) - len(newfiles) - len(changed)} unchanged")
 
-        if problemfiles is not None and problemfiles:
-            print("Error: Problems copying files from home archive to target archive")
-            print(problemfiles)
-            for f, pinfo in problemfiles.items():
-                print(f"\t{f} {pinfo['src']} -> {pinfo['dst']}: {pinfo['err']}")
-        elif files2register:
-            regprobs = dstfilemgmt.register_file_in_archive(files2register, dst_archive)
-            if regprobs is not None and regprobs:
-                problemfiles.update(regprobs)
-
-            if problemfiles:
-                print(f"ERROR\n\n\nError: putting {len(problemfiles):0d} files into archive")
-                for file in problemfiles:
-                    print(file, problemfiles[file])
-                    sys.exit(1)
+        problemfiles = {}
+        starttime = time.time()
+        if newfiles:
+            size = self.chunk_size()
+            chunks = [{x: {'src': x, 'dst': x} for x in newfiles[i:i + size]}
+                      for i in range(0, len(newfiles), size)]
+            if len(chunks) > 1:
+                problemfiles = self.transfer_and_register(transobj, dst_archive_info, chunks)
             else:
-                dstfilemgmt.commit()
-
-    if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print("END\n\n")
-
-
-def archive_copy_dir(src_archive_info, dst_archive_info, archive_transfer_info, relpath, config=None):
+                results = transobj.blocking_transfer(chunks[0])
+                self.register_chunk(dstfilemgmt, dst_archive, self.split_results(results, problemfiles),
+                                    problemfiles)
+        replaced = {}
+        if changed:
+            replaced = transobj.blocking_transfer({x: {'src': x, 'dst': x} for x in changed}, replace=True)
+            self.update_replaced(dstfilemgmt, replaced, problemfiles)
+        print(f"\tSyncing directory {relpath} took {time.time() - starttime} seconds")
+
+        # md5sums from the DB for the new files and from the copy for the replaced ones
+        registered = [x for x in newfiles if x not in problemfiles]
+        md5sums = self.dst_md5sums(dstfilemgmt, dst_archive, registered) if registered else {}
+        for path in registered:
+            manifest[path] = current[path] + (md5sums.get(path),)
+        for path in changed:
+            if path not in problemfiles:
+                manifest[path] = current[path] + (replaced[path].get('md5sum'),)
+        save_manifest(manifest_name, manifest)
+        self.report_problems(problemfiles, return_problems)
+        return problemfiles
+
+
+# session reused by archive_copy and archive_copy_dir while they are called with the same
+# archive_transfer_info and config
+_session = None
+
+
+def get_session(archive_transfer_info, config=None):
+    """ The ArchiveTransferSession for the given info, reusing the last one if it was made
+        from the same objects """
+    global _session
+    if (_session is None or _session.archive_transfer_info is not archive_transfer_info or
+            _session.config is not config):
+        if _session is not None:
+            _session.close()
+        _session = ArchiveTransferSession(archive_transfer_info, config)
+    return _session
+
+
+def archive_copy(src_archive_info, dst_archive_info, archive_transfer_info, filelist, config=None,
+                 return_problems=False):
+    """ Copy files between archives (see ArchiveTransferSession.copy), returns the problem files """
+    return get_session(archive_transfer_info, config).copy(src_archive_info, dst_archive_info, filelist,
+                                                           return_problems)
+
+
+def archive_copy_dir(src_archive_info, dst_archive_info, archive_transfer_info, relpath, config=None,
+                     incremental=False, return_problems=False):
+    """ Copy a directory between archives (see ArchiveTransferSession.copy_dir), returns the
+        problem files """
     # relpath is relative path within archive
-    # this function doesn't check which files already exist on dst.
-
-    if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print("BEG")
-
-    src_archive = src_archive_info['name']
-    dst_archive = dst_archive_info['name']
-
-    ## check which files are already on dst
-    # dynamically load filemgmt class for dst
-    dstfilemgmt_class = miscutils.dynamically_load_class(dst_archive_info['filemgmt'])
-
-    valDict = get_config_vals(dst_archive_info, config, dstfilemgmt_class.requested_config_vals())
-    dstfilemgmt = dstfilemgmt_class(config=valDict)
-
-    if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print(f"dst_archive = {dst_archive}")
-
-
-    ## dynamically load filemgmt class for src
-    #srcfilemgmt_class = miscutils.dynamically_load_class(src_archive_info['filemgmt'])
-    #valDict = get_config_vals(src_archive_info, config, srcfilemgmt_class.requested_config_vals())
-    #srcfilemgmt = srcfilemgmt_class(config=valDict)
-    #
-    ## get archive paths for files in home archive
-    #src_file_archive_info = srcfilemgmt.get_file_archive_info(files2stage, src_archive, fwdefs.FM_PREFER_COMPRESSED)
-    #missing_files = set(files2stage) - set(src_file_archive_info.keys())
-    #fwdebug(0, "ARCHIVE_TRANSFER_UTILS_DEBUG", "files not on src archive %s" % missing_files)
-
-    #    if missing_files is not None and len(missing_files) > 0:
-    #        print "Error:  Could not find the following files on the src archive"
-    #        for f in missing_files:
-    #            print "\t%s" % f
-    #        miscutils.fwdie("Error: Missing files", 1)
-
-    # dst rel path will be same as src rel path
-    transinfo = None
-    if src_archive in archive_transfer_info and dst_archive in archive_transfer_info[src_archive]:
-        transinfo = archive_transfer_info[src_archive][dst_archive]
-    elif dst_archive in archive_transfer_info and src_archive in archive_transfer_info[dst_archive]:
-        transinfo = archive_transfer_info[dst_archive][src_archive]
-    else:
-        miscutils.fwdie(f"Error:  Could not determine transfer class for {src_archive} and {dst_archive}", 1)
-
-    # import archive 2 archive class
-    transobj = None
-    try:
-        transfer_class = miscutils.dynamically_load_class(transinfo['transfer'])
-        valDict = get_config_vals(transinfo, config, transfer_class.requested_config_vals())
-        transobj = transfer_class(src_archive_info, dst_archive_info, transinfo, valDict)
-    except Exception as err:
-        print(f"ERROR\nError: creating archive transfer object\n{err}")
-        raise
-
-    starttime = time.time()    # save start time
-    transresults = transobj.transfer_directory(relpath)
-    endtime = time.time()     # save end time
-    print(f"\tTransfering directory {relpath} took {endtime - starttime} seconds")
-
-    files2register = {}
-    problemfiles = {}
-    for f, finfo in transresults.items():
-        if 'err' in finfo:
-            problemfiles[f] = finfo
-        else:
-            files2register[f] = finfo
-
-    if problemfiles is not None and problemfiles:
-        print("Error: Problems copying files from home archive to target archive")
-        for f in problemfiles:
-            print(problemfiles[f])
-            print(f"\t{f} {problemfiles[f]['dst']}: {problemfiles[f]['err']}")
-    elif files2register:
-        regprobs = dstfilemgmt.register_file_in_archive(files2register, dst_archive)
-        if regprobs is not None and regprobs:
-            problemfiles.update(regprobs)
+    return get_session(archive_transfer_info, config).copy_dir(src_archive_info, dst_archive_info, relpath,
+                                                               incremental, return_problems)
 
-        if problemfiles:
-            print(f"ERROR\n\n\nError: putting {len(problemfiles):0d} files into archive")
-            for file in problemfiles:
-                print(file, problemfiles[file])
-                sys.exit(1)
-        else:
-            dstfilemgmt.commit()
 
-    if miscutils.fwdebug_check(3, "ARCHIVE_TRANSFER_UTILS_DEBUG"):
-        miscutils.fwdebug_print("END\n\n")
+def archive_copy_multi(src_archive_info, dst_archive_infos, archive_transfer_info, filelist, config=None,
+                       return_problems=False):
+    """ Copy files from one archive to several (see ArchiveTransferSession.copy_multi),
+        returns the problem files per dst archive """
+    return get_session(archive_transfer_info, config).copy_multi(src_archive_info, dst_archive_infos,
+                                                                 filelist, return_problems)
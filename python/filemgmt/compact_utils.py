@@ -54,10 +54,8 @@ class CompactLogs(fmutils.FileManager):
         owd = os.getcwd()
         try:
             self.update("Gathering file info from DB")
+            # gather_data also sets reqnum, unitname, and attnum
             self.gather_data()
-            curs = self.dbh.cursor()
-            curs.execute(f"select reqnum, unitname, attnum from pfw_attempt where id={self.pfwid}")
-            (self.reqnum, self.unitname, self.attnum) = curs.fetchone()
             if not self.relpath:
                 self.update(f'  Connot compact logs for pfw_attempt_id, no relpath found {self.pfwid}', True)
                 return 1
@@ -116,11 +114,16 @@ class CompactLogs(fmutils.FileManager):
                                  }
                         sql = "insert into desfile (filename, compression, filetype, pfw_attempt_id, wgb_task_id, filesize, md5sum) values (:fname, :comp, :ftype, :pfwid, :wgb, :fsize, :md5sum)"
                         curs.execute(sql, finfo)
-                        sql = f"select id from desfile where filename='{self.tarfile.replace('.gz', '')}' and compression='.gz'"
-                        curs.execute(sql)
+                        sql = "select id from desfile where filename=:fname and compression=:comp"
+                        curs.execute(sql, {'fname': finfo['fname'],
+                                           'comp': finfo['comp']})
                         fid = curs.fetchone()[0]
-                        sql = f"insert into file_archive_info (filename, compression, archive_name, path, desfile_id) values ('{self.tarfile.replace('.gz', '')}', '.gz', '{self.archive}', '{os.path.join(self.relpath, 'log')}', {fid})"
-                        curs.execute(sql)
+                        sql = "insert into file_archive_info (filename, compression, archive_name, path, desfile_id) values (:fname, :comp, :archive, :path, :fid)"
+                        curs.execute(sql, {'fname': finfo['fname'],
+                                           'comp': finfo['comp'],
+                                           'archive': self.archive,
+                                           'path': os.path.join(self.relpath, 'log'),
+                                           'fid': fid})
 
                 except:
                     self.update("Error updating the database entries, rolling back any DB changes.", True)
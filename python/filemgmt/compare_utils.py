@@ -1,15 +1,32 @@
 """ Compare files from local disk and DB location tracking based upon an archive path """
 
+import copy
+import heapq
+import json
+import os
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from despydmdb import desdmdbi
 from filemgmt import fmutils
+import filemgmt.disk_utils_local as dkutils
+
+# number of rows the DB driver pulls per round trip when streaming an inventory
+STREAM_ARRAYSIZE = 5000
+# number of completed paths between checkpoint writes
+CHECKPOINT_EVERY = 100
 
 
 class FileCompare(fmutils.FileManager):
     def __init__(self, args, pfwids):
         fmutils.FileManager.__init__(self, 0, args, pfwids, None, None)
+        self.args = args
         self.start_at = args.start_at
         self.end_at = args.end_at
         self.date_range = args.date_range
         self.pipeline = args.pipeline
+        self.parallel = fmutils.check_arg(args, 'parallel') or 1
 
     def print_all_files(self):
         """ Print both lists of files side by side
@@ -238,6 +255,10 @@ class FileCompare(fmutils.FileManager):
             self.pfwids = self.pfwids[offset:self.end_at]
         else:
             self.pfwids = self.pfwids[offset:]
+        self.prefetch_attempt_info()
+        self.file_inventory = fmutils.AttemptInventory(self.archive, self.pfwids)
+        if self.parallel > 1 and len(self.pfwids) > 1:
+            return self.parallel_task(offset, length)
         for i, pdwi in enumerate(self.pfwids):
             print(f"--------------------- Starting {i + 1 + offset:d}/{length:d} ---------------------")
             self.pfwid = pdwi
@@ -245,6 +266,99 @@ class FileCompare(fmutils.FileManager):
         return count
 
 
+    def parallel_task(self, offset, length):
+        """ Method to run the comparison for the pfw_attempt_ids on self.parallel worker threads
+
+            Each task runs in its own FileCompare instance using a connection drawn from a
+            small pool, so the DB queries, disk walks, and md5sums of different attempts
+            overlap.  The output of each task is buffered and printed in input order, so
+            the output and return value are the same as for a serial run.
+
+            Parameters
+            ----------
+            offset : int
+                The index of the first pfw_attempt_id in the full list (for the progress
+                lines)
+
+            length : int
+                The length of the full list of pfw_attempt_ids
+
+            Returns
+            -------
+            A sum of the results of do_task
+        """
+        nthreads = min(self.parallel, len(self.pfwids))
+        pool = queue.Queue()
+        pool.put(self.dbh)
+        extra = []
+        for _ in range(nthreads - 1):
+            dbh = desdmdbi.DesDmDbi(self.des_services, self.section)
+            extra.append(dbh)
+            pool.put(dbh)
+
+        stdp = fmutils.ThreadOutput()
+        sys.stdout = stdp
+        count = 0
+        try:
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                futures = [executor.submit(self.compare_one, pfwid, pool, stdp) for pfwid in self.pfwids]
+                for i, fut in enumerate(futures):
+                    try:
+                        (ret, text) = fut.result()
+                    except Exception as ex:
+                        # a worker that died outside of do_task still counts as a failure
+                        (ret, text) = (1, f"{self.pfwids[i]}  ERROR ({ex})\n")
+                    print(f"--------------------- Starting {i + 1 + offset:d}/{length:d} ---------------------")
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+                    count += ret
+        finally:
+            sys.stdout = stdp.close()
+            for dbh in extra:
+                dbh.close()
+        return count
+
+    def compare_one(self, pfwid, pool, stdp):
+        """ Method to run the comparison of a single pfw_attempt_id from a worker thread
+
+            Parameters
+            ----------
+            pfwid : int
+                The pfw_attempt_id to compare
+
+            pool : queue.Queue
+                The pool of DB connections
+
+            stdp : fmutils.ThreadOutput
+                The stdout replacement used to capture the output of this task
+
+            Returns
+            -------
+            tuple of the result of do_task and the text it printed
+        """
+        dbh = pool.get()
+        stdp.start()
+        try:
+            args = copy.copy(self.args)
+            args.dbh = dbh
+            args.pfwid = pfwid
+            args.parallel = 1
+            comp = FileCompare(args, [pfwid])
+            comp.attempt_info = self.attempt_info
+            comp.file_inventory = self.file_inventory
+            try:
+                ret = comp.do_task()
+            finally:
+                # the connection belongs to the pool, do not let the instance close it
+                comp.dbh = None
+        except Exception as ex:
+            print(f"{pfwid}  ERROR ({ex})")
+            ret = 1
+        finally:
+            text = stdp.stop()
+            pool.put(dbh)
+        return (ret, text)
+
     def do_task(self):
         """ Main control """
         self.gather_data()
@@ -320,12 +434,279 @@ class FileCompare(fmutils.FileManager):
             print(f"{loc}  ERROR")
         return 1
 
+
+def stream_files_from_db(dbh, archive, relpath=None, start_after=None):
+    """ Stream the file inventory of an archive ordered by (path, filename)
+
+        The rows are fetched STREAM_ARRAYSIZE at a time from a single open cursor, so
+        only one batch is ever held in memory.  The ordering and the start_after comparison
+        are done with NLS_SORT=BINARY whatever the session settings so that they match the
+        ordering of disk_inventory_stream.
+
+        Parameters
+        ----------
+        dbh : database handle
+            The handle to use for the query
+
+        archive : str
+            The archive name to use
+
+        relpath : str
+            Only return files at or below this relative path, default is the whole archive
+
+        start_after : str
+            Only return files whose path sorts after this path (used to resume from a
+            checkpoint)
+
+        Yields
+        ------
+        tuple of ((path, filename including compression), filesize, md5sum)
+    """
+    binds = {'archive': archive}
+    sql = "select fai.path, fai.filename, fai.compression, art.filesize, art.md5sum from desfile art, file_archive_info fai where"
+    wherevals = ['fai.desfile_id=art.id',
+                 f"fai.archive_name={dbh.get_named_bind_string('archive')}"]
+    if relpath is not None:
+        wherevals.append(f"(fai.path={dbh.get_named_bind_string('relpath')} or fai.path like {dbh.get_named_bind_string('relpathlike')})")
+        binds['relpath'] = relpath.strip('/')
+        binds['relpathlike'] = relpath.strip('/') + '/%'
+    if start_after is not None:
+        wherevals.append(f"nlssort(fai.path, 'NLS_SORT=BINARY') > nlssort({dbh.get_named_bind_string('start')}, 'NLS_SORT=BINARY')")
+        binds['start'] = start_after
+    sql += fmutils.build_where_clause(wherevals)
+    sql += " order by nlssort(fai.path, 'NLS_SORT=BINARY'), nlssort(fai.filename || coalesce(fai.compression, ''), 'NLS_SORT=BINARY')"
+
+    curs = dbh.cursor()
+    curs.arraysize = STREAM_ARRAYSIZE
+    curs.execute(sql, binds)
+    try:
+        for (path, filename, compression, filesize, md5sum) in curs:
+            if compression is not None:
+                filename += compression
+            yield ((path.rstrip('/'), filename), filesize, md5sum)
+    finally:
+        curs.close()
+
+
+def disk_inventory_stream(archive_root, relpath=None, start_after=None, md5sum=False):
+    """ Walk an archive yielding files in the same (path, filename) order as stream_files_from_db
+
+        Directories are visited in sorted order of their relative path (a plain depth first
+        walk does not give that ordering, e.g. a/b-c sorts before a/b/c).  Only the
+        directories waiting to be visited are held in memory, never the list of files.
+
+        Parameters
+        ----------
+        archive_root : str
+            The root of the archive
+
+        relpath : str
+            Only walk the tree at or below this relative path, default is the whole archive
+
+        start_after : str
+            Skip the files of all directories whose relative path sorts at or before this
+            path (subdirectories are still walked if anything below them can sort after it)
+
+        md5sum : bool
+            Whether or not to compute the md5sum of each file
+
+        Yields
+        ------
+        tuple of ((path, filename), filesize, md5sum)
+    """
+    top = '' if relpath is None else relpath.strip('/')
+    pending = [top]
+    while pending:
+        rdir = heapq.heappop(pending)
+        # only yield files from directories which have not been checkpointed
+        dofiles = start_after is None or rdir > start_after
+        files = []
+        try:
+            with os.scandir(os.path.join(archive_root, rdir)) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub = os.path.join(rdir, entry.name)
+                        # only descend if something below may sort after the checkpoint,
+                        # i.e. unless every path starting with sub/ sorts before it
+                        if start_after is None or start_after < sub + '/' or \
+                           start_after.startswith(sub + '/'):
+                            heapq.heappush(pending, sub)
+                    elif dofiles:
+                        files.append((entry.name, entry.stat(follow_symlinks=False).st_size))
+        except OSError as exc:
+            print(f"Warning: cannot read directory {os.path.join(archive_root, rdir)}: {exc}")
+            continue
+        files.sort()
+        for (name, size) in files:
+            fmd5 = None
+            if md5sum:
+                fmd5 = dkutils.get_md5sum_file(os.path.join(archive_root, rdir, name))
+            yield ((rdir, name), size, fmd5)
+
+
+def merge_inventories(db_iter, disk_iter, md5sum=False):
+    """ Merge-join two ordered inventory streams and yield discrepancies as they are found
+
+        Because both streams are sorted by (path, filename) a file with a path mismatch
+        shows up as one dbonly and one diskonly entry.
+
+        Parameters
+        ----------
+        db_iter : iterator
+            Output of stream_files_from_db
+
+        disk_iter : iterator
+            Output of disk_inventory_stream
+
+        md5sum : bool
+            Whether or not to compare md5sums
+
+        Yields
+        ------
+        tuple of (kind, (path, filename), db entry, disk entry) where kind is one of 'dbonly',
+        'diskonly', 'filesize', 'md5sum', or 'equal'
+    """
+    dbent = next(db_iter, None)
+    diskent = next(disk_iter, None)
+    while dbent is not None or diskent is not None:
+        if diskent is None or (dbent is not None and dbent[0] < diskent[0]):
+            yield ('dbonly', dbent[0], dbent, None)
+            dbent = next(db_iter, None)
+        elif dbent is None or diskent[0] < dbent[0]:
+            yield ('diskonly', diskent[0], None, diskent)
+            diskent = next(disk_iter, None)
+        else:
+            if dbent[1] != diskent[1]:
+                kind = 'filesize'
+            elif md5sum and dbent[2] != diskent[2]:
+                kind = 'md5sum'
+            else:
+                kind = 'equal'
+            yield (kind, dbent[0], dbent, diskent)
+            dbent = next(db_iter, None)
+            diskent = next(disk_iter, None)
+
+
+class ArchiveAudit:
+    """ Archive-wide comparison of DB and disk in a single constant memory pass
+
+        Parameters
+        ----------
+        args : object
+            Contains the arguments (dbh, archive, relpath, md5sum, checkpoint, silent,
+            verbose)
+
+    """
+    def __init__(self, args):
+        self.dbh = args.dbh
+        self.archive = args.archive
+        self.relpath = fmutils.check_arg(args, 'relpath')
+        self.md5sum = args.md5sum
+        self.checkpoint = fmutils.check_arg(args, 'checkpoint')
+        self.silent = args.silent
+        self.counts = {'equal': 0,
+                       'dbonly': 0,
+                       'diskonly': 0,
+                       'filesize': 0,
+                       'md5sum': 0}
+        # resumed from a checkpoint without counts, so they only cover part of the archive
+        self.partial = False
+
+    def read_checkpoint(self):
+        """ Return the last completed path from the checkpoint file, if any, and restore the
+            counts up to it """
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint, 'r', encoding="utf-8") as fh:
+            text = fh.read().strip()
+        if not text:
+            return None
+        try:
+            info = json.loads(text)
+        except ValueError:
+            # a checkpoint with only the path (the counts before it aren't known)
+            self.partial = True
+            return text
+        self.counts.update(info['counts'])
+        return info['path']
+
+    def remove_checkpoint(self):
+        """ Remove the checkpoint file once the audit is complete """
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def write_checkpoint(self, path):
+        """ Atomically record the last path for which both inventories have been fully compared,
+            along with the counts up to it """
+        if self.checkpoint is None:
+            return
+        tmpname = f"{self.checkpoint}.tmp"
+        with open(tmpname, 'w', encoding="utf-8") as fh:
+            fh.write(json.dumps({'path': path, 'counts': self.counts}) + "\n")
+        os.replace(tmpname, self.checkpoint)
+
+    def run(self):
+        """ Run the audit, printing each discrepancy as it is found
+
+            Returns
+            -------
+            0 if DB and disk agree, 1 otherwise
+        """
+        archive_root = fmutils.get_archive_root(self.dbh, self.archive)
+        start_after = self.read_checkpoint()
+        if start_after is not None and not self.silent:
+            print(f"Resuming audit after path {start_after}")
+
+        db_iter = stream_files_from_db(self.dbh, self.archive, self.relpath, start_after)
+        disk_iter = disk_inventory_stream(archive_root, self.relpath, start_after, self.md5sum)
+
+        lastpath = None
+        npaths = 0
+        for (kind, (path, fname), dbent, diskent) in merge_inventories(db_iter, disk_iter, self.md5sum):
+            # everything sorting before the current path has now been seen on both sides (and
+            # counted, the checkpoint's counts don't include the current file)
+            if path != lastpath:
+                if lastpath is not None:
+                    npaths += 1
+                    if npaths % CHECKPOINT_EVERY == 0:
+                        self.write_checkpoint(lastpath)
+                lastpath = path
+            self.counts[kind] += 1
+            if kind == 'equal':
+                continue
+            if kind == 'dbonly':
+                print(f"dbonly    {path}/{fname}")
+            elif kind == 'diskonly':
+                print(f"diskonly  {path}/{fname}")
+            elif kind == 'filesize':
+                print(f"filesize  {path}/{fname} {dbent[1]} {diskent[1]}")
+            else:
+                print(f"md5sum    {path}/{fname} {dbent[2]} {diskent[2]}")
+            sys.stdout.flush()
+        # a finished audit starts from the beginning next time
+        self.remove_checkpoint()
+
+        if not self.silent:
+            print("Audit Summary")
+            print(f"\tEqual:\t{self.counts['equal']:d}")
+            print(f"\tDB only:\t{self.counts['dbonly']:d}")
+            print(f"\tDisk only:\t{self.counts['diskonly']:d}")
+            print(f"\tMismatched filesize:\t{self.counts['filesize']:d}")
+            if self.md5sum:
+                print(f"\tMismatched md5sum:\t{self.counts['md5sum']:d}")
+        if self.partial:
+            print("Partial audit: resumed from a checkpoint without counts, the counts only cover the paths after it")
+            return 1
+        if self.counts['dbonly'] or self.counts['diskonly'] or self.counts['filesize'] or self.counts['md5sum']:
+            return 1
+        return 0
+
 # pylint: disable=unused-argument
 
 def compare(dbh=None, des_services=None, section=None, archive='desar2home', reqnum=None, unitname=None,
             attnum=None, relpath=None, pfwid=None, date_range=None, pipeline=None,
             md5sum=False, debug=False, script=False, verbose=False, silent=True,
-            tag=None, start_at=1, end_at=0, log=None):
+            tag=None, start_at=1, end_at=0, log=None, parallel=1):
     """ Entry point
     """
     (args, pfwids) = fmutils.determine_ids(fmutils.DataObject(**locals()))
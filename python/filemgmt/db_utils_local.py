@@ -4,6 +4,73 @@
 import sys
 import os
 import time
+import weakref
+
+# prepared cursors, keyed by database handle and then by the sql text (see cached_cursor)
+STATEMENT_CACHE = weakref.WeakKeyDictionary()
+
+def cached_cursor(dbh, sql):
+    """ Method to get a cursor that has the given sql already prepared on the given handle.
+        Repeated calls with the same (bind variable) sql return the same cursor, so the
+        statement is only parsed once per connection.   The results of a previous execution
+        of the cursor are discarded when it is executed again.
+
+        Parameters
+        ----------
+        dbh : db handle
+            The handle the cursor belongs to
+
+        sql : str
+            The sql statement, values must be supplied as bind variables
+
+        Returns
+        -------
+        The prepared cursor, execute it with curs.execute(None, binds).   Don't run any other
+        sql on it (e.g., a commit, use dbh.commit()), that would replace the prepared statement
+        for every later user of the cursor.
+    """
+    stmts = STATEMENT_CACHE.setdefault(dbh, {})
+    if sql not in stmts:
+        curs = dbh.cursor()
+        curs.prepare(sql)
+        stmts[sql] = curs
+    return stmts[sql]
+
+def execute_cached(dbh, sql, binds=None):
+    """ Method to execute the given sql with a cached prepared cursor
+
+        Parameters
+        ----------
+        dbh : db handle
+            The handle to use for the query
+
+        sql : str
+            The sql statement, values must be supplied as bind variables
+
+        binds : dict
+            The values for the bind variables, default is None
+
+        Returns
+        -------
+        The executed cursor
+    """
+    curs = cached_cursor(dbh, sql)
+    curs.execute(None, binds or {})
+    return curs
+
+def clear_statement_cache(dbh):
+    """ Method to drop the cached cursors of a handle, call before closing the handle
+
+        Parameters
+        ----------
+        dbh : db handle
+            The handle whose cursors are to be dropped
+    """
+    for curs in STATEMENT_CACHE.pop(dbh, {}).values():
+        try:
+            curs.close()
+        except Exception:
+            pass
 
 def get_pfw_attempt_ids_from_triplet(dbh, args):
     """ Method to get a list of pfw_attempt_ids based on part or all of the reqnum, unitname, attnum
@@ -19,15 +86,18 @@ def get_pfw_attempt_ids_from_triplet(dbh, args):
 
     """
     # set up the query
-    sql = f"select id from pfw_attempt where reqnum={args.reqnum}"
+    sql = f"select id from pfw_attempt where reqnum={dbh.get_named_bind_string('reqnum')}"
+    binds = {'reqnum': args.reqnum}
     # if there is a unitname then add it
     if args.unitname:
-        sql += f" and unitname='{args.unitname}'"
+        sql += f" and unitname={dbh.get_named_bind_string('unitname')}"
+        binds['unitname'] = args.unitname
     # if there is an attnum then add it
     if args.attnum:
-        sql += f" and attnum={args.attnum}"
+        sql += f" and attnum={dbh.get_named_bind_string('attnum')}"
+        binds['attnum'] = args.attnum
     curs = dbh.cursor()
-    curs.execute(sql)
+    curs.execute(sql, binds)
     results = curs.fetchall()
     if not results:
         msg = f"No pfw_attempt_id found for reqnum {args.reqnum}"
@@ -59,8 +129,9 @@ def del_files_from_db(dbh, relpath, archive):
             The name of the archive to delete from
 
     """
-    cur = dbh.cursor()
-    cur.execute(f"delete from file_archive_info where archive_name='{archive}' and path like '{relpath}%'")
+    sql = f"delete from file_archive_info where archive_name={dbh.get_named_bind_string('archive')} and path like {dbh.get_named_bind_string('relpath')}"
+    execute_cached(dbh, sql, {'archive': archive,
+                              'relpath': relpath + '%'})
     dbh.commit()
 
 def del_part_files_from_db_by_name(dbh, relpath, archive, delfiles):
@@ -81,12 +152,14 @@ def del_part_files_from_db_by_name(dbh, relpath, archive, delfiles):
             List of file names to delete
 
     """
-    cur = dbh.cursor()
-    cur.prepare(f"delete from file_archive_info where archive_name='{archive}' and path like '{relpath}%' and filename=:1")
-    cur.executemany(None, delfiles)
+    sql = f"delete from file_archive_info where archive_name={dbh.get_named_bind_string('archive')} and path like {dbh.get_named_bind_string('relpath')} and filename={dbh.get_named_bind_string('filename')}"
+    cur = cached_cursor(dbh, sql)
+    cur.executemany(None, [{'archive': archive,
+                            'relpath': relpath + '%',
+                            'filename': fname} for fname in delfiles])
     if cur.rowcount != len(delfiles):
         print(f"Inconsistency detected: {cur.rowcount:d} rows removed from db and {len(delfiles):d} files deleted, these should match.")
-    cur.execute('commit')
+    dbh.commit()
 
 def del_part_files_from_db(dbh, delfileid):
     """ Method to delete specific files from file_archive_info based on id
@@ -102,8 +175,7 @@ def del_part_files_from_db(dbh, delfileid):
     """
     # load the desfile_ids into a gtt table
     tid = dbh.load_id_gtt(delfileid)
-    cur = dbh.cursor()
-    cur.execute(f"delete from file_archive_info fai where fai.desfile_id in (select id from {tid})")
+    cur = execute_cached(dbh, f"delete from file_archive_info fai where fai.desfile_id in (select id from {tid})")
     if len(delfileid) != cur.rowcount:
         print(f"Inconsistency detected: {cur.rowcount:d} rows removed from db and {len(delfileid):d} files deleted, these should match.")
     dbh.commit()
@@ -124,7 +196,7 @@ def get_pfw_attempt_id_from_tag(dbh, tag):
         list: containing the associated pfw_attempt_ids
     """
     curs = dbh.cursor()
-    curs.execute(f'select pfw_attempt_id from proctag where tag=\'{tag}\'')
+    curs.execute(f"select pfw_attempt_id from proctag where tag={dbh.get_named_bind_string('tag')}", {'tag': tag})
     pfw_ids = []
     results = curs.fetchall()
     # if no pfw_attempt_ids are found, exit
@@ -151,9 +223,10 @@ def update_attempt_state(dbh, state, pfwid):
             The pfw_attempt_id identifying the row in the table to change
 
     """
-    cur = dbh.cursor()
-    cur.execute(f"update attempt_state set home_archive_state='{state}', db_state='PRUNED' where pfw_attempt_id={pfwid:d}")
-    cur.execute('commit')
+    sql = f"update attempt_state set home_archive_state={dbh.get_named_bind_string('state')}, db_state='PRUNED' where pfw_attempt_id={dbh.get_named_bind_string('pfwid')}"
+    execute_cached(dbh, sql, {'state': state,
+                              'pfwid': int(pfwid)})
+    dbh.commit()
 
 def get_file_count_by_pfwid(dbh, pfwid):
     """ Method to get the number of files in file_archive_info associated with a given pfw_attempt_id
@@ -171,11 +244,11 @@ def get_file_count_by_pfwid(dbh, pfwid):
         Int containing the number of files
 
     """
-    curs = dbh.cursor()
-    curs.execute(f'select count(fai.filename) from file_archive_info fai, desfile df where df.pfw_attempt_id={pfwid} and fai.desfile_id=df.id')
+    sql = f"select count(fai.filename) from file_archive_info fai, desfile df where df.pfw_attempt_id={dbh.get_named_bind_string('pfwid')} and fai.desfile_id=df.id"
+    curs = execute_cached(dbh, sql, {'pfwid': pfwid})
     return curs.fetchone()[0]
 
-def get_pfw_attempt_ids_where(dbh, whereclause, order=None):
+def get_pfw_attempt_ids_where(dbh, whereclause, order=None, binds=None):
     """ Method to query the database for pfw_attempt_ids with the given where and order by
         qualifiers.
 
@@ -185,11 +258,14 @@ def get_pfw_attempt_ids_where(dbh, whereclause, order=None):
             The handle to use for the query
 
         whereclause : list
-            A list of the where clauses to use with the query (e.g. ["DATA_STATE='JUNK'"])
+            A list of the where clauses to use with the query (e.g. ["DATA_STATE=:state"])
 
         order : str
             The column to order the results by, default is no ordering.
 
+        binds : dict
+            The values of any bind variables used in whereclause, default is None
+
         Returns
         -------
         List of the pfw_attempt_ids meeting the given qualifiers.
@@ -203,7 +279,7 @@ def get_pfw_attempt_ids_where(dbh, whereclause, order=None):
         sql += ' ' + val
     if order:
         sql += f' order by {order}'
-    curs.execute(sql)
+    curs.execute(sql, binds or {})
     results = curs.fetchall()
     res = []
     for result in results:
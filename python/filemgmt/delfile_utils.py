@@ -47,6 +47,7 @@ class DelFiles(fmutils.FileManager):
         self.pfwids.sort() # put them in order
         all_data = {}
         self.merged_comparison_info = {}
+        self.prefetch_attempt_info()
         # go through each pfw_attempt_id and gather the needed data
         for pid in self.pfwids:
             self.pfwid = pid
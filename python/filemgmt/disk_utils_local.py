@@ -14,11 +14,31 @@ import sys
 import shutil
 import hashlib
 import errno
+import fcntl
 import time
 import copy
 
 import despymisc.miscutils as miscutils
 
+# ways to put a file at its destination (see place_file)
+PLACE_REFLINK = 'reflink'     # copy on write clone, shares the data blocks until either is modified
+PLACE_HARDLINK = 'hardlink'   # hardlink, only for inputs the job can't write (see hardlink_file)
+PLACE_COPY = 'copy'
+
+# order to try them in for files staged into a job and for archive to archive transfers
+INPUT_PLACEMENT = (PLACE_REFLINK, PLACE_HARDLINK, PLACE_COPY)
+ARCHIVE_PLACEMENT = (PLACE_REFLINK, PLACE_COPY)
+
+# Linux ioctl to make a file share another's data blocks
+FICLONE = 0x40049409
+
+# errors meaning a method can't work between two filesystems (rather than for one file).
+# Not EPERM: hardlinks can get it for some files only (e.g., with protected_hardlinks)
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL)
+
+# methods found not to work, by (src device, dst device)
+_unsupported = {}
+
 
 ######################################################################
 def get_md5sum_file(fullname, blksize=2**15):
@@ -109,8 +129,11 @@ def get_file_disk_info_path(path, save_md5sum=False):
     return fileinfo
 
 ######################################################################
-def copyfiles(filelist, tstats, verify=False):
-    """ Copies files in given src,dst in filelist """
+def copyfiles(filelist, tstats, verify=False, methods=(PLACE_COPY,)):
+    """ Copies files in given src,dst in filelist
+
+        methods are the ways to place each file to try in order (see place_file)
+    """
 
     status = 0
     for filename, fdict in filelist.items():
@@ -130,7 +153,7 @@ def copyfiles(filelist, tstats, verify=False):
                 path = os.path.dirname(dst)
                 if path and not os.path.exists(path):
                     miscutils.coremakedirs(path)
-                shutil.copy(src, dst)
+                place_file(src, dst, methods)
                 if tstats is not None:
                     tstats.stat_end_file(0, fsize)
                 if verify:
@@ -145,6 +168,141 @@ def copyfiles(filelist, tstats, verify=False):
             filelist[filename]['err'] = str(value)
     return (status, filelist)
 
+######################################################################
+def reflink_file(src, dst):
+    """ Make dst a copy on write clone of src (fails unless the filesystem supports it) """
+    try:
+        with open(src, 'rb') as sfh, open(dst, 'wb') as dfh:
+            fcntl.ioctl(dfh.fileno(), FICLONE, sfh.fileno())
+        shutil.copymode(src, dst)
+    except OSError:
+        remove_file_if_exists(dst)
+        raise
+
+######################################################################
+def hardlink_file(src, dst):
+    """ Make dst a hardlink to src, only if the job can't change src through it
+
+        src must be owned by another user and not writable by the job.   Making the link
+        read-only isn't enough: the mode is src's too (e.g., an archive file or a node
+        cache entry) and the owner of src can make it writable again.
+    """
+    if os.stat(src).st_uid == os.geteuid() or os.access(src, os.W_OK):
+        raise OSError(errno.EACCES, f"Not hardlinking {src}, it can be written by this job")
+    os.link(src, dst)
+
+######################################################################
+def place_file(src, dst, methods=INPUT_PLACEMENT):
+    """ Put a copy of src at dst using the first of methods that works
+
+        Which methods work is probed once per (src, dst) filesystem pair.
+
+        Returns
+        -------
+        str, the method used
+    """
+    dstdir = os.path.dirname(dst) or '.'
+    pair = (os.stat(src).st_dev, os.stat(dstdir).st_dev)
+    unsupported = _unsupported.setdefault(pair, set())
+    for method in methods:
+        if method in unsupported:
+            continue
+        if method == PLACE_COPY:
+            shutil.copy(src, dst)
+            return method
+        try:
+            if method == PLACE_REFLINK:
+                reflink_file(src, dst)
+            else:
+                hardlink_file(src, dst)
+            return method
+        except OSError as err:
+            if err.errno in UNSUPPORTED_ERRNOS:
+                if miscutils.fwdebug_check(3, "DISK_UTILS_LOCAL_DEBUG"):
+                    miscutils.fwdebug_print(f"{method} not supported from {src} to {dstdir}: {err}")
+                unsupported.add(method)
+            elif err.errno == errno.ENOENT:
+                raise
+    raise OSError(errno.EOPNOTSUPP, f"None of {methods} worked for {src} to {dst}")
+
+######################################################################
+def copyfile_md5(src, dst, blksize=2**20):
+    """ Copy src to dst computing the md5sum of the data on the way
+
+        Returns
+        -------
+        str, the md5sum of the copy
+    """
+    md5 = hashlib.md5()
+    with open(src, 'rb') as infh, open(dst, 'wb') as outfh:
+        for chunk in iter(lambda: infh.read(blksize), b''):
+            md5.update(chunk)
+            outfh.write(chunk)
+    shutil.copymode(src, dst)
+    return md5.hexdigest()
+
+######################################################################
+def copyfile_fanout(src, dsts, methods=ARCHIVE_PLACEMENT, pool=None, blksize=2**20):
+    """ Copy src to each of dsts reading it only once
+
+        Destinations where a reflink works (if in methods) get one, the others are written
+        from the same reads, at the same time if given a thread pool.
+
+        Returns
+        -------
+        dict of dst to error message for the dsts that failed
+    """
+    errors = {}
+    streamed = []
+    for dst in dsts:
+        path = os.path.dirname(dst)
+        if path and not os.path.exists(path):
+            miscutils.coremakedirs(path)
+        if PLACE_REFLINK in methods:
+            try:
+                if place_file(src, dst, (PLACE_REFLINK,)) == PLACE_REFLINK:
+                    continue
+            except OSError:
+                pass
+        streamed.append(dst)
+    if not streamed:
+        return errors
+
+    def write(fhandle, data):
+        try:
+            fhandle.write(data)
+            return None
+        except OSError as err:
+            return err
+
+    outs = {}
+    try:
+        for dst in streamed:
+            try:
+                outs[dst] = open(dst, 'wb')
+            except OSError as err:
+                errors[dst] = str(err)
+        with open(src, 'rb') as infh:
+            for chunk in iter(lambda: infh.read(blksize), b''):
+                dstlist = list(outs)
+                if pool is not None and len(dstlist) > 1:
+                    errs = list(pool.map(write, [outs[x] for x in dstlist], [chunk] * len(dstlist)))
+                else:
+                    errs = [write(outs[x], chunk) for x in dstlist]
+                for dst, err in zip(dstlist, errs):
+                    if err is not None:
+                        errors[dst] = str(err)
+                        outs.pop(dst).close()
+    finally:
+        for fhandle in outs.values():
+            fhandle.close()
+    for dst in streamed:
+        if dst in errors:
+            remove_file_if_exists(dst)
+        else:
+            shutil.copymode(src, dst)
+    return errors
+
 ######################################################################
 def remove_file_if_exists(filename):
     """ Method to remove a single file if it exisits
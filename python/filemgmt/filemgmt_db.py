@@ -294,6 +294,23 @@ class FileMgmtDB(desdmdbi.DesDmDbi):
         return existslist
 
 
+    ###########################################################################
+    def update_file_size_md5(self, filelist):
+        """ Updates the filesize and md5sum of files already in desfile whose contents
+            changed (e.g., replaced in an archive by a sync).   Doesn't commit.
+
+            filelist is a list of dicts with filename, compression, filesize and md5sum
+        """
+        sql = (f"update desfile set filesize={self.get_named_bind_string('filesize')}, " +
+               f"md5sum={self.get_named_bind_string('md5sum')} where " +
+               f"filename={self.get_named_bind_string('filename')} and " +
+               f"nullcmp(compression, {self.get_named_bind_string('compression')}) = 1")
+        curs = self.cursor()
+        curs.executemany(sql, [{k: finfo[k] for k in ('filename', 'compression', 'filesize', 'md5sum')}
+                               for finfo in filelist])
+        curs.close()
+
+
     ###########################################################################
     @staticmethod
     def _get_required_headers(filetype_dict):
@@ -39,6 +39,11 @@ class FileMgmtNoDB:
         return {}
 
 
+    def update_file_size_md5(self, filelist):
+        # with no db, nothing to update
+        miscutils.fwdebug_print("Nothing to do")
+
+
     def file_has_metadata(self, filenames):
         return filenames
 
@@ -5,12 +5,16 @@
 
 """ Miscellaneous FileMgmt utils """
 
+import io
 import json
 import os
 import sys
+import threading
 import time
 import copy
 
+import numpy as np
+
 from despydmdb import desdmdbi
 from despymisc import miscutils
 from despymisc import misctime
@@ -19,6 +23,12 @@ import filemgmt.disk_utils_local as dkutils
 
 COMPLETE = "Complete"
 
+# archive roots are constant, so cache them for the life of the process (keyed by archive name)
+ARCHIVE_ROOTS = {}
+
+# number of pfw_attempt_ids whose file inventories are fetched by a single query
+INVENTORY_CHUNK = 200
+
 ##################################################################################################
 def get_config_vals(archive_info, config, keylist):
     """ Search given dicts for specific values """
@@ -266,6 +276,61 @@ class Print:
         """
         self.old_stdout.flush()
 
+class ThreadOutput:
+    """ Class to give each worker thread its own stdout buffer
+
+        Text written from a thread which has called start() goes to that thread's
+        buffer, everything else goes to the original stdout.  This allows output
+        from concurrent tasks to be printed in a deterministic order.
+
+    """
+    def __init__(self):
+        self.old_stdout = sys.stdout
+        self.local = threading.local()
+
+    def start(self):
+        """ Method to start capturing the output of the calling thread
+        """
+        self.local.buffer = io.StringIO()
+
+    def stop(self):
+        """ Method to stop capturing the output of the calling thread
+
+            Returns
+            -------
+            str containing the captured text
+        """
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return text
+
+    def write(self, text):
+        """ Method to write the text to the buffer of the calling thread, if any
+
+            Parameters
+            ----------
+            text : str
+                The text to write
+
+        """
+        buf = getattr(self.local, 'buffer', None)
+        if buf is not None:
+            buf.write(text)
+        else:
+            self.old_stdout.write(text)
+
+    def close(self):
+        """ Method to return stdout to its original handle
+
+        """
+        return self.old_stdout
+
+    def flush(self):
+        """ Method to force the buffer to flush
+
+        """
+        self.old_stdout.flush()
+
 def removeEmptyFolders(path, removeRoot=True):
     """ Function to remove empty folders
     """
@@ -354,22 +419,26 @@ def determine_ids(args):
     # if dealing with a date range then get the relevant pfw_attempt_ids
     if 'date_range' in args and args.date_range:
         dates = args.date_range.split(',')
-        whereclause = []
-        if len(dates) == 1:
-            whereclause.append(f"submittime>=TO_DATE('{dates[0]} 00:00:01', 'YYYY-MM-DD HH24:MI:SS') and submittime<=TO_DATE('{dates[0]} 23:59:59', 'YYYY-MM-DD HH24:MI:SS')")
-        else:
-            whereclause.append(f"submittime>=TO_DATE('{dates[0]} 00:00:01', 'YYYY-MM-DD HH24:MI:SS') and submittime<=TO_DATE('{dates[1]} 23:59:59', 'YYYY-MM-DD HH24:MI:SS')")
+        bind = args.dbh.get_named_bind_string
+        whereclause = [f"submittime>=TO_DATE({bind('startdate')}, 'YYYY-MM-DD HH24:MI:SS') and submittime<=TO_DATE({bind('enddate')}, 'YYYY-MM-DD HH24:MI:SS')"]
+        binds = {'startdate': f"{dates[0]} 00:00:01",
+                 'enddate': f"{dates[-1]} 23:59:59"}
         if args.pipeline:
-            whereclause.append(f"subpipeprod='{args.pipeline}'")
+            whereclause.append(f"subpipeprod={bind('pipeline')}")
+            binds['pipeline'] = args.pipeline
         if 'reqnum' in args and args.reqnum:
-            whereclause.append(f"reqnum={args.reqnum}")
+            whereclause.append(f"reqnum={bind('reqnum')}")
+            binds['reqnum'] = args.reqnum
             if args.unitname:
-                whereclause.append(f"unitname='{args.unitname}'")
+                whereclause.append(f"unitname={bind('unitname')}")
+                binds['unitname'] = args.unitname
             if args.attnum:
-                whereclause.append(f"attnum={args.attnum}")
+                whereclause.append(f"attnum={bind('attnum')}")
+                binds['attnum'] = args.attnum
         elif args.tag:
-            whereclause.append(f"id in (select pfw_attempt_id from proctag where tag='{args.tag}')")
-        pfwids = dbutils.get_pfw_attempt_ids_where(args.dbh, whereclause, 'id')
+            whereclause.append(f"id in (select pfw_attempt_id from proctag where tag={bind('tag')})")
+            binds['tag'] = args.tag
+        pfwids = dbutils.get_pfw_attempt_ids_where(args.dbh, whereclause, 'id', binds)
 
         if not args.silent:
             print(f"Found {len(pfwids):d} pfw_attempt_id's for the given date range (and any qualifying tag/reqnum)")
@@ -401,9 +470,10 @@ def get_unique_paths(args):
         return args, []
     if args.dbh is None:
         args.dbh = desdmdbi.DesDmDbi(args.des_services, args.section)
-    sql = f"select distinct(path) from file_archive_info where archive_name='{args.archive}' and path like 'RAW/{args.raw}%'"
+    sql = f"select distinct(path) from file_archive_info where archive_name={args.dbh.get_named_bind_string('archive')} and path like {args.dbh.get_named_bind_string('rawpath')}"
     curs = args.dbh.cursor()
-    curs.execute(sql)
+    curs.execute(sql, {'archive': args.archive,
+                       'rawpath': f"RAW/{args.raw}%"})
     results = curs.fetchall()
     dirs = []
     for r in results:
@@ -411,6 +481,141 @@ def get_unique_paths(args):
     return args, dirs
 
 
+def get_archive_root(dbh, archive):
+    """ Get the root of the given archive, querying ops_archive only the first time
+
+        Parameters
+        ----------
+        dbh : database handle
+            The handle to use for the query
+
+        archive : str
+            The name of the archive
+
+        Returns
+        -------
+        str containing the archive root
+    """
+    if archive not in ARCHIVE_ROOTS:
+        sql = f"select root from ops_archive where name={dbh.get_named_bind_string('name')}"
+        rows = dbutils.execute_cached(dbh, sql, {'name': archive}).fetchall()
+        cnt = len(rows)
+        if cnt != 1:
+            print(f"Invalid archive name ({archive}).   Found {cnt} rows in ops_archive")
+            print("\tAborting")
+            sys.exit(1)
+        ARCHIVE_ROOTS[archive] = rows[0][0]
+    return ARCHIVE_ROOTS[archive]
+
+
+def inventory_to_array(files, pathkey):
+    """ Convert a file inventory into a columnar structured array sorted by name
+
+        Parameters
+        ----------
+        files : dict
+            Dictionary of file info keyed by file name (including any compression
+            extension), as built by get_files_from_db or get_files_from_disk
+
+        pathkey : str
+            The key holding the relative archive path ('path' for DB entries,
+            'relpath' for disk entries)
+
+        Returns
+        -------
+        numpy structured array with name, path, filesize, and md5sum columns.
+        Missing sizes are stored as -1 and missing md5sums as empty strings.
+    """
+    finfos = list(files.values())
+    arr = np.rec.fromarrays([np.array(list(files), dtype=str),
+                             np.array([finfo.get(pathkey) or '' for finfo in finfos], dtype=str),
+                             np.array([-1 if finfo.get('filesize') is None else finfo['filesize'] for finfo in finfos], dtype=np.int64),
+                             np.array([finfo.get('md5sum') or '' for finfo in finfos], dtype=str)],
+                            names='name,path,filesize,md5sum')
+    arr.sort(order='name')
+    return arr
+
+
+class AttemptInventory:
+    """ Class to fetch the desfile/file_archive_info inventory of many pfw_attempt_ids with one query
+
+        The pfw_attempt_ids are loaded into a GTT in chunks of INVENTORY_CHUNK (in the order
+        they will be processed) and the rows are partitioned by pfw_attempt_id. Each partition
+        is handed out once, so only the current chunk is held in memory. The instance can be
+        shared between threads, each caller supplies its own database handle.
+
+        Parameters
+        ----------
+        archive : str
+            The archive name
+
+        pfwids : list
+            The pfw_attempt_ids, in the order they will be requested
+
+        filetype : str
+            Restrict the inventory to this filetype, default is None (all files)
+    """
+    def __init__(self, archive, pfwids, filetype=None):
+        self.archive = archive
+        self.filetype = filetype
+        self.order = [int(pid) for pid in pfwids or []]
+        self.position = {pid: i for i, pid in enumerate(self.order)}
+        self.partitions = {}
+        self.fetched = set()
+        self.desc = None
+        self.lock = threading.Lock()
+
+    def get(self, dbh, pfwid):
+        """ Get the inventory rows of a pfw_attempt_id, fetching the next chunk if needed
+
+            Parameters
+            ----------
+            dbh : database handle
+                The handle to use if a query is needed
+
+            pfwid : int
+                The pfw_attempt_id
+
+            Returns
+            -------
+            tuple of the column names and the list of rows for the pfw_attempt_id
+        """
+        pid = int(pfwid)
+        with self.lock:
+            if pid not in self.partitions:
+                self.fetch(dbh, self.next_chunk(pid))
+            return self.desc, self.partitions.pop(pid)
+
+    def next_chunk(self, pid):
+        """ Get the list of pfw_attempt_ids to fetch along with the given one
+        """
+        if pid not in self.position:
+            return [pid]
+        start = self.position[pid]
+        return [pid] + [p for p in self.order[start + 1:start + INVENTORY_CHUNK] if p not in self.fetched]
+
+    def fetch(self, dbh, pfwids):
+        """ Query the inventory for the given pfw_attempt_ids and partition the results
+        """
+        gtt = dbh.load_id_gtt(pfwids)
+        binds = {'archive': self.archive}
+        sql = "select art.pfw_attempt_id, fai.path, art.filename, art.compression, art.id, art.md5sum, art.filesize " \
+              f"from desfile art, file_archive_info fai, {gtt} g where art.pfw_attempt_id=g.id and fai.desfile_id=art.id " \
+              f"and fai.archive_name={dbh.get_named_bind_string('archive')}"
+        if self.filetype is not None:
+            sql += f" and art.filetype={dbh.get_named_bind_string('filetype')}"
+            binds['filetype'] = self.filetype
+        curs = dbutils.cached_cursor(dbh, sql)
+        curs.arraysize = 5000
+        curs.execute(None, binds)
+        self.desc = [d[0].lower() for d in curs.description][1:]
+        for pid in pfwids:
+            self.partitions[pid] = []
+            self.fetched.add(pid)
+        for row in curs:
+            self.partitions[int(row[0])].append(row[1:])
+
+
 def check_arg(args, argname):
     if argname in args:
         return args.__dict__[argname]
@@ -466,8 +671,11 @@ class FileManager:
         self.files_from_disk = None
         self.duplicates = None
         self.comparison_info = {}
+        self.attempt_info = {}
+        self.file_inventory = None
 
     def reset(self):
+        dbutils.clear_statement_cache(self.dbh)
         self.dbh.close()
         self.dbh = desdmdbi.DesDmDbi(self.des_services, self.section)
         self.relpath = None
@@ -624,6 +832,7 @@ class FileManager:
         """
         retval = 0
         if self.pfwids:
+            self.prefetch_attempt_info()
             self.length = len(self.pfwids)
             for i, pdwi in enumerate(self.pfwids):
                 self.number = i
@@ -648,30 +857,46 @@ class FileManager:
 
         return retval
 
+    def prefetch_attempt_info(self, pfwids=None):
+        """ Load the attempt information for the given pfw_attempt_ids with a single query
+
+            The pfw_attempt_ids are loaded into a GTT and joined to pfw_attempt and
+            attempt_state, the results are kept in self.attempt_info (keyed by
+            pfw_attempt_id) and used by get_paths_by_id instead of per attempt queries.
+
+            Parameters
+            ----------
+            pfwids : list
+                The pfw_attempt_ids to load, default is self.pfwids
+        """
+        if pfwids is None:
+            pfwids = self.pfwids
+        newids = [int(pid) for pid in pfwids if int(pid) not in self.attempt_info]
+        if not newids:
+            return
+        gtt = self.dbh.load_id_gtt(newids)
+        sql = f"select pfw.id, pfw.archive_path, ats.data_state, pfw.operator, pfw.reqnum, pfw.unitname, pfw.attnum from pfw_attempt pfw, attempt_state ats, {gtt} g where pfw.id=g.id and ats.pfw_attempt_id=pfw.id"
+        curs = dbutils.execute_cached(self.dbh, sql)
+        for row in curs:
+            self.attempt_info[int(row[0])] = {'archive_path': row[1],
+                                              'data_state': row[2],
+                                              'operator': row[3],
+                                              'reqnum': row[4],
+                                              'unitname': row[5],
+                                              'attnum': row[6]}
+
     def get_paths_by_path(self):
         """ Method to get data about files based on path
         """
         # check archive is valid archive name (and get archive root)
-        sql = f"select root from ops_archive where name={self.dbh.get_named_bind_string('name')}"
-
-        curs = self.dbh.cursor()
-        curs.execute(sql, {'name': self.archive})
-        rows = curs.fetchall()
-        cnt = len(rows)
-        if cnt != 1:
-            print(f"Invalid archive name ({self.archive}).   Found {cnt} rows in ops_archive")
-            print("\tAborting")
-            sys.exit(1)
-
-        self.archive_root = rows[0][0]
+        self.archive_root = get_archive_root(self.dbh, self.archive)
         if self.rdir:
             self.archive_path = os.path.join(self.archive_root, self.rdir)
             self.relpath = self.rdir
         else:
             # see if relpath is the root directory for an attempt
-            sql = f"select operator, id from pfw_attempt where archive_path={self.dbh.get_named_bind_string('apath')}"
-            curs.execute(sql, {'apath': self.relpath})
-            rows = curs.fetchall()
+            sql = f"select pfw.operator, pfw.id, ats.data_state, pfw.reqnum, pfw.unitname, pfw.attnum from pfw_attempt pfw, attempt_state ats where pfw.archive_path={self.dbh.get_named_bind_string('apath')} and ats.pfw_attempt_id=pfw.id"
+            rows = dbutils.execute_cached(self.dbh, sql, {'apath': self.relpath}).fetchall()
             if not rows:
                 print(f"\nCould not find an attempt with an archive_path={self.relpath}")
                 print("Assuming that this is part of an attempt, continuing...\n")
@@ -683,13 +908,7 @@ class FileManager:
                 print('\nAborting')
                 sys.exit(1)
             else:
-                self.operator = rows[0][0]
-                self.pfwid = rows[0][1]
-
-                sql = f"select data_state from attempt_state where pfw_attempt_id={self.dbh.get_named_bind_string('pfwid')}"
-                curs.execute(sql, {'pfwid': self.pfwid})
-                rows = curs.fetchall()
-                self.state = rows[0][0]
+                (self.operator, self.pfwid, self.state, self.reqnum, self.unitname, self.attnum) = rows[0]
 
             self.archive_path = os.path.join(self.archive_root, self.relpath)
 
@@ -711,47 +930,27 @@ class FileManager:
         """
 
         # check archive is valid archive name (and get archive root)
-        sql = f"select root from ops_archive where name={self.dbh.get_named_bind_string('name')}"
-
-        curs = self.dbh.cursor()
-        curs.execute(sql, {'name': self.archive})
-        rows = curs.fetchall()
-        cnt = len(rows)
-        if cnt != 1:
-            print(f"Invalid archive name ({self.archive}).   Found {cnt} rows in ops_archive")
-            print("\tAborting")
-            sys.exit(1)
-
-        self.archive_root = rows[0][0]
+        self.archive_root = get_archive_root(self.dbh, self.archive)
 
         if self.pfwid:
-            sql = f"select pfw.archive_path, ats.data_state, pfw.operator, pfw.reqnum, pfw.unitname, pfw.attnum from pfw_attempt pfw, attempt_state ats where pfw.id={self.dbh.get_named_bind_string('pfwid')} and ats.pfw_attempt_id=pfw.id"
-            curs.execute(sql, {'pfwid' : self.pfwid})
-            rows = curs.fetchall()
+            self.prefetch_attempt_info([self.pfwid])
+            info = self.attempt_info[int(self.pfwid)]
 
-            self.relpath = rows[0][0]
-            self.state = rows[0][1]
-            self.operator = rows[0][2]
-            self.reqnum = rows[0][3]
-            self.unitname = rows[0][4]
-            self.attnum = rows[0][5]
+            self.relpath = info['archive_path']
+            self.state = info['data_state']
+            self.operator = info['operator']
+            self.reqnum = info['reqnum']
+            self.unitname = info['unitname']
+            self.attnum = info['attnum']
 
         else:
         ### sanity check relpath
-            sql = f"select archive_path, operator, id from pfw_attempt where reqnum={self.dbh.get_named_bind_string('reqnum')} and unitname={self.dbh.get_named_bind_string('unitname')} and attnum={self.dbh.get_named_bind_string('attnum')}"
-            curs.execute(sql, {'reqnum' : self.reqnum,
-                               'unitname' : self.unitname,
-                               'attnum' : self.attnum})
-            rows = curs.fetchall()
-
-            self.relpath = rows[0][0]
-            self.operator = rows[0][1]
-            self.pfwid = rows[0][2]
-            sql = f"select data_state from attempt_state where pfw_attempt_id={self.dbh.get_named_bind_string('pfwid')}"
-            curs.execute(sql, {'pfwid' : self.pfwid})
-            rows = curs.fetchall()
+            sql = f"select pfw.archive_path, pfw.operator, pfw.id, ats.data_state from pfw_attempt pfw, attempt_state ats where pfw.reqnum={self.dbh.get_named_bind_string('reqnum')} and pfw.unitname={self.dbh.get_named_bind_string('unitname')} and pfw.attnum={self.dbh.get_named_bind_string('attnum')} and ats.pfw_attempt_id=pfw.id"
+            rows = dbutils.execute_cached(self.dbh, sql, {'reqnum' : self.reqnum,
+                                                          'unitname' : self.unitname,
+                                                          'attnum' : self.attnum}).fetchall()
 
-            self.state = rows[0][0]
+            (self.relpath, self.operator, self.pfwid, self.state) = rows[0]
 
         if self.relpath is None:
             raise Exception(f" Path is NULL in database for pfw_attempt_id {self.pfwid}.")
@@ -782,34 +981,30 @@ class FileManager:
         if self.debug:
             start_time = time.time()
             print("Getting file information from db: BEG")
-        sql = "select fai.path, art.filename, art.compression, art.id, art.md5sum, art.filesize from desfile art, file_archive_info fai where"
-        if filetype is not None:
-            sql += build_where_clause([f'art.pfw_attempt_id={str(self.pfwid)}',
-                                       'fai.desfile_id=art.id',
-                                       'art.filetype=\'' + filetype + '\'',
-                                       'fai.archive_name=\'' + self.archive + '\''])
-        elif self.pfwid is not None:
-            sql += build_where_clause([f'art.pfw_attempt_id={str(self.pfwid)}',
-                                       'fai.desfile_id=art.id',
-                                       'fai.archive_name=\'' + self.archive + '\''])
-        elif self.relpath is not None:
+        if self.pfwid is not None:
+            # served from the bulk inventory, which fetches the following attempts in the same query
+            if self.file_inventory is None or self.file_inventory.filetype != filetype:
+                self.file_inventory = AttemptInventory(self.archive, self.pfwids, filetype)
+            (desc, rows) = self.file_inventory.get(self.dbh, self.pfwid)
+        else:
+            sql = "select fai.path, art.filename, art.compression, art.id, art.md5sum, art.filesize from desfile art, file_archive_info fai where"
             sql += build_where_clause(['fai.desfile_id=art.id',
-                                       'fai.archive_name=\'' + self.archive + '\'',
-                                       'fai.path like \'' + self.relpath + '%\''])
-
-        if self.debug:
-            print(f"\nsql = {sql}\n")
-
-        curs = self.dbh.cursor()
-        curs.execute(sql)
-        if self.debug:
-            print("executed")
-        desc = [d[0].lower() for d in curs.description]
+                                       f"fai.archive_name={self.dbh.get_named_bind_string('archive')}",
+                                       f"fai.path like {self.dbh.get_named_bind_string('relpath')}"])
+            if self.debug:
+                print(f"\nsql = {sql}\n")
+
+            curs = dbutils.execute_cached(self.dbh, sql, {'archive': self.archive,
+                                                          'relpath': self.relpath + '%'})
+            if self.debug:
+                print("executed")
+            desc = [d[0].lower() for d in curs.description]
+            rows = curs
 
         filelist = []
 
         self.files_from_db = {}
-        for row in curs:
+        for row in rows:
             fdict = dict(zip(desc, row))
             fname = fdict['filename']
             if fdict['compression'] is not None:
@@ -832,10 +1027,9 @@ class FileManager:
         """ Method to check for duplicates in DB
         """
         table = self.dbh.load_filename_gtt(filelist)
-        sql = f"select fai.path, art.filename, art.compression,art.id, art.md5sum, art.filesize from desfile art, file_archive_info fai, {table} gtt where fai.desfile_id=art.id and fai.archive_name='{self.archive}' and gtt.filename=art.filename and coalesce(fai.compression,'x') = coalesce(gtt.compression,'x')"
+        sql = f"select fai.path, art.filename, art.compression,art.id, art.md5sum, art.filesize from desfile art, file_archive_info fai, {table} gtt where fai.desfile_id=art.id and fai.archive_name={self.dbh.get_named_bind_string('archive')} and gtt.filename=art.filename and coalesce(fai.compression,'x') = coalesce(gtt.compression,'x')"
 
-        curs = self.dbh.cursor()
-        curs.execute(sql)
+        curs = dbutils.execute_cached(self.dbh, sql, {'archive': self.archive})
         results = curs.fetchall()
         self.db_duplicates = {}
 
@@ -906,6 +1100,10 @@ class FileManager:
     def compare_db_disk(self):
         """ Compare file info from DB to info from disk
 
+            Both inventories are converted to sorted columnar arrays (see
+            inventory_to_array) and classified with array set operations and
+            masked comparisons rather than a per-file loop.
+
             Parameters
             ----------
             file_from_db : dict
@@ -949,46 +1147,57 @@ class FileManager:
         if self.md5sum:
             self.comparison_info['md5sum'] = []
 
-        #if check_filesize:
-        #    comparison_info['filesize'] = []
-
-        allfiles = set(self.files_from_db).union(set(self.files_from_disk))
-
-        for fname in allfiles:
-            if fname in self.files_from_db:
-                if fname in self.files_from_disk:
-                    self.comparison_info['both'].append(fname)
-                    fdisk = self.files_from_disk[fname]
-                    fdb = self.files_from_db[fname]
-                    if fname in self.duplicates:
-                        self.comparison_info['duplicates'].append(fname)
-                    if fdisk['relpath'] == fdb['path']:
-                        if fdisk['filesize'] == fdb['filesize']:
-                            if self.md5sum:
-                                if fdisk['md5sum'] == fdb['md5sum']:
-                                    self.comparison_info['equal'].append(fname)
-                                else:
-                                    self.comparison_info['md5sum'].append(fname)
-                            else:
-                                self.comparison_info['equal'].append(fname)
-                        else:
-                            self.comparison_info['filesize'].append(fname)
-                    else:
-                        try:
-                            data = dkutils.get_single_file_disk_info(fdb['path'] + '/' + fname, self.md5sum, self.archive_root)
-                            if fname not in self.duplicates:
-                                self.duplicates[fname] = []
-                            self.duplicates[fname].append(copy.deepcopy(self.files_from_disk[fname]))
-                            self.files_from_disk[fname] = data
-                            self.comparison_info['duplicates'].append(fname)
-                        except:
-                            self.comparison_info['path'].append(fname)
-                else:
-                    self.comparison_info['dbonly'].append(fname)
-            else:
-                if fname in self.duplicates:
-                    self.comparison_info['pathdup'].append(fname)
-                self.comparison_info['diskonly'].append(fname)
+        dbarr = inventory_to_array(self.files_from_db, 'path')
+        diskarr = inventory_to_array(self.files_from_disk, 'relpath')
+        dupnames = np.array(sorted(self.duplicates), dtype=str)
+
+        _, dbidx, diskidx = np.intersect1d(dbarr['name'], diskarr['name'],
+                                           assume_unique=True, return_indices=True)
+        dbboth = dbarr[dbidx]
+        diskboth = diskarr[diskidx]
+
+        dbonly = np.setdiff1d(dbarr['name'], dbboth['name'], assume_unique=True)
+        diskonly = np.setdiff1d(diskarr['name'], diskboth['name'], assume_unique=True)
+
+        self.comparison_info['both'] = dbboth['name'].tolist()
+        self.comparison_info['dbonly'] = dbonly.tolist()
+        self.comparison_info['diskonly'] = diskonly.tolist()
+        self.comparison_info['pathdup'] = diskonly[np.isin(diskonly, dupnames)].tolist()
+        self.comparison_info['duplicates'] = dbboth['name'][np.isin(dbboth['name'], dupnames)].tolist()
+
+        samepath = dbboth['path'] == diskboth['path']
+        samesize = dbboth['filesize'] == diskboth['filesize']
+        if self.md5sum:
+            samemd5 = dbboth['md5sum'] == diskboth['md5sum']
+            self.comparison_info['md5sum'] = dbboth['name'][samepath & samesize & ~samemd5].tolist()
+            self.comparison_info['equal'] = dbboth['name'][samepath & samesize & samemd5].tolist()
+        else:
+            self.comparison_info['equal'] = dbboth['name'][samepath & samesize].tolist()
+        self.comparison_info['filesize'] = dbboth['name'][samepath & ~samesize].tolist()
+
+        # A path mismatch is only real if no copy of the file was found at the DB path.
+        # Every copy seen during the disk walk is already in self.duplicates, so only
+        # paths outside of the walked tree need to go back to the file system.
+        walked = None if self.relpath is None else self.relpath.rstrip('/')
+        for fname, dbpath in zip(dbboth['name'][~samepath].tolist(), dbboth['path'][~samepath].tolist()):
+            data = None
+            for dup in self.duplicates.get(fname, []):
+                if dup.get('relpath') == dbpath:
+                    data = dup
+                    break
+            if data is None and walked is not None and dbpath != walked and not dbpath.startswith(walked + '/'):
+                fullname = os.path.join(self.archive_root, dbpath, fname)
+                if os.path.exists(fullname):
+                    data = dkutils.get_single_file_disk_info(fullname, self.md5sum, self.archive_root)
+            if data is None:
+                self.comparison_info['path'].append(fname)
+                continue
+            if fname not in self.duplicates:
+                self.duplicates[fname] = [self.files_from_disk[fname]]
+            elif self.files_from_disk[fname] not in self.duplicates[fname]:
+                self.duplicates[fname].append(self.files_from_disk[fname])
+            self.files_from_disk[fname] = data
+            self.comparison_info['duplicates'].append(fname)
 
         end_time = time.time()
         if self.debug:
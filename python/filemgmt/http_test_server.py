@@ -0,0 +1,383 @@
+"""
+    Small local stand-in for the archive's WebDAV server, for testing and benchmarking
+    HttpUtils (and the classes using it) without a network or a real archive.
+
+    Supports GET (with Range), HEAD, PUT and MKCOL on a local directory, with optional
+    basic auth, and can inject latency, a bandwidth cap (for all or some downloads) and
+    429/500 responses (optionally with a body, like a real server's error page).
+
+    Example
+    -------
+        with WebDavServer(rootdir, user='user', passwd='pw', latency=0.05) as server:
+            desfile = server.write_desservices(os.path.join(tmpdir, '.desservices.ini'))
+            hutils = HttpUtils(desfile, 'file-http')
+            hutils.copyfiles({'a.fits': {'src': server.url + 'a.fits', 'dst': 'a.fits'}}, None)
+
+    Can also be run by itself (python -m filemgmt.http_test_server --help).
+"""
+
+import os
+import re
+import sys
+import time
+import base64
+import random
+import argparse
+import threading
+import collections
+import email.utils
+import http.server
+
+# bytes per read/write while streaming file data
+CHUNK = 64 * 1024
+
+
+class WebDavHandler(http.server.BaseHTTPRequestHandler):
+    """ Request handler for WebDavServer """
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, don't let small responses wait on acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def local_path(self):
+        """ The file under the server's root for the request path, None if outside of it """
+        path = os.path.normpath(self.path.split('?', 1)[0]).lstrip('/')
+        full = os.path.join(self.server.rootdir, path)
+        if os.path.commonpath([full, self.server.rootdir]) != self.server.rootdir:
+            return None
+        return full
+
+    def send_empty(self, code, headers=None):
+        """ Send a response without a body """
+        self.send_response(code)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_body(self, code, body, headers=None):
+        """ Send a response with a (small) body, e.g. an error page """
+        self.send_response(code)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def start_request(self):
+        """ Apply auth and the fault injection common to all methods
+
+            Returns
+            -------
+            bool, whether to go on with the request (a response was already sent if not)
+        """
+        self.server.count(self.command)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.auth is not None and self.headers.get('Authorization') != self.server.auth:
+            self.skip_body()
+            self.send_empty(401, {'WWW-Authenticate': 'Basic realm="filemgmt"'})
+            return False
+        (code, body) = self.server.injected_error()
+        if code is not None:
+            self.skip_body()
+            headers = {}
+            if code == 429 or code == 503:
+                headers['Retry-After'] = str(self.server.retry_after)
+            if body:
+                self.send_body(code, body, headers)
+            else:
+                self.send_empty(code, headers)
+            return False
+        return True
+
+    def skip_body(self):
+        """ Read and drop any request body so the connection can be reused """
+        nbytes = int(self.headers.get('Content-Length') or 0)
+        while nbytes > 0:
+            data = self.rfile.read(min(CHUNK, nbytes))
+            if not data:
+                break
+            nbytes -= len(data)
+
+    def throttled_copy(self, src, dst, nbytes, bandwidth=None):
+        """ Copy nbytes from src to dst, no faster than bandwidth (default the server's
+            bandwidth cap)
+        """
+        if bandwidth is None:
+            bandwidth = self.server.bandwidth
+        # about 10 writes a second when capped, so a slow transfer trickles instead of
+        # arriving in one go and then sitting idle
+        chunk = min(CHUNK, max(1, int(bandwidth / 10))) if bandwidth else CHUNK
+        start = time.time()
+        done = 0
+        while done < nbytes:
+            data = src.read(min(chunk, nbytes - done))
+            if not data:
+                break
+            dst.write(data)
+            done += len(data)
+            if bandwidth:
+                ahead = done / bandwidth - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return done
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        if not self.start_request():
+            return
+        path = self.local_path()
+        if path is None or not os.path.isfile(path):
+            self.send_empty(404)
+            return
+        size = os.path.getsize(path)
+        (beg, end) = (0, size - 1)
+        code = 200
+        rng = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get('Range', ''))
+        if rng and self.server.ranges:
+            if rng.group(1):
+                beg = int(rng.group(1))
+                if rng.group(2):
+                    end = min(int(rng.group(2)), size - 1)
+            elif rng.group(2):
+                beg = max(0, size - int(rng.group(2)))
+            if beg >= size or beg > end:
+                self.send_empty(416, {'Content-Range': f"bytes */{size}"})
+                return
+            code = 206
+        self.send_response(code)
+        self.send_header('Content-Length', str(end - beg + 1))
+        self.send_header('Last-Modified', email.utils.formatdate(os.path.getmtime(path), usegmt=True))
+        self.send_header('Accept-Ranges', 'bytes' if self.server.ranges else 'none')
+        if code == 206:
+            self.send_header('Content-Range', f"bytes {beg}-{end}/{size}")
+        self.end_headers()
+        if body:
+            bandwidth = self.server.throttled_for(path)
+            with open(path, 'rb') as fh:
+                fh.seek(beg)
+                self.throttled_copy(fh, self.wfile, end - beg + 1, bandwidth)
+
+    def do_PUT(self):
+        if not self.start_request():
+            return
+        path = self.local_path()
+        if 'Content-Length' not in self.headers:
+            self.close_connection = True
+            self.send_empty(411)
+            return
+        if path is None or not os.path.isdir(os.path.dirname(path)):
+            self.skip_body()
+            self.send_empty(409)
+            return
+        existed = os.path.exists(path)
+        tmpname = f"{path}.put.{threading.get_ident()}"
+        nbytes = int(self.headers['Content-Length'])
+        with open(tmpname, 'wb') as fh:
+            done = self.throttled_copy(self.rfile, fh, nbytes)
+        if done != nbytes:
+            os.remove(tmpname)
+            self.close_connection = True
+            return
+        os.replace(tmpname, path)
+        self.send_empty(204 if existed else 201)
+
+    def do_MKCOL(self):
+        if not self.start_request():
+            return
+        path = self.local_path()
+        if path is None or not os.path.isdir(os.path.dirname(path.rstrip('/'))):
+            self.send_empty(409)
+        elif os.path.exists(path):
+            self.send_empty(405)
+        else:
+            os.mkdir(path)
+            self.send_empty(201)
+
+
+class WebDavServer(http.server.ThreadingHTTPServer):
+    """ Local WebDAV stand-in serving rootdir
+
+        Parameters
+        ----------
+        rootdir : str
+            The directory served, urls are relative to it
+        port : int
+            The port to listen on (127.0.0.1 only), 0 picks a free one
+        user, passwd : str
+            Credentials required (basic auth), none required if user is None
+        latency : float
+            Seconds added to every request
+        bandwidth : float
+            Max bytes/sec for each response/request body, 0 for no cap
+        error_rate : float
+            Fraction of requests (0-1) answered with a random code from error_codes
+        error_codes : list
+            The http codes to inject, default [429, 500]
+        retry_after : int
+            Retry-After seconds sent with injected 429/503
+        error_body : bytes
+            Body sent with injected errors (e.g., an html error page), none if empty
+        ranges : bool
+            Whether to honor Range requests
+        verbose : bool
+            Whether to log every request
+    """
+    daemon_threads = True
+    # the default listen backlog (5) drops connections when many transfers start at once
+    request_queue_size = 128
+
+    def __init__(self, rootdir, port=0, user=None, passwd=None, latency=0.0, bandwidth=0,
+                 error_rate=0.0, error_codes=None, retry_after=1, ranges=True, verbose=False,
+                 error_body=b''):
+        self.rootdir = os.path.realpath(rootdir)
+        self.user = user
+        self.passwd = passwd
+        self.auth = None
+        if user is not None:
+            self.auth = 'Basic ' + base64.b64encode(f"{user}:{passwd or ''}".encode()).decode()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_codes = error_codes or [429, 500]
+        self.retry_after = retry_after
+        self.error_body = error_body
+        self.ranges = ranges
+        self.verbose = verbose
+        # (code, body) to send, in order, before going back to error_rate (see fail_next)
+        self.forced_errors = collections.deque()
+        # file -> [bytes/sec, number of GETs left] (see throttle_next)
+        self.throttled = {}
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+        super().__init__(('127.0.0.1', port), WebDavHandler)
+
+    @property
+    def url(self):
+        """ Base url of the server (ends in /) """
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def count(self, method):
+        """ Count a request by method """
+        with self.lock:
+            self.requests[method] += 1
+
+    def fail_next(self, *codes, body=None):
+        """ Answer the next requests with the given http codes, with body (default the
+            server's error_body)
+        """
+        if body is None:
+            body = self.error_body
+        with self.lock:
+            self.forced_errors.extend((code, body) for code in codes)
+
+    def throttle_next(self, path, bandwidth, count=1):
+        """ Send the body of the next count GETs of path (relative to the root url) at no
+            more than bandwidth bytes/sec, e.g., to make a download straggle or stall
+        """
+        with self.lock:
+            self.throttled[os.path.join(self.rootdir, path)] = [bandwidth, count]
+
+    def throttled_for(self, path):
+        """ The bandwidth cap for a GET of the file at path, None for the server's """
+        with self.lock:
+            throttle = self.throttled.get(path)
+            if throttle is None:
+                return None
+            throttle[1] -= 1
+            if throttle[1] <= 0:
+                del self.throttled[path]
+            return throttle[0]
+
+    def injected_error(self):
+        """ The http code and body to fail the current request with, (None, None) to
+            handle it normally
+        """
+        with self.lock:
+            if self.forced_errors:
+                return self.forced_errors.popleft()
+        if self.error_rate and random.random() < self.error_rate:
+            return random.choice(self.error_codes), self.error_body
+        return None, None
+
+    def handle_error(self, request, client_address):
+        # clients dropping a connection mid-transfer (e.g., a stalled try or the losing half
+        # of a hedged download) are part of the tests, not worth a traceback
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def write_desservices(self, filename, section='file-http'):
+        """ Write a des services file for HttpUtils to use with this server
+
+            Returns
+            -------
+            str, the filename
+        """
+        with open(filename, 'w', encoding="utf-8") as fh:
+            fh.write(f"[{section}]\nurl = {self.url}\nuser = {self.user or ''}\npasswd = {self.passwd or ''}\n")
+        os.chmod(filename, 0o600)
+        return filename
+
+    def start(self):
+        """ Serve requests in a background thread """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the background thread and close the socket """
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main(argv):
+    """ Run the server in the foreground """
+    parser = argparse.ArgumentParser(description='Local WebDAV stand-in for testing file transfers')
+    parser.add_argument('rootdir', help='directory to serve')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--user', default=None)
+    parser.add_argument('--passwd', default=None)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0, help='max bytes/sec per transfer')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests to fail')
+    parser.add_argument('--error_codes', default='429,500', help='comma separated http codes to inject')
+    parser.add_argument('--error_body', default='', help='body sent with injected errors')
+    parser.add_argument('--no_ranges', action='store_true', default=False, help='ignore Range requests')
+    parser.add_argument('--verbose', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    server = WebDavServer(args.rootdir, args.port, args.user, args.passwd, args.latency,
+                          args.bandwidth, args.error_rate,
+                          [int(x) for x in args.error_codes.split(',')],
+                          ranges=not args.no_ranges, verbose=args.verbose,
+                          error_body=args.error_body.encode())
+    print(f"Serving {server.rootdir} at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
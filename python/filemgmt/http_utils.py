@@ -8,6 +8,13 @@ import subprocess
 import re
 import traceback
 import time
+import hashlib
+import tempfile
+import random
+import threading
+import collections
+import email.utils
+from concurrent.futures import ThreadPoolExecutor
 import certifi
 import pycurl
 
@@ -16,12 +23,92 @@ import despymisc.miscutils as miscutils
 import filemgmt.filemgmt_defs as fmdefs
 import filemgmt.utils as utils
 
+# optional keys in the file movement config (mvmtinfo) controlling concurrent transfers
+HTTP_PARALLEL = 'http_parallel'
+HTTP_MAX_PER_HOST = 'http_max_per_host'
+HTTP_DIR_CACHE = 'http_dir_cache'
+HTTP_RETRY_BUDGET = 'http_retry_budget'
+HTTP_SPLIT_RANGES = 'http_split_ranges'
+HTTP_SPLIT_SIZE = 'http_split_size'
+HTTP_ADAPTIVE = 'http_adaptive'
+HTTP_CONCURRENCY_STATE = 'http_concurrency_state'
+HTTP_CONNECT_TIMEOUT = 'http_connect_timeout'
+HTTP_LOW_SPEED_LIMIT = 'http_low_speed_limit'
+HTTP_LOW_SPEED_TIME = 'http_low_speed_time'
+HTTP_HEDGE_SIZE = 'http_hedge_size'
+HTTP_HEDGE_PERCENTILE = 'http_hedge_percentile'
+
+# remote directories known to exist can be shared between the jobs on a node through the file
+# given by http_dir_cache in the file movement config (not shared by default), entries older
+# than DIR_CACHE_TTL seconds are ignored in case the directory has since been removed
+DIR_CACHE_TTL = 86400
+
+# with adaptive concurrency (see ConcurrencyController) the number of simultaneous transfers
+# learned for each host is saved in this file (override with http_concurrency_state) so the
+# next job starts from it, entries older than CONCURRENCY_STATE_TTL seconds are ignored
+DEFAULT_CONCURRENCY_STATE = os.path.join(tempfile.gettempdir(), f"filemgmt_http_concurrency.{os.getuid()}")
+CONCURRENCY_STATE_TTL = 7 * 86400
+
+# http codes for a successful transfer, and returned by MKCOL when the directory now exists
+HTTP_OK = [200, 201, 204, 206, 301]
+MKCOL_OK = [200, 201, 301, 405]
+
+# retries wait secondsBetweenRetries * 2**(try-1), capped at MAX_BACKOFF, with the upper half
+# randomized so that many jobs do not retry in lockstep.   A Retry-After from the server is
+# honored up to MAX_BACKOFF.   RETRY_BUDGET is the default max total seconds a single file
+# may spend waiting to retry.
+MAX_BACKOFF = 600
+RETRY_BUDGET = 1800
+
+# buffer size for the files being read from/written to by curl
+BUFSIZE = 1 << 20
+
+# downloads are written to dst + PARTIAL_SUFFIX and renamed once complete and checked, a
+# partial file left by a failed try (or an earlier job) is resumed with an http Range request
+PARTIAL_SUFFIX = '.partial'
+
+# a connection taking more than CONNECT_TIMEOUT seconds, or a transfer moving less than
+# LOW_SPEED_LIMIT bytes/sec for LOW_SPEED_TIME seconds, fails (and is retried) instead of
+# hanging the job (0 turns the check off)
+CONNECT_TIMEOUT = 60
+LOW_SPEED_LIMIT = 1024
+LOW_SPEED_TIME = 120
+
+# in a concurrent batch, a download of at most hedgesize bytes running longer than the
+# hedgepercentile of the earlier transfers of such files gets a duplicate request on a free
+# handle, whichever finishes first is used.   Needs HEDGE_MIN_SAMPLES finished transfers.
+# The duplicate writes to dst + HEDGE_SUFFIX.
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 10
+HEDGE_SUFFIX = '.hedge' + PARTIAL_SUFFIX
+
+# files of at least SPLIT_SIZE bytes may be fetched as several byte ranges at the same time
+# (see HttpUtils.get_ranges), each range is at least SPLIT_MIN_RANGE bytes
+SPLIT_SIZE = 256 * 1024 * 1024
+SPLIT_MIN_RANGE = 16 * 1024 * 1024
+
+# pycurl info saved for each transfer and passed on to the transfer stats, separates the
+# time spent on dns/connect/tls from the time moving data
+TIMING_INFO = {'namelookup_time': pycurl.NAMELOOKUP_TIME,
+               'connect_time': pycurl.CONNECT_TIME,
+               'appconnect_time': pycurl.APPCONNECT_TIME,
+               'starttransfer_time': pycurl.STARTTRANSFER_TIME,
+               'total_time': pycurl.TOTAL_TIME,
+               'speed_download': pycurl.SPEED_DOWNLOAD,
+               'speed_upload': pycurl.SPEED_UPLOAD}
+
+# remote diagnostics (ping, traceroute) run in the background, at most once per host per
+# object, and are killed after DIAG_TIMEOUT seconds
+DIAG_TIMEOUT = 120
+DIAG_LOCK = threading.Lock()
+
 
 def http_code_str(hcode):
     codestr = f"Unmapped http_code ({hcode})"
     code2str = {'200': 'Success/Ok',
                 '201': 'Success/Created',
                 '204': 'No content (unknown status)',
+                '206': 'Partial content (resumed or ranged get)',
                 '301': 'Directory already existed',
                 '304': 'Not modified',
                 '400': 'Bad Request (check command syntax)',
@@ -40,10 +127,537 @@ def http_code_str(hcode):
         codestr = code2str[str(hcode)]
     return codestr
 
+def options_from_config(mvmtinfo):
+    """ Get the HttpUtils keywords from a file movement config
+
+        Parameters
+        ----------
+        mvmtinfo : dict
+            The file movement config, may contain http_parallel (number of simultaneous
+            transfers), http_max_per_host (max connections to a single host),
+            http_dir_cache (file holding the remote directories known to exist, shared
+            with the other jobs on the node),
+            http_retry_budget (max seconds a file may spend waiting to retry),
+            http_split_ranges (number of byte ranges to fetch a large file in),
+            http_split_size (min size of a file to be fetched in ranges),
+            http_adaptive (adjust the number of simultaneous transfers, up to http_parallel,
+            to the throughput seen), http_concurrency_state (file holding the number
+            of simultaneous transfers learned for each host), http_connect_timeout,
+            http_low_speed_limit and http_low_speed_time (stall detection, see
+            CONNECT_TIMEOUT), http_hedge_size (max size of a download that may get a
+            duplicate request, 0 for none) and http_hedge_percentile (how slow a transfer
+            must be compared to earlier ones to get a duplicate)
+
+        Returns
+        -------
+        dict of keyword arguments for HttpUtils
+    """
+    if not mvmtinfo:
+        return {}
+    kwargs = {}
+    if HTTP_PARALLEL in mvmtinfo:
+        kwargs['numparallel'] = int(mvmtinfo[HTTP_PARALLEL])
+    if HTTP_MAX_PER_HOST in mvmtinfo:
+        kwargs['maxperhost'] = int(mvmtinfo[HTTP_MAX_PER_HOST])
+    if HTTP_DIR_CACHE in mvmtinfo:
+        kwargs['dircache'] = mvmtinfo[HTTP_DIR_CACHE]
+    if HTTP_RETRY_BUDGET in mvmtinfo:
+        kwargs['retrybudget'] = float(mvmtinfo[HTTP_RETRY_BUDGET])
+    if HTTP_SPLIT_RANGES in mvmtinfo:
+        kwargs['splitranges'] = int(mvmtinfo[HTTP_SPLIT_RANGES])
+    if HTTP_SPLIT_SIZE in mvmtinfo:
+        kwargs['splitsize'] = int(mvmtinfo[HTTP_SPLIT_SIZE])
+    if HTTP_ADAPTIVE in mvmtinfo:
+        kwargs['adaptive'] = miscutils.convertBool(mvmtinfo[HTTP_ADAPTIVE])
+    if HTTP_CONCURRENCY_STATE in mvmtinfo:
+        kwargs['concurrencystate'] = mvmtinfo[HTTP_CONCURRENCY_STATE]
+    if HTTP_CONNECT_TIMEOUT in mvmtinfo:
+        kwargs['connecttimeout'] = int(mvmtinfo[HTTP_CONNECT_TIMEOUT])
+    if HTTP_LOW_SPEED_LIMIT in mvmtinfo:
+        kwargs['lowspeedlimit'] = int(mvmtinfo[HTTP_LOW_SPEED_LIMIT])
+    if HTTP_LOW_SPEED_TIME in mvmtinfo:
+        kwargs['lowspeedtime'] = int(mvmtinfo[HTTP_LOW_SPEED_TIME])
+    if HTTP_HEDGE_SIZE in mvmtinfo:
+        kwargs['hedgesize'] = int(mvmtinfo[HTTP_HEDGE_SIZE])
+    if HTTP_HEDGE_PERCENTILE in mvmtinfo:
+        kwargs['hedgepercentile'] = float(mvmtinfo[HTTP_HEDGE_PERCENTILE])
+    return kwargs
+
+
+def backoff_delay(base, ntry, retry_after=None):
+    """ Number of seconds to wait before retry number ntry (1 is the first retry)
+
+        Parameters
+        ----------
+        base : float
+            The delay before the first retry
+
+        ntry : int
+            The retry number
+
+        retry_after : float
+            The delay requested by the server, default is None
+    """
+    delay = min(MAX_BACKOFF, base * 2 ** (ntry - 1))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, MAX_BACKOFF))
+    return delay
+
+
+def parse_retry_after(headers):
+    """ Get the number of seconds in a Retry-After header (seconds or http date), None if
+        there is no usable header
+    """
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_http_error(httpcode):
+    """ Whether the http status code is from a response other than 2xx (0 or None if there
+        was no response)
+    """
+    return bool(httpcode) and not 200 <= httpcode < 300
+
+
+def header_collector(headers):
+    """ Make a pycurl HEADERFUNCTION that stores the response headers of the last response
+        in the dictionary headers (lower case names, the status code is stored as ':status')
+    """
+    def collect(line):
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            headers.clear()
+            parts = line.split()
+            if len(parts) > 1:
+                headers[':status'] = parts[1]
+        elif ':' in line:
+            (name, value) = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return collect
+
+
+def remote_diagnostics(hname):
+    """ Run ping and traceroute to hname and print the output as one block
+    """
+    out = [f"Running commands to {hname} for diagnostics"]
+    for (desc, cmd) in [(f"Pinging {hname}", ['ping', '-c', '4', hname]),
+                        (f"Running traceroute to {hname}", ['traceroute', hname])]:
+        out.append(f"\n{desc}")
+        try:   # don't let exception here halt
+            out.append(subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                      text=True, timeout=DIAG_TIMEOUT, check=False).stdout)
+        except Exception as err:   # print exception but continue
+            out.append(f"Ignoring remote diagnostics exception ({err}).   Continuing.")
+    with DIAG_LOCK:
+        print("*" * 75)
+        print("\n".join(out))
+        print("*" * 75)
+        sys.stdout.flush()
+
+
+def curl_timing(curl, retries=0, stalls=0, hedges=0):
+    """ Timing info (see TIMING_INFO) of the last transfer done by the curl handle
+
+        Parameters
+        ----------
+        curl : pycurl.Curl
+            The handle, must not have been reset since the transfer
+        retries : int
+            The number of retries the transfer needed, saved with the timing info
+        stalls : int
+            The number of tries that were stopped by the stall detection
+        hedges : int
+            The number of duplicate requests made for the file
+
+        Returns
+        -------
+        dict
+    """
+    timing = {key: curl.getinfo(info) for key, info in TIMING_INFO.items()}
+    timing['retries'] = retries
+    timing['stalls'] = stalls
+    timing['hedges'] = hedges
+    return timing
+
+
+def percentile(values, pct):
+    """ The pct percentile (nearest rank) of the values """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))]
+
+
+def split_url(url):
+    """ Split a url into the server part and the list of urls of its parent directories,
+        shallowest first
+    """
+    m = re.match(r"(https?://[^/]+)(/.*)", url)
+    return m.group(1), [m.group(1) + x for x in miscutils.get_list_directories([m.group(2)])]
+
+
+class ChecksumWriter:
+    """ Buffered writer for downloads that computes the md5sum of the data as it is written
+
+        Parameters
+        ----------
+        path : str
+            The file to write to
+
+        resume : bool
+            Whether to keep (and checksum) any data already in the file so the transfer can
+            continue from there, default is False
+
+        headers : dict
+            The response headers (see header_collector).  When resuming, data from a response
+            that is not 206 (partial content) replaces what was in the file.   The body of a
+            response that is not 2xx (e.g., an error page) is dropped, and the next retry
+            starts over.
+    """
+    def __init__(self, path, resume=False, headers=None):
+        self.path = path
+        self.headers = headers if headers is not None else {}
+        self.fh = open(path, 'ab' if resume else 'wb', buffering=BUFSIZE)
+        self.md5 = hashlib.md5()
+        self.nbytes = 0
+        if resume:
+            with open(path, 'rb') as rfh:
+                for chunk in iter(lambda: rfh.read(BUFSIZE), b''):
+                    self.md5.update(chunk)
+                    self.nbytes += len(chunk)
+        # bytes already in the file when the current try started, and bytes still to be
+        # checked against the response status (see write)
+        self.start = self.nbytes
+        self.offset = self.nbytes
+        # whether the current try got an http error response
+        self.httperror = False
+
+    def write(self, data):
+        """ Method used as the curl WRITEFUNCTION """
+        status = self.headers.get(':status')
+        if status is not None and not status.startswith('2'):
+            # not file data, don't write or checksum it
+            self.httperror = True
+            return None
+        if self.offset:
+            # first data of a resumed transfer, make sure the server honored the range
+            if self.headers.get(':status') != '206':
+                self.restart()
+            self.offset = 0
+        self.md5.update(data)
+        self.nbytes += len(data)
+        self.fh.write(data)
+
+    def retry(self, curl, restart=False):
+        """ Set up the curl handle to continue from what has been written so far
+            (or from the beginning if restart is True)
+        """
+        if restart or self.httperror:
+            self.restart()
+        self.fh.flush()
+        self.start = self.nbytes
+        self.offset = self.nbytes
+        curl.setopt(pycurl.RESUME_FROM_LARGE, self.nbytes)
+
+    def restart(self):
+        """ Discard everything written so far (for a retry) """
+        self.fh.seek(0)
+        self.fh.truncate()
+        self.md5 = hashlib.md5()
+        self.nbytes = 0
+        self.start = 0
+        self.offset = 0
+        self.httperror = False
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def close(self):
+        self.fh.close()
+
+
+class ChecksumReader:
+    """ Buffered reader for uploads that computes the md5sum of the data as it is read
+
+        Parameters
+        ----------
+        path : str
+            The file to read from
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'rb', buffering=BUFSIZE)
+        self.md5 = hashlib.md5()
+        self.nbytes = 0
+        self.start = 0
+
+    def read(self, size):
+        """ Method used as the curl READFUNCTION """
+        data = self.fh.read(size)
+        self.md5.update(data)
+        self.nbytes += len(data)
+        return data
+
+    def retry(self, curl, restart=True):
+        """ Uploads always start over """
+        self.restart()
+
+    def restart(self):
+        """ Go back to the beginning of the file (for a retry) """
+        self.fh.seek(0)
+        self.md5 = hashlib.md5()
+        self.nbytes = 0
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def close(self):
+        self.fh.close()
+
+
+def check_transfer(stream, filesize, md5sum):
+    """ Compare what went through a ChecksumReader/ChecksumWriter with what was expected
+
+        Parameters
+        ----------
+        stream : ChecksumReader or ChecksumWriter
+            The stream used for the transfer
+
+        filesize : int
+            The expected number of bytes, 0 or None if not known
+
+        md5sum : str
+            The expected md5sum (e.g., from the DB), None if not known
+
+        Returns
+        -------
+        str describing the problem, None if the transfer looks good
+    """
+    if filesize and stream.nbytes != filesize:
+        return f"Transferred {stream.nbytes} bytes of {stream.path}, expected {filesize}"
+    if md5sum and stream.hexdigest() != md5sum:
+        return f"md5sum mismatch for {stream.path} ({stream.hexdigest()} vs expected {md5sum})"
+    return None
+
+
+class ConcurrencyController:
+    """ Additive increase/multiplicative decrease of the number of simultaneous transfers to
+        a host.   After each window of completed transfers (one per allowed transfer) the
+        limit goes up by one if the aggregate throughput improved by more than GAIN over the
+        previous window, or if it is still below where it was before the last cut.   The
+        limit is cut by DECREASE on a 429/5xx from the server, or when the mean time to first
+        byte of a window grows past LATENCY_FACTOR times (and LATENCY_MARGIN seconds over) a
+        smoothed baseline without the throughput improving.
+    """
+    GAIN = 0.05
+    DECREASE = 0.5
+    LATENCY_FACTOR = 2.0
+    # ms scale jitter on a fast link easily doubles the time to first byte, ignore it
+    LATENCY_MARGIN = 0.05
+    # weight of each new window in the time to first byte baseline
+    LATENCY_SMOOTHING = 0.25
+    # transfers (in multiples of maximum) needed before the limit is worth saving
+    SAVE_WINDOWS = 3
+
+    def __init__(self, host, maximum, minimum=1, statefile=None):
+        self.host = host
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.statefile = statefile
+        self.saved = self.load()
+        if self.saved is not None:
+            self.limit = min(self.maximum, max(self.minimum, self.saved))
+        else:
+            self.limit = max(self.minimum, self.maximum // 2)
+        self.last_rate = None
+        self.base_latency = None
+        # limit before the last cut, recovered toward without needing a throughput gain
+        self.ceiling = self.limit
+        self.samples = 0
+        self.backed_off = False
+        self.new_window()
+
+    def new_window(self):
+        """ Start measuring a new window of transfers """
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_count = 0
+        self.window_latency = 0.0
+        self.window_timed = 0
+
+    def completed(self, nbytes, latency=None):
+        """ Record a successful transfer of nbytes, latency is its time to first byte
+
+            Returns
+            -------
+            int, the (possibly changed) limit
+        """
+        self.backed_off = False
+        self.samples += 1
+        self.window_count += 1
+        self.window_bytes += nbytes or 0
+        if latency:
+            self.window_latency += latency
+            self.window_timed += 1
+        if self.window_count < self.limit:
+            return self.limit
+        elapsed = time.time() - self.window_start
+        rate = self.window_bytes / elapsed if elapsed > 0 else 0.0
+        improved = self.last_rate is not None and rate > self.last_rate * (1 + self.GAIN)
+        self.last_rate = rate
+        if self.window_timed:
+            latency = self.window_latency / self.window_timed
+            base = self.base_latency
+            self.base_latency = latency if base is None else base + self.LATENCY_SMOOTHING * (latency - base)
+            if (base is not None and not improved and latency > self.LATENCY_FACTOR * base
+                    and latency - base > self.LATENCY_MARGIN):
+                self.decrease(f"time to first byte {latency:.2f}s vs usual {base:.2f}s")
+                return self.limit
+        if (improved or self.limit < self.ceiling) and self.limit < self.maximum:
+            self.limit += 1
+            if miscutils.fwdebug_check(3, "HTTP_UTILS_DEBUG"):
+                miscutils.fwdebug_print(f"Throughput to {self.host} at {rate:.0f} B/s, now {self.limit} simultaneous transfers")
+        self.new_window()
+        return self.limit
+
+    def overloaded(self, httpcode):
+        """ Record that the server refused or failed a transfer (429 or 5xx) """
+        if self.backed_off:
+            # already backed off and nothing has finished since, the transfer started before that
+            return self.limit
+        return self.decrease(f"http status {httpcode}")
+
+    def decrease(self, reason):
+        """ Cut the limit and start measuring again """
+        limit = max(self.minimum, int(self.limit * self.DECREASE))
+        if limit != self.limit:
+            miscutils.fwdebug_print(f"Reducing simultaneous transfers to {self.host} from {self.limit} to {limit} ({reason})")
+        # clean windows climb back to where the cut was made from, one transfer at a time
+        self.ceiling = self.limit
+        self.limit = limit
+        self.backed_off = True
+        self.new_window()
+        return self.limit
+
+    def load(self):
+        """ The limit saved for the host by an earlier job, None if none """
+        if not self.statefile:
+            return None
+        limit = None
+        now = time.time()
+        try:
+            with open(self.statefile, 'r', encoding="utf-8") as fh:
+                for line in fh:
+                    parts = line.split()
+                    try:
+                        if len(parts) == 3 and parts[1] == self.host and now - float(parts[0]) < CONCURRENCY_STATE_TTL:
+                            limit = int(parts[2])
+                    except ValueError:
+                        pass
+        except OSError:
+            return None
+        return limit
+
+    def save(self):
+        """ Append the current limit for the host to the state file if it changed and
+            enough transfers were seen to trust it
+        """
+        if not self.statefile or self.limit == self.saved:
+            return
+        if self.samples < self.SAVE_WINDOWS * self.maximum:
+            if miscutils.fwdebug_check(3, "HTTP_UTILS_DEBUG"):
+                miscutils.fwdebug_print(f"Not saving limit {self.limit} for {self.host}, only {self.samples} transfers")
+            return
+        try:
+            if os.path.exists(self.statefile) and os.path.getsize(self.statefile) > 1 << 20:
+                self.compact()
+            # single appending write so concurrent jobs do not interleave lines
+            fd = os.open(self.statefile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+            try:
+                os.write(fd, f"{time.time():.0f} {self.host} {self.limit}\n".encode())
+            finally:
+                os.close(fd)
+            self.saved = self.limit
+        except OSError as err:
+            miscutils.fwdebug_print(f"Could not update concurrency state {self.statefile} ({err})")
+
+    def compact(self):
+        """ Rewrite the state file keeping only the latest entry for each host """
+        latest = {}
+        with open(self.statefile, 'r', encoding="utf-8") as fh:
+            for line in fh:
+                parts = line.split()
+                if len(parts) == 3:
+                    latest[parts[1]] = line
+        tmpname = f"{self.statefile}.{os.getpid()}.tmp"
+        with open(tmpname, 'w', encoding="utf-8") as fh:
+            fh.writelines(latest.values())
+        os.replace(tmpname, self.statefile)
+
+
+class HttpTransfer:
+    """ Class to hold the state of a single file transfer in a concurrent batch
+    """
+    def __init__(self, filename, src, dst, filesize, upload, md5sum=None):
+        self.filename = filename
+        self.src = src
+        self.dst = dst
+        self.filesize = filesize
+        self.md5sum = md5sum
+        self.upload = upload
+        self.tries = 0
+        self.restart = False
+        self.waited = 0.0
+        self.httpcode = None
+        self.headers = {}
+        self.ready_at = 0.0
+        self.starttime = None
+        self.task_id = None
+        self.fh = None
+        self.timing = None
+        # downloads are written here, then renamed to dst
+        self.partial = dst + PARTIAL_SUFFIX
+        self.try_start = None
+        self.stalls = 0
+        # a duplicate request for a straggling download (see copyfiles_multi): the original
+        # has the duplicate in hedge, the duplicate has the original in primary
+        self.hedges = 0
+        self.hedge = None
+        self.primary = None
+        self.err = None
+
+    def duplicate(self):
+        """ A hedged request for the same download, written to its own partial file """
+        dup = HttpTransfer(self.filename, self.src, self.dst, self.filesize, self.upload, self.md5sum)
+        dup.partial = self.dst + HEDGE_SUFFIX
+        dup.restart = True
+        dup.primary = self
+        return dup
+
+    def url(self):
+        """ The remote end of the transfer """
+        if self.upload:
+            return self.dst
+        return self.src
+
+
 class HttpUtils:
     copyfiles_called = 0
 
-    def __init__(self, des_services, des_http_section, numtries=5, secondsBetweenRetries=30):
+    def __init__(self, des_services, des_http_section, numtries=5, secondsBetweenRetries=30,
+                 numparallel=1, maxperhost=0, dircache=None, retrybudget=RETRY_BUDGET,
+                 splitranges=1, splitsize=SPLIT_SIZE, adaptive=False,
+                 concurrencystate=DEFAULT_CONCURRENCY_STATE, connecttimeout=CONNECT_TIMEOUT,
+                 lowspeedlimit=LOW_SPEED_LIMIT, lowspeedtime=LOW_SPEED_TIME, hedgesize=0,
+                 hedgepercentile=HEDGE_PERCENTILE):
         """Get password for curl and initialize existing_directories variable.
 
         >>> C = HttpUtils('test_http_utils/.desservices.ini', 'file-http')
@@ -57,18 +671,59 @@ class HttpUtils:
             self.curl_password = f"{self.auth_params['user']}:{self.auth_params['passwd']}"
         except Exception as err:
             miscutils.fwdie(f"Unable to get curl password ({err})", fmdefs.FM_EXIT_FAILURE)
+        self.connecttimeout = connecttimeout
+        self.lowspeedlimit = lowspeedlimit
+        self.lowspeedtime = lowspeedtime
+        self.hedgesize = hedgesize
+        self.hedgepercentile = hedgepercentile
         self.curl = pycurl.Curl()
         self.curl.setopt(pycurl.USERPWD, self.curl_password)
+        self.set_stall_options(self.curl)
         self.existing_directories = set()
         self.numtries = numtries
         self.src = None
         self.dst = None
         self.filesize = None
+        self.md5sum = None
+        self.stream = None
         self.secondsBetweenRetries = secondsBetweenRetries
+        # concurrent transfers (see copyfiles_multi), the multi handle and the easy handles are
+        # kept for the life of the object so open connections are reused between batches
+        self.numparallel = numparallel
+        self.maxperhost = maxperhost
+        self.multi = None
+        self.free_handles = []
+        # with adaptive, numparallel is the most simultaneous transfers allowed and the number
+        # used is adjusted per host by a ConcurrencyController
+        self.adaptive = adaptive
+        self.concurrencystate = concurrencystate
+        self.controllers = {}
+        # file of remote directories known to exist, shared with other jobs (None to not share)
+        self.dircache = dircache
+        self.dircache_loaded = False
+        self.retrybudget = retrybudget
+        # large downloads fetched as splitranges byte ranges at the same time (see get_ranges)
+        self.splitranges = splitranges
+        self.splitsize = splitsize
+        self.headers = {}
+        # curl timing info of the last file transferred (see curl_timing)
+        self.timing = None
+        self.diag_pool = None
+        self.diag_hosts = set()
 
     def reset(self):
         self.curl.reset()
         self.curl.setopt(pycurl.USERPWD, self.curl_password)
+        self.set_stall_options(self.curl)
+
+    def set_stall_options(self, curl):
+        """ Make curl give up on a connection or transfer that stalls (see CONNECT_TIMEOUT)
+        """
+        if self.connecttimeout:
+            curl.setopt(pycurl.CONNECTTIMEOUT, self.connecttimeout)
+        if self.lowspeedlimit and self.lowspeedtime:
+            curl.setopt(pycurl.LOW_SPEED_LIMIT, self.lowspeedlimit)
+            curl.setopt(pycurl.LOW_SPEED_TIME, self.lowspeedtime)
 
     def check_url(self, P):
         """See if P is a url.
@@ -84,42 +739,70 @@ class HttpUtils:
             return (P, True)
         return (P, False)
 
-    def verify(self):
-        """ Method to verify if a file was completely transferred
+    def check_stream(self, stream, verify):
+        """ Method to check the data that went through the stream against the expected
+            size and md5sum, returns None if good otherwise a description of the problem
+        """
+        if stream is None:
+            return None
+        filesize = self.filesize
+        if not filesize and verify:
+            # size not known ahead of time, use what the server said it was sending
+            clen = self.curl.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
+            if clen is not None and clen >= 0:
+                filesize = int(clen) + stream.start
+        return check_transfer(stream, filesize, self.md5sum)
 
+    def retry_wait(self, ntry, waited, headers):
+        """ Seconds to wait before retry number ntry, None if that would exceed the retry budget
         """
-        try:
-            self.curl.setopt(pycurl.URL, self.dst)
-            self.curl.setopt(pycurl.NOBODY, 1)
-            for i in range(self.numtries):
-                self.curl.perform()
-                rtemp = self.curl.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
-                if rtemp is not None:
-                    if i > 0:
-                        print(f"Verify took {int(i) + 1} tries to succeed")
-                    break
-                time.sleep(5)
-                if i == self.numtries - 1:
-                    print(f"Failed to verify {self.dst} after {self.numtries:d} tries.")
-                    return False
-            rfsize = int(rtemp)
-            if self.filesize == 0:
-                self.filesize = os.path.getsize(self.src)
-            if self.filesize == rfsize:
-                return True
-            return False
-        except:
-            (etype, value, trback) = sys.exc_info()
-            traceback.print_exception(etype, value, trback, file=sys.stdout)
-            return False
-        finally:
-            #self.curl.unsetopt(pycurl.URL)
-            self.curl.setopt(pycurl.NOBODY, 0)
+        delay = backoff_delay(self.secondsBetweenRetries, ntry, parse_retry_after(headers))
+        if waited + delay > self.retrybudget:
+            return None
+        return delay
 
-    def perform(self, cmd=None, verify=False, upload=False):
+    def diagnostics(self, cmd, url):
+        """ Print local diagnostics and start the remote ones in the background
+
+        """
+        print("\nDiagnostics:")
+        print("Directory info")
+        sys.stdout.flush()
+        if miscutils.fwdebug_check(10, "HTTP_UTILS_DEBUG"):
+            utils.find_ls('.')
+        elif self.src is not None and not re.match("^https?:", self.src):
+            print(utils.ls_ld(self.src))
+        else:
+            print(os.getcwd())
+            print("Source file is not local")
+        print("\nFile system disk space usage")
+        utils.df_h('.')
+        sys.stdout.flush()
+
+        hostm = re.search(r"https?://([^/:]+)[:/]", url or '')
+        if not hostm:
+            print("Couldn't find url in curl cmd:", cmd)
+            print("Skipping remote diagnostics.\n")
+        elif hostm.group(1) not in self.diag_hosts:
+            self.diag_hosts.add(hostm.group(1))
+            if self.diag_pool is None:
+                self.diag_pool = ThreadPoolExecutor(max_workers=1)
+            self.diag_pool.submit(remote_diagnostics, hostm.group(1))
+
+    def perform(self, cmd=None, verify=False, upload=False, stream=None, okcodes=HTTP_OK):
+        waited = 0.0
+        stalls = 0
+        exitcode = pycurl.E_OK
+        httpcode = None
+        self.curl.setopt(pycurl.HEADERFUNCTION, header_collector(self.headers))
         for x in range(self.numtries):
-            exitcode = pycurl.E_OK
             msg = None
+            self.headers.clear()
+            if stream is not None and x > 0:
+                # continue a download where it stopped unless what arrived was bad or the
+                # server answered with an error (e.g., 416 for a range past the end)
+                stream.retry(self.curl, restart=exitcode == -1 or is_http_error(httpcode))
+            exitcode = pycurl.E_OK
             try:
                 if upload:
                     self.curl.setopt(pycurl.UPLOAD, 1)
@@ -128,20 +811,21 @@ class HttpUtils:
                     self.curl.setopt(pycurl.UPLOAD, 0)
             except pycurl.error as ex:
                 exitcode, msg = ex.args
+                if exitcode == pycurl.E_OPERATION_TIMEDOUT:
+                    stalls += 1
+                    msg = f"{msg}, stalled (see http_low_speed_limit, http_low_speed_time, http_connect_timeout)"
             httpcode = self.curl.getinfo(pycurl.HTTP_CODE)
-            if exitcode == pycurl.E_OK:
-                if ((httpcode in [200, 201, 301] and verify) or httpcode == 204) and self.dst is not None:
-                    # if we get code 204 check to see if it has been transferred by getting file size
-                    # check file size
-
-                    if self.verify():
-                        if x > 0:
-                            print(f"Transfer took {x + 1} tries to succeed")
-                        return
-                elif httpcode in [200, 201, 301] and not verify:
+            self.timing = curl_timing(self.curl, x, stalls)
+            if exitcode == pycurl.E_OK and httpcode in okcodes:
+                # the size and md5sum were computed as the data streamed through, so no
+                # need to ask the server or re-read the file
+                problem = self.check_stream(stream, verify)
+                if problem is None:
                     if x > 0:
                         print(f"Transfer took {x + 1} tries to succeed")
                     return
+                msg = problem
+                exitcode = -1
 
             miscutils.fwdebug_print("*" * 75)
             miscutils.fwdebug_print("CURL FAILURE")
@@ -152,61 +836,19 @@ class HttpUtils:
             else:
                 miscutils.fwdebug_print("curl http status: unknown")
 
+            delay = None
             if x < self.numtries-1:    # not the last time in the loop
-                miscutils.fwdebug_print(f"Sleeping {self.secondsBetweenRetries} secs")
-                time.sleep(self.secondsBetweenRetries)
+                delay = self.retry_wait(x + 1, waited, self.headers)
+            if delay is not None:
+                if upload and httpcode == 409:
+                    # parent directory is missing, the directory cache was out of date
+                    self.recreate_dirs(self.dst)
+                miscutils.fwdebug_print(f"Sleeping {delay:.1f} secs")
+                time.sleep(delay)
+                waited += delay
             else:
-                print("\nDiagnostics:")
-                print("Directory info")
-                sys.stdout.flush()
-                if miscutils.fwdebug_check(10, "HTTP_UTILS_DEBUG"):
-                    utils.find_ls('.')
-                elif self.src is not None:
-                    print(utils.ls_ld(self.src))
-                else:
-                    print(os.getcwd())
-                    print("Source file is not local")
-                print("\nFile system disk space usage")
-                utils.df_h('.')
-
-                sys.stdout.flush()
-
-                if self.src is not None:
-                    hostm = re.search(r"https?://([^/:]+)[:/]", self.src)
-                else:
-                    hostm = re.search(r"https?://([^/:]+)[:/]", self.dst)
-                if hostm:
-                    hname = hostm.group(1)
-                    try:   # don't let exception here halt
-                        print(f"Running commands to {hname} for diagnostics")
-                        print(f"\nPinging {hname}")
-                        sys.stdout.flush()
-                        stat = subprocess.Popen(f"ping -c 4 {hname}",
-                                                shell=True,
-                                                stdout=subprocess.PIPE,
-                                                stderr=subprocess.PIPE,
-                                                text=True)
-                        curl_stdout = stat.communicate()[0]
-                        print(curl_stdout)
-                        print(f"\nRunning traceroute to {hname}")
-                        sys.stdout.flush()
-                        stat = subprocess.Popen(f"traceroute {hname}",
-                                                shell=True,
-                                                stdout=subprocess.PIPE,
-                                                stderr=subprocess.PIPE,
-                                                text=True)
-                        curl_stdout = stat.communicate()[0]
-                        print(curl_stdout)
-                    except:   # print exception but continue
-                        (etype, value, trback) = sys.exc_info()
-                        traceback.print_exception(etype, value, trback, file=sys.stdout)
-                        print("\n\nIgnoring remote diagnostics exception.   Continuing.\n")
-                else:
-                    print("Couldn't find url in curl cmd:", cmd)
-                    print("Skipping remote diagnostics.\n")
-
-                print("*" * 75)
-                sys.stdout.flush()
+                self.diagnostics(cmd, self.src if self.src is not None and re.match("^https?:", self.src) else self.dst)
+                break
 
         errmsg = f"Curl operation failed with return code {exitcode:d} ({msg}), "
         if httpcode is not None:
@@ -216,44 +858,357 @@ class HttpUtils:
 
         raise Exception(errmsg)
 
+    def load_dir_cache(self):
+        """ Add the directories recorded in the shared cache file to existing_directories
+        """
+        if self.dircache_loaded or not self.dircache:
+            return
+        self.dircache_loaded = True
+        now = time.time()
+        nlines = 0
+        fresh = {}
+        try:
+            with open(self.dircache, 'r', encoding="utf-8") as fh:
+                for line in fh:
+                    nlines += 1
+                    parts = line.split()
+                    try:
+                        if len(parts) == 2 and now - float(parts[0]) < DIR_CACHE_TTL:
+                            fresh[parts[1]] = parts[0]
+                    except ValueError:
+                        pass
+        except OSError:
+            return
+        self.existing_directories.update(fresh)
+        # keep the file from growing without bound, rewrite it if it is mostly stale
+        if nlines > 1000 and nlines > 2 * len(fresh):
+            try:
+                tmpname = f"{self.dircache}.{os.getpid()}.tmp"
+                with open(tmpname, 'w', encoding="utf-8") as fh:
+                    for url, stamp in fresh.items():
+                        fh.write(f"{stamp} {url}\n")
+                os.replace(tmpname, self.dircache)
+            except OSError:
+                pass
+
+    def remember_dirs(self, urls):
+        """ Record that the given remote directories (and their parents) exist
+        """
+        known = set()
+        for url in urls:
+            known.update(split_url(url + '/x')[1])
+        known -= self.existing_directories
+        if not known:
+            return
+        self.existing_directories.update(known)
+        if not self.dircache:
+            return
+        # single appending write so concurrent jobs do not interleave lines
+        now = time.time()
+        try:
+            fd = os.open(self.dircache, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+            try:
+                os.write(fd, ''.join(f"{now:.0f} {url}\n" for url in sorted(known)).encode())
+            finally:
+                os.close(fd)
+        except OSError as err:
+            miscutils.fwdebug_print(f"Could not update directory cache {self.dircache} ({err})")
+
+    def forget_dirs(self, f):
+        """ Drop the parent directories of url *f* from existing_directories, used when the
+            server says they are missing
+        """
+        self.existing_directories.difference_update(split_url(f)[1])
+
+    def recreate_dirs(self, f):
+        """ Forget and create again the parent directories of url *f*, used when the server
+            says they are missing.   Uses its own handles so the transfer set up on self.curl
+            can go on as is, so not for use during copyfiles_multi
+        """
+        self.forget_dirs(f)
+        try:
+            for level in self.plan_directories([f]):
+                self.mkcol_multi(level)
+                self.remember_dirs(level)
+        except Exception as err:
+            miscutils.fwdebug_print(str(err))
+
+    def plan_directories(self, urls):
+        """ Determine the remote directories that need to be created for the given file urls
+
+            Parameters
+            ----------
+            urls : list
+                The urls of the files to be uploaded
+
+            Returns
+            -------
+            list of lists of directory urls, one list per depth (shallowest first), every
+            directory in a list can be created at the same time
+        """
+        self.load_dir_cache()
+        levels = {}
+        for url in urls:
+            for dname in split_url(url)[1]:
+                if dname not in self.existing_directories:
+                    levels.setdefault(dname.count('/'), set()).add(dname)
+        return [sorted(levels[depth]) for depth in sorted(levels)]
+
+    def create_http_dirs(self, urls):
+        """ Create all the remote directories needed by the given file urls, breadth-first,
+            with up to numparallel MKCOL requests at a time.
+
+            Parameters
+            ----------
+            urls : list
+                The urls of the files to be uploaded
+        """
+        for level in self.plan_directories(urls):
+            if self.numparallel <= 1 or len(level) == 1:
+                for dname in level:
+                    self.create_http_intermediate_dirs(dname + '/x')
+            else:
+                self.mkcol_multi(level)
+                self.remember_dirs(level)
+
+    def mkcol_multi(self, dirs):
+        """ Issue MKCOL requests for the given directory urls concurrently
+
+        """
+        pending = collections.deque((0.0, dname) for dname in dirs)
+        tries = collections.Counter()
+        active = {}
+        while pending or active:
+            now = time.time()
+            for _ in range(len(pending)):
+                if len(active) >= self.numparallel:
+                    break
+                (ready_at, dname) = pending.popleft()
+                if ready_at > now:
+                    pending.append((ready_at, dname))
+                    continue
+                curl = self.get_handle()
+                if dname.startswith('https:'):
+                    curl.setopt(pycurl.CAINFO, certifi.where())
+                curl.setopt(pycurl.URL, dname)
+                curl.setopt(pycurl.CUSTOMREQUEST, 'MKCOL')
+                curl.setopt(pycurl.WRITEFUNCTION, lambda x: None)
+                tries[dname] += 1
+                active[curl] = dname
+                self.multi.add_handle(curl)
+            if not active:
+                time.sleep(max(0.0, min(x[0] for x in pending) - time.time()))
+                continue
+            while True:
+                ret, _ = self.multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                numq, oklist, errlist = self.multi.info_read()
+                for (curl, exitcode, msg) in [(c, pycurl.E_OK, None) for c in oklist] + list(errlist):
+                    dname = active.pop(curl)
+                    self.multi.remove_handle(curl)
+                    httpcode = curl.getinfo(pycurl.HTTP_CODE)
+                    self.free_handles.append(curl)
+                    if exitcode == pycurl.E_OK and httpcode in MKCOL_OK:
+                        continue
+                    miscutils.fwdebug_print(f"MKCOL {dname} failed: curl exitcode {exitcode} ({msg}), http status {httpcode} ({http_code_str(httpcode)})")
+                    if tries[dname] >= self.numtries:
+                        for other in active:
+                            self.multi.remove_handle(other)
+                            self.free_handles.append(other)
+                        raise Exception(f"Could not create directory {dname} after {tries[dname]} tries")
+                    pending.append((time.time() + backoff_delay(self.secondsBetweenRetries, tries[dname]), dname))
+                if numq == 0:
+                    break
+            if active:
+                self.multi_wait()
+
     def create_http_intermediate_dirs(self, f):
         """Create all directories that are valid prefixes of the URL *f*.
 
         """
         # Making bar/ sometimes returns a 301 status even if there doesn't seem to be a bar/ in the directory.
-        m = re.match(r"(https?://[^/]+)(/.*)", f)
+        self.load_dir_cache()
+        todo = [x for x in split_url(f)[1] if x not in self.existing_directories]
+        if not todo:
+            return
         self.curl.setopt(pycurl.CUSTOMREQUEST, 'MKCOL')
         self.curl.setopt(pycurl.WRITEFUNCTION, lambda x: None)
-        for x in miscutils.get_list_directories([m.group(2)]):
-            if x not in self.existing_directories:
-                self.curl.setopt(pycurl.URL, m.group(1) + x)
-                if self.perform(cmd=f'MKCOL {m.group(1) + x}'):
-                    self.existing_directories.add(x)
-        self.curl.unsetopt(pycurl.CUSTOMREQUEST)
+        try:
+            for x in todo:
+                self.curl.setopt(pycurl.URL, x)
+                self.perform(cmd=f'MKCOL {x}', okcodes=MKCOL_OK)
+                self.remember_dirs([x])
+        finally:
+            self.curl.unsetopt(pycurl.CUSTOMREQUEST)
         #self.curl.unsetopt(pycurl.URL)
 
 
     def get(self, verify=False):
         starttime = time.time()
+        if self.splitranges > 1 and self.filesize and self.filesize >= self.splitsize:
+            if self.get_ranges():
+                return time.time() - starttime
+        # write to a partial file (continuing any left by an earlier failure), rename when good
+        part = self.dst + PARTIAL_SUFFIX
         self.curl.setopt(pycurl.URL, self.src)
-        self.curl.setopt(pycurl.WRITEFUNCTION, open(self.dst, 'wb').write)
-        self.perform(cmd=f'Get {self.src}', verify=verify)
-        #self.curl.unsetopt(pycurl.WRITEFUNCTION)
+        self.stream = ChecksumWriter(part, resume=True, headers=self.headers)
+        try:
+            if self.filesize and self.stream.nbytes >= self.filesize:
+                if check_transfer(self.stream, self.filesize, self.md5sum) is None:
+                    self.stream.close()
+                    os.replace(part, self.dst)
+                    return time.time() - starttime
+                self.stream.restart()
+            self.curl.setopt(pycurl.WRITEFUNCTION, self.stream.write)
+            self.curl.setopt(pycurl.RESUME_FROM_LARGE, self.stream.nbytes)
+            self.perform(cmd=f'Get {self.src}', verify=verify, stream=self.stream)
+        finally:
+            self.stream.close()
+            self.curl.setopt(pycurl.WRITEFUNCTION, lambda x: None)
+            self.curl.setopt(pycurl.RESUME_FROM_LARGE, 0)
+        os.replace(part, self.dst)
         #self.curl.unsetopt(pycurl.URL)
         return time.time() - starttime
 
+    def get_ranges(self):
+        """ Fetch a large file as several byte ranges at the same time, each written into
+            place in a preallocated partial file that is renamed when complete.
+
+            Returns
+            -------
+            bool, False if the server does not support ranges (nothing was transferred)
+        """
+        nranges = int(min(self.splitranges, self.filesize // SPLIT_MIN_RANGE))
+        if nranges < 2:
+            return False
+        starttime = time.time()
+        part = self.dst + PARTIAL_SUFFIX
+        step = -(-self.filesize // nranges)
+        ranges = [{'pos': beg, 'end': min(beg + step, self.filesize) - 1,
+                   'tries': 0, 'ready_at': 0.0, 'headers': {}} for beg in range(0, self.filesize, step)]
+        fd = os.open(part, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, self.filesize)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, self.filesize)
+            supported = self.fetch_ranges(fd, ranges)
+        except:
+            os.close(fd)
+            os.remove(part)
+            raise
+        os.close(fd)
+        if not supported:
+            os.remove(part)
+            return False
+        # connection times are from the first range, rates are for the whole file
+        elapsed = time.time() - starttime
+        self.timing.update({'total_time': elapsed,
+                            'speed_download': self.filesize / elapsed if elapsed > 0 else 0.0,
+                            'retries': sum(rng['tries'] for rng in ranges) - len(ranges)})
+        self.stream = None
+        if self.md5sum:
+            md5 = hashlib.md5()
+            with open(part, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(BUFSIZE), b''):
+                    md5.update(chunk)
+            if md5.hexdigest() != self.md5sum:
+                os.remove(part)
+                raise Exception(f"md5sum mismatch for {self.dst} ({md5.hexdigest()} vs expected {self.md5sum})")
+        os.replace(part, self.dst)
+        return True
+
+    def fetch_ranges(self, fd, ranges):
+        """ Run the range requests for get_ranges on the multi handle, retrying each range
+            from where it stopped
+
+            Returns
+            -------
+            bool, False if the server ignored the range requests
+        """
+        def writer(rng):
+            def write(data):
+                if rng['headers'].get(':status') != '206':
+                    return 0    # not a partial response, abort this transfer
+                os.pwrite(fd, data, rng['pos'])
+                rng['pos'] += len(data)
+                return None
+            return write
+
+        pending = collections.deque(ranges)
+        active = {}
+        self.timing = None
+        try:
+            while pending or active:
+                now = time.time()
+                for _ in range(len(pending)):
+                    rng = pending.popleft()
+                    if rng['ready_at'] > now:
+                        pending.append(rng)
+                        continue
+                    curl = self.get_handle()
+                    if self.src.startswith('https:'):
+                        curl.setopt(pycurl.CAINFO, certifi.where())
+                    curl.setopt(pycurl.URL, self.src)
+                    curl.setopt(pycurl.HEADERFUNCTION, header_collector(rng['headers']))
+                    curl.setopt(pycurl.RANGE, f"{rng['pos']}-{rng['end']}")
+                    curl.setopt(pycurl.WRITEFUNCTION, writer(rng))
+                    rng['tries'] += 1
+                    active[curl] = rng
+                    self.multi.add_handle(curl)
+                if not active:
+                    time.sleep(max(0.0, min(x['ready_at'] for x in pending) - time.time()))
+                    continue
+                while True:
+                    ret, _ = self.multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    numq, oklist, errlist = self.multi.info_read()
+                    for (curl, exitcode, msg) in [(c, pycurl.E_OK, None) for c in oklist] + list(errlist):
+                        rng = active.pop(curl)
+                        self.multi.remove_handle(curl)
+                        httpcode = curl.getinfo(pycurl.HTTP_CODE)
+                        if self.timing is None:
+                            self.timing = curl_timing(curl)
+                        self.free_handles.append(curl)
+                        if httpcode == 200:
+                            miscutils.fwdebug_print(f"Server ignored range request for {self.src}, using a single stream")
+                            return False
+                        if exitcode == pycurl.E_OK and httpcode == 206 and rng['pos'] == rng['end'] + 1:
+                            continue
+                        if rng['tries'] >= self.numtries:
+                            raise Exception(f"Failed to get bytes {rng['pos']}-{rng['end']} of {self.src}: curl exitcode {exitcode} ({msg}), http status {httpcode} ({http_code_str(httpcode)})")
+                        rng['ready_at'] = time.time() + backoff_delay(self.secondsBetweenRetries, rng['tries'],
+                                                                      parse_retry_after(rng['headers']))
+                        pending.append(rng)
+                    if numq == 0:
+                        break
+                if active:
+                    self.multi_wait()
+        finally:
+            for curl in active:
+                self.multi.remove_handle(curl)
+                self.free_handles.append(curl)
+        return True
+
     def put(self, verify=False):
         starttime = time.time()
         self.curl.setopt(pycurl.URL, self.dst)
         #self.curl.setopt(pycurl.UPLOAD, 1)
-        self.curl.setopt(pycurl.READFUNCTION, open(self.src, 'rb').read)
-        # suppress screen output
-        self.curl.setopt(pycurl.WRITEFUNCTION, lambda x: None)
-        if self.filesize == 0:
-            self.filesize = os.path.getsize(self.src)
-        self.curl.setopt(pycurl.INFILESIZE, self.filesize)
-        self.perform(cmd=f'PUT {self.src} to {self.dst}', verify=verify, upload=True)
-        #self.curl.unsetopt(pycurl.WRITEFUNCTION)
+        self.stream = ChecksumReader(self.src)
+        try:
+            self.curl.setopt(pycurl.READFUNCTION, self.stream.read)
+            # suppress screen output
+            self.curl.setopt(pycurl.WRITEFUNCTION, lambda x: None)
+            if self.filesize == 0:
+                self.filesize = os.path.getsize(self.src)
+            self.curl.setopt(pycurl.INFILESIZE_LARGE, self.filesize)
+            self.perform(cmd=f'PUT {self.src} to {self.dst}', verify=verify, upload=True, stream=self.stream)
+        finally:
+            self.stream.close()
         #self.curl.unsetopt(pycurl.URL)
         #self.curl.unsetopt(pycurl.INFILESIZE)
         #self.curl.setopt(pycurl.UPLOAD, 0)
@@ -263,6 +1218,8 @@ class HttpUtils:
 
     def copyfiles(self, filelist, tstats, secondsBetweenRetriesC=30, numTriesC=5, verify=False):
         """ Copies files in given src,dst in filelist """
+        if self.numparallel > 1 and len(filelist) > 1:
+            return self.copyfiles_multi(filelist, tstats, secondsBetweenRetriesC, numTriesC, verify)
         num_copies_from_archive = 0
         num_copies_to_archive = 0
         total_copy_time_from_archive = 0.0
@@ -270,11 +1227,20 @@ class HttpUtils:
         status = 0
         self.secondsBetweenRetries = secondsBetweenRetriesC
         self.numtries = numTriesC
+        upload_urls = [fdict['dst'] for fdict in filelist.values() if re.match("^https?:", fdict['dst'])]
+        if upload_urls:
+            try:
+                self.create_http_dirs(upload_urls)
+            except Exception as err:
+                miscutils.fwdebug_print(f"Could not create remote directories for the batch up front ({err}), trying per file")
         try:
             for filename, fdict in filelist.items():
                 self.filesize = 0
                 if 'filesize' in fdict and fdict['filesize'] is not None:
                     self.filesize = fdict['filesize']
+                self.md5sum = fdict.get('md5sum')
+                self.stream = None
+                self.timing = None
                 try:
                     (self.src, isurl_src) = self.check_url(fdict['src'])
                     (self.dst, isurl_dst) = self.check_url(fdict['dst'])
@@ -299,7 +1265,7 @@ class HttpUtils:
                             raise Exception(f"Error: path still missing after coremakedirs ({path})")
                         copy_time = self.get(verify)
                         if tstats is not None:
-                            tstats.stat_end_file(0, self.filesize)
+                            tstats.stat_end_file(0, self.filesize, timing=self.timing)
                     elif isurl_dst:   # if remote file
                         if tstats is not None:
                             tstats.stat_beg_file(filename)
@@ -309,7 +1275,7 @@ class HttpUtils:
                         copy_time = self.put(verify)
 
                         if tstats is not None:
-                            tstats.stat_end_file(0, self.filesize)
+                            tstats.stat_end_file(0, self.filesize, timing=self.timing)
 
                     # Print some debugging info:
                     if miscutils.fwdebug_check(9, "HTTP_UTILS_DEBUG"):
@@ -324,6 +1290,9 @@ class HttpUtils:
 
                     if copy_time is None:
                         copy_time = 0
+                    elif self.stream is not None and fdict.get('md5sum') is None:
+                        # save callers from re-reading the file to get the md5sum
+                        fdict['md5sum'] = self.stream.hexdigest()
 
                     if isurl_dst:
                         num_copies_to_archive += 1
@@ -335,7 +1304,7 @@ class HttpUtils:
                 except Exception as err:
                     status = 1
                     if tstats is not None:
-                        tstats.stat_end_file(1, self.filesize)
+                        tstats.stat_end_file(1, self.filesize, timing=self.timing)
                     filelist[filename]['err'] = str(err)
                     miscutils.fwdebug_print(str(err))
 
@@ -344,3 +1313,369 @@ class HttpUtils:
 
         HttpUtils.copyfiles_called += 1
         return (status, filelist)
+
+
+    def get_controller(self, url):
+        """ The ConcurrencyController for the host of the url, None if not adaptive
+        """
+        if not self.adaptive:
+            return None
+        host = split_url(url)[0]
+        if host not in self.controllers:
+            self.controllers[host] = ConcurrencyController(host, self.numparallel,
+                                                           statefile=self.concurrencystate)
+        return self.controllers[host]
+
+    def get_handle(self):
+        """ Get an easy handle for a concurrent transfer, reusing a free one if possible
+        """
+        if self.multi is None:
+            self.multi = pycurl.CurlMulti()
+            self.multi.setopt(pycurl.M_MAXCONNECTS, self.numparallel)
+            if self.maxperhost > 0:
+                self.multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, self.maxperhost)
+        if self.free_handles:
+            curl = self.free_handles.pop()
+            curl.reset()
+        else:
+            curl = pycurl.Curl()
+        curl.setopt(pycurl.USERPWD, self.curl_password)
+        self.set_stall_options(curl)
+        return curl
+
+    def multi_wait(self):
+        """ Wait for activity on the multi handle's transfers, at most a second and no longer
+            than curl's next timeout
+        """
+        timeout = self.multi.timeout()
+        if timeout < 0:
+            timeout = 1000
+        if timeout > 0:
+            self.multi.select(min(timeout, 1000) / 1000.0)
+
+    def start_transfer(self, xfer, active):
+        """ Set up an easy handle for the given transfer and add it to the multi handle
+        """
+        curl = self.get_handle()
+        try:
+            curl.setopt(pycurl.HEADERFUNCTION, header_collector(xfer.headers))
+            if xfer.url().startswith('https:'):
+                curl.setopt(pycurl.CAINFO, certifi.where())
+            curl.setopt(pycurl.URL, xfer.url())
+            if xfer.upload:
+                xfer.fh = ChecksumReader(xfer.src)
+                curl.setopt(pycurl.UPLOAD, 1)
+                curl.setopt(pycurl.READFUNCTION, xfer.fh.read)
+                curl.setopt(pycurl.INFILESIZE_LARGE, xfer.filesize)
+                # suppress screen output
+                curl.setopt(pycurl.WRITEFUNCTION, lambda x: None)
+            else:
+                # continue any partial file unless the last try got bad data or an error
+                # response, or the partial file is already as big as (or bigger than) the file
+                xfer.fh = ChecksumWriter(xfer.partial, resume=True, headers=xfer.headers)
+                if xfer.restart or (xfer.filesize and xfer.fh.nbytes >= xfer.filesize):
+                    xfer.fh.restart()
+                xfer.restart = False
+                curl.setopt(pycurl.WRITEFUNCTION, xfer.fh.write)
+                curl.setopt(pycurl.RESUME_FROM_LARGE, xfer.fh.nbytes)
+        except:
+            if xfer.fh is not None:
+                xfer.fh.close()
+            self.free_handles.append(curl)
+            raise
+        xfer.tries += 1
+        xfer.try_start = time.time()
+        if xfer.starttime is None:
+            xfer.starttime = xfer.try_start
+        active[curl] = xfer
+        self.multi.add_handle(curl)
+
+    def finish_transfer(self, curl, active, exitcode, msg, verify):
+        """ Release the handle of a completed transfer and check the result
+
+            Returns
+            -------
+            tuple of the transfer and the error message (None on success)
+        """
+        xfer = active.pop(curl)
+        self.multi.remove_handle(curl)
+        xfer.fh.close()
+        httpcode = curl.getinfo(pycurl.HTTP_CODE)
+        clen = curl.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
+        xfer.httpcode = httpcode
+        if exitcode == pycurl.E_OPERATION_TIMEDOUT:
+            xfer.stalls += 1
+            msg = f"{msg}, stalled (see http_low_speed_limit, http_low_speed_time, http_connect_timeout)"
+        xfer.timing = curl_timing(curl, xfer.tries - 1, xfer.stalls)
+        self.free_handles.append(curl)
+        if is_http_error(httpcode):
+            # don't resume after an error response (e.g., 416 for a range past the end)
+            xfer.restart = True
+        if exitcode == pycurl.E_OK and httpcode in HTTP_OK:
+            filesize = xfer.filesize
+            if not filesize and verify and clen is not None and clen >= 0:
+                # size not known ahead of time, use what the server said it was sending
+                filesize = int(clen) + xfer.fh.start
+            msg = check_transfer(xfer.fh, filesize, xfer.md5sum)
+            if msg is None:
+                if not xfer.upload:
+                    os.replace(xfer.fh.path, xfer.dst)
+                return xfer, None
+            exitcode = -1
+            xfer.restart = True
+
+        miscutils.fwdebug_print("*" * 75)
+        miscutils.fwdebug_print("CURL FAILURE")
+        miscutils.fwdebug_print(f"curl command: {'PUT' if xfer.upload else 'Get'} {xfer.url()}")
+        miscutils.fwdebug_print(f"curl exitcode: {exitcode} ({msg})")
+        errmsg = f"Curl operation failed with return code {exitcode:d} ({msg}), "
+        if httpcode:
+            miscutils.fwdebug_print(f"curl http status: {httpcode} ({http_code_str(httpcode)})")
+            errmsg += f" http status {httpcode} ({http_code_str(httpcode)})"
+        else:
+            miscutils.fwdebug_print("curl http status: unknown")
+            errmsg += " http status unknown"
+        return xfer, errmsg
+
+    def cancel_transfer(self, xfer, active):
+        """ Stop the transfer if still running (the losing half of a hedged download) and
+            remove its partial file
+        """
+        for curl, other in list(active.items()):
+            if other is xfer:
+                del active[curl]
+                self.multi.remove_handle(curl)
+                self.free_handles.append(curl)
+                break
+        if xfer.fh is not None:
+            xfer.fh.close()
+            try:
+                os.remove(xfer.partial)
+            except OSError:
+                pass
+
+    def copyfiles_multi(self, filelist, tstats, secondsBetweenRetriesC=30, numTriesC=5, verify=False):
+        """ Copies files in given src,dst in filelist, running up to numparallel transfers at
+            the same time on a CurlMulti handle.   Failed transfers are retried after an
+            exponential backoff (within the per file retry budget) without holding up the rest
+            of the batch.   Straggling small downloads may get a hedged duplicate request (see
+            HEDGE_PERCENTILE).  Reports per file errors and transfer stats the same way as
+            copyfiles.
+        """
+        num_copies_from_archive = 0
+        num_copies_to_archive = 0
+        total_copy_time_from_archive = 0.0
+        total_copy_time_to_archive = 0.0
+        status = 0
+        self.secondsBetweenRetries = secondsBetweenRetriesC
+        self.numtries = numTriesC
+        pending = collections.deque()
+        active = {}
+        upload_urls = [fdict['dst'] for fdict in filelist.values() if re.match("^https?:", fdict['dst'])]
+        if upload_urls:
+            try:
+                self.create_http_dirs(upload_urls)
+            except Exception as err:
+                miscutils.fwdebug_print(f"Could not create remote directories for the batch up front ({err}), trying per file")
+        # seconds taken by the successful tries of downloads small enough to hedge
+        durations = []
+        # a batch goes to or from a single archive server
+        controller = None
+        for fdict in filelist.values():
+            url = fdict['dst'] if re.match("^https?:", fdict['dst']) else fdict['src']
+            if re.match("^https?:", url):
+                controller = self.get_controller(url)
+                break
+
+        def done(xfer, err=None):
+            nonlocal status, num_copies_from_archive, num_copies_to_archive
+            nonlocal total_copy_time_from_archive, total_copy_time_to_archive
+            if xfer.timing is not None:
+                xfer.timing.update({'stalls': xfer.stalls, 'hedges': xfer.hedges})
+            if err is not None:
+                status = 1
+                if tstats is not None:
+                    tstats.stat_end_file(1, xfer.filesize, xfer.task_id, xfer.timing)
+                filelist[xfer.filename]['err'] = err
+                miscutils.fwdebug_print(err)
+                return
+            copy_time = time.time() - xfer.starttime
+            if controller is not None:
+                controller.completed(xfer.filesize, (xfer.timing or {}).get('starttransfer_time'))
+            if xfer.fh is not None and filelist[xfer.filename].get('md5sum') is None:
+                # save callers from re-reading the file to get the md5sum
+                filelist[xfer.filename]['md5sum'] = xfer.fh.hexdigest()
+            if tstats is not None:
+                tstats.stat_end_file(0, xfer.filesize, xfer.task_id, xfer.timing)
+            if xfer.tries > 1:
+                print(f"Transfer took {xfer.tries} tries to succeed")
+            if miscutils.fwdebug_check(3, "HTTP_UTILS_DEBUG"):
+                miscutils.fwdebug_print(f"Copy info: {HttpUtils.copyfiles_called} {filelist[xfer.filename]['filename']} {xfer.filesize} {copy_time} {time.time()} {'toarchive' if xfer.upload else 'fromarchive'}")
+            if xfer.upload:
+                num_copies_to_archive += 1
+                total_copy_time_to_archive += copy_time
+            else:
+                num_copies_from_archive += 1
+                total_copy_time_from_archive += copy_time
+
+        try:
+            for filename, fdict in filelist.items():
+                filesize = 0
+                task_id = None
+                if 'filesize' in fdict and fdict['filesize'] is not None:
+                    filesize = fdict['filesize']
+                try:
+                    (src, isurl_src) = self.check_url(fdict['src'])
+                    (dst, isurl_dst) = self.check_url(fdict['dst'])
+                    if (isurl_src and isurl_dst) or (not isurl_src and not isurl_dst):
+                        miscutils.fwdie(f"Exactly one of isurl_src and isurl_dst has to be true (values: {isurl_src}, {src}, {isurl_dst}, {dst}",
+                                        fmdefs.FM_EXIT_FAILURE)
+                    # if local file and file already exists there is nothing to do
+                    if not isurl_dst and os.path.exists(dst):
+                        num_copies_from_archive += 1
+                        continue
+                    if isurl_dst and filesize == 0:
+                        filesize = os.path.getsize(src)
+                    xfer = HttpTransfer(filename, src, dst, filesize, isurl_dst, fdict.get('md5sum'))
+                    if tstats is not None:
+                        xfer.task_id = task_id = tstats.stat_beg_file(filename)
+                    if isurl_dst:
+                        # create remote paths
+                        self.create_http_intermediate_dirs(dst)
+                    else:
+                        # make the path
+                        path = os.path.dirname(dst)
+                        if path and not os.path.exists(path):
+                            miscutils.coremakedirs(path)
+                        if path and not os.path.exists(path):
+                            raise Exception(f"Error: path still missing after coremakedirs ({path})")
+                        if self.splitranges > 1 and filesize >= self.splitsize:
+                            # large file, fetched by itself in several ranges at once
+                            (self.src, self.dst, self.filesize, self.md5sum) = (src, dst, filesize, xfer.md5sum)
+                            (xfer.starttime, xfer.tries) = (time.time(), 1)
+                            if self.get_ranges():
+                                xfer.timing = self.timing
+                                done(xfer)
+                                continue
+                    pending.append(xfer)
+                except Exception as err:
+                    status = 1
+                    if tstats is not None:
+                        tstats.stat_end_file(1, filesize, task_id)
+                    filelist[filename]['err'] = str(err)
+                    miscutils.fwdebug_print(str(err))
+
+            while pending or active:
+                # start any transfers that are ready, up to the concurrency limit
+                now = time.time()
+                limit = self.numparallel if controller is None else controller.limit
+                for _ in range(len(pending)):
+                    if len(active) >= limit:
+                        break
+                    xfer = pending.popleft()
+                    if xfer.ready_at > now:
+                        pending.append(xfer)
+                        continue
+                    try:
+                        self.start_transfer(xfer, active)
+                    except Exception as err:
+                        done(xfer, str(err))
+
+                if not active:
+                    if pending:
+                        time.sleep(max(0.0, min(x.ready_at for x in pending) - time.time()))
+                    continue
+
+                # use free handles to duplicate downloads that are taking much longer than usual
+                if self.hedgesize > 0 and len(durations) >= HEDGE_MIN_SAMPLES and len(active) < limit:
+                    slow = time.time() - percentile(durations, self.hedgepercentile)
+                    for xfer in sorted(active.values(), key=lambda x: x.try_start):
+                        if len(active) >= limit or xfer.try_start > slow:
+                            break
+                        if xfer.upload or xfer.hedges or xfer.primary is not None or \
+                           not xfer.filesize or xfer.filesize > self.hedgesize:
+                            continue
+                        xfer.hedge = xfer.duplicate()
+                        xfer.hedges += 1
+                        try:
+                            self.start_transfer(xfer.hedge, active)
+                        except Exception as err:
+                            miscutils.fwdebug_print(f"Could not start duplicate request for {xfer.filename} ({err})")
+                            xfer.hedge = None
+
+                while True:
+                    ret, _ = self.multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    numq, oklist, errlist = self.multi.info_read()
+                    finished = [(c, pycurl.E_OK, None) for c in oklist] + list(errlist)
+                    for (curl, exitcode, msg) in finished:
+                        if curl not in active:
+                            continue    # the other half of a hedged download already won
+                        xfer, err = self.finish_transfer(curl, active, exitcode, msg, verify)
+                        if err is None and xfer.filesize and xfer.filesize <= self.hedgesize:
+                            durations.append(time.time() - xfer.try_start)
+                        primary = xfer.primary or xfer
+                        if primary.hedge is not None:
+                            other = primary.hedge if xfer is primary else primary
+                            running = any(x is other for x in active.values())
+                            if err is None:
+                                # first one done wins
+                                self.cancel_transfer(other, active)
+                                primary.hedge = None
+                                (primary.fh, primary.timing) = (xfer.fh, xfer.timing)
+                                primary.stalls += other.stalls if xfer is primary else xfer.stalls
+                                done(primary)
+                                continue
+                            if running:
+                                # the other one may still succeed
+                                xfer.err = err
+                                continue
+                            # both failed, retry as an ordinary transfer
+                            hedge = primary.hedge
+                            primary.hedge = None
+                            primary.stalls += hedge.stalls
+                            self.cancel_transfer(hedge, active)
+                            (err, primary.err) = (primary.err or err, None)
+                            xfer = primary
+                        if err is None:
+                            done(xfer)
+                            continue
+                        if controller is not None and xfer.httpcode is not None and \
+                           (xfer.httpcode == 429 or xfer.httpcode >= 500):
+                            controller.overloaded(xfer.httpcode)
+                        delay = None
+                        if xfer.tries < self.numtries:
+                            delay = self.retry_wait(xfer.tries, xfer.waited, xfer.headers)
+                        if delay is None:
+                            self.diagnostics(f"{'PUT' if xfer.upload else 'Get'} {xfer.url()}", xfer.url())
+                            done(xfer, err)
+                            continue
+                        if xfer.upload and xfer.httpcode == 409:
+                            # parent directory is missing, the directory cache was out of date
+                            self.forget_dirs(xfer.dst)
+                            try:
+                                self.create_http_intermediate_dirs(xfer.dst)
+                            except Exception as direrr:
+                                miscutils.fwdebug_print(str(direrr))
+                        miscutils.fwdebug_print(f"Retrying {xfer.filename} in {delay:.1f} secs")
+                        xfer.waited += delay
+                        xfer.ready_at = time.time() + delay
+                        pending.append(xfer)
+                    if numq == 0:
+                        break
+                if active:
+                    self.multi_wait()
+        finally:
+            # do not leave handles attached if an exception is propagating
+            for curl, xfer in list(active.items()):
+                self.multi.remove_handle(curl)
+                xfer.fh.close()
+                self.free_handles.append(curl)
+            if controller is not None:
+                controller.save()
+            print(f"[Copy summary] copy_batch:{HttpUtils.copyfiles_called:d}  file_copies_to_archive:{num_copies_to_archive:d} time_to_archive:{total_copy_time_to_archive:.3f} copies_from_archive:{num_copies_from_archive:d} time_from_archive:{total_copy_time_from_archive:.3f}  end_time_for_batch:{time.time():3f}")
+
+        HttpUtils.copyfiles_called += 1
+        return (status, filelist)
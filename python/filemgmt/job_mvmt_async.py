@@ -0,0 +1,83 @@
+"""
+    Background job2home for the job file movement classes, so a wrapper's outputs can be
+    uploaded while the next wrapper runs.
+"""
+
+import os
+import copy
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncJob2Home:
+    """ Mixin adding job2home_async to a job file movement class
+
+        The class must do its transfers with self.HU and self.tstats and have a
+        new_http_utils method.   Uploads run one batch at a time in the order they were
+        started, each with its own HttpUtils and tstats batch so they don't share state
+        with the transfers the job does meanwhile.
+    """
+    upload_pool = None
+    upload_hu = None
+    pending = None
+
+    def job2home_async(self, filelist, verify=False):
+        """ Start uploading files from the job scratch directory to the home archive in
+            the background
+
+            Returns
+            -------
+            concurrent.futures.Future whose result is what job2home would have returned
+        """
+        if self.upload_pool is None:
+            self.upload_pool = ThreadPoolExecutor(max_workers=1)
+            self.upload_hu = self.new_http_utils()
+            self.pending = []
+        worker = copy.copy(self)
+        worker.HU = self.upload_hu
+        if self.tstats is not None:
+            worker.tstats = self.tstats.batch_copy()
+        future = self.upload_pool.submit(self.upload, worker, copy.deepcopy(filelist), verify)
+        self.pending.append(({os.path.normpath(x['dst']) for x in filelist.values()}, future))
+        return future
+
+    @staticmethod
+    def upload(worker, filelist, verify):
+        """ job2home in the upload thread, then release the worker's tstats batch copy """
+        try:
+            return worker.job2home(filelist, verify)
+        finally:
+            if worker.tstats is not None:
+                worker.tstats.end_batch_copy()
+
+    def wait_job2home(self, filelist=None):
+        """ Wait for background uploads: all of them, or only as far as needed for the
+            files in filelist (by src, relative to the home archive as in home2job)
+
+            Returns
+            -------
+            dict, combined results of the uploads waited for (same as from job2home)
+
+            If an upload raised, the exception is raised once all of the uploads waited
+            for are done.
+        """
+        results = {}
+        if not self.pending:
+            return results
+        last = len(self.pending)
+        if filelist is not None:
+            wanted = {os.path.normpath(x['src']) for x in filelist.values()}
+            last = 0
+            for (i, (dsts, _)) in enumerate(self.pending):
+                if dsts & wanted:
+                    last = i + 1
+        # uploads run in order, so waiting for the last one needed covers those before it
+        done = self.pending[:last]
+        self.pending = self.pending[last:]
+        concurrent.futures.wait([future for (_, future) in done])
+        errors = [future.exception() for (_, future) in done if future.exception() is not None]
+        if errors:
+            raise errors[0]
+        for (_, future) in done:
+            results.update(future.result())
+        return results
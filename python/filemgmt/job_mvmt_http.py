@@ -13,11 +13,13 @@ import os
 
 import despymisc.miscutils as miscutils
 import filemgmt.http_utils as http_utils
+import filemgmt.node_cache as node_cache
+import filemgmt.job_mvmt_async as job_mvmt_async
 
 DES_SERVICES = 'des_services'
 DES_HTTP_SECTION = 'des_http_section'
 
-class JobArchiveHttp:
+class JobArchiveHttp(job_mvmt_async.AsyncJob2Home):
     """
     """
     # assumes home, target, and job dirs are read/write same machine
@@ -36,8 +38,17 @@ class JobArchiveHttp:
         for x in (DES_SERVICES, DES_HTTP_SECTION):
             if x not in self.config:
                 miscutils.fwdie(f'Error:  Missing {x} in config', 1)
-        self.HU = http_utils.HttpUtils(self.config[DES_SERVICES],
-                                       self.config[DES_HTTP_SECTION])
+        # concurrent transfers and the directory cache are configured through the file movement config
+        self.HU = self.new_http_utils()
+        # inputs shared by the jobs on a node (e.g., calibrations) are fetched once per node
+        self.cache = node_cache.from_config(self.mvmt)
+
+
+    def new_http_utils(self):
+        """ HttpUtils configured from the file movement config """
+        return http_utils.HttpUtils(self.config[DES_SERVICES],
+                                    self.config[DES_HTTP_SECTION],
+                                    **http_utils.options_from_config(self.mvmt))
 
 
     def home2job(self, filelist):
@@ -45,13 +56,21 @@ class JobArchiveHttp:
         if self.home is None:
             raise Exception("Home archive info is None.   Should not be calling this function")
 
+        # outputs of earlier steps still being uploaded in the background
+        self.wait_job2home(filelist)
+
         absfilelist = copy.deepcopy(filelist)
         for finfo in absfilelist.values():
             finfo['src'] = os.path.join(self.home['root_http'], finfo['src'])
 
         if self.tstats is not None:
             self.tstats.stat_beg_batch('home2job', self.home['name'], 'job_scratch', self.__module__ + '.' + self.__class__.__name__)
-        (status, results) = self.HU.copyfiles(absfilelist, self.tstats)
+        if self.cache is not None:
+            (status, results) = self.cache.copyfiles(absfilelist,
+                                                     lambda files: self.HU.copyfiles(files, self.tstats),
+                                                     self.tstats)
+        else:
+            (status, results) = self.HU.copyfiles(absfilelist, self.tstats)
         if self.tstats is not None:
             self.tstats.stat_end_batch(status)
         return results
@@ -15,12 +15,14 @@ import os
 
 import despymisc.miscutils as miscutils
 import filemgmt.http_utils as http_utils
+import filemgmt.node_cache as node_cache
+import filemgmt.job_mvmt_async as job_mvmt_async
 import filemgmt.disk_utils_local as disk_utils_local
 
 DES_SERVICES = 'des_services'
 DES_HTTP_SECTION = 'des_http_section'
 
-class JobArchiveHttpCp:
+class JobArchiveHttpCp(job_mvmt_async.AsyncJob2Home):
     """
         Use http for transfers between job and home archive, and
         cp between job and target archive
@@ -42,8 +44,16 @@ class JobArchiveHttpCp:
         for reqkey in (DES_SERVICES, DES_HTTP_SECTION):
             if reqkey not in self.config:
                 miscutils.fwdie(f'Error:  Missing {reqkey} in config', 1)
-        self.HU = http_utils.HttpUtils(self.config[DES_SERVICES],
-                                       self.config[DES_HTTP_SECTION])
+        # concurrent transfers and the directory cache are configured through the file movement config
+        self.HU = self.new_http_utils()
+        # inputs shared by the jobs on a node (e.g., calibrations) are fetched once per node
+        self.cache = node_cache.from_config(self.mvmt)
+
+    def new_http_utils(self):
+        """ HttpUtils configured from the file movement config """
+        return http_utils.HttpUtils(self.config[DES_SERVICES],
+                                    self.config[DES_HTTP_SECTION],
+                                    **http_utils.options_from_config(self.mvmt))
 
     def home2job(self, filelist):
         """ From inside job, pull files from home archive to job scratch directory """
@@ -55,6 +65,9 @@ class JobArchiveHttpCp:
         if self.home is None:
             raise Exception("Home archive info is None.   Should not be calling this function")
 
+        # outputs of earlier steps still being uploaded in the background
+        self.wait_job2home(filelist)
+
         absfilelist = copy.deepcopy(filelist)
         for finfo in absfilelist.values():
             finfo['src'] = os.path.join(self.home['root_http'], finfo['src'])
@@ -62,7 +75,12 @@ class JobArchiveHttpCp:
         if self.tstats is not None:
             self.tstats.stat_beg_batch('home2job', self.home['name'], 'job_scratch',
                                        self.__module__ + '.' + self.__class__.__name__)
-        (status, results) = self.HU.copyfiles(absfilelist, self.tstats)
+        if self.cache is not None:
+            (status, results) = self.cache.copyfiles(absfilelist,
+                                                     lambda files: self.HU.copyfiles(files, self.tstats),
+                                                     self.tstats)
+        else:
+            (status, results) = self.HU.copyfiles(absfilelist, self.tstats)
         if self.tstats is not None:
             self.tstats.stat_end_batch(status)
         return results
@@ -121,7 +139,7 @@ class JobArchiveHttpCp:
         if self.tstats is not None:
             self.tstats.stat_beg_batch('job2home', 'job_scratch', self.home['name'],
                                        self.__module__ + '.' + self.__class__.__name__)
-        (status, results) = self.HU.copyfiles(absfilelist, self.tstats, verify)
+        (status, results) = self.HU.copyfiles(absfilelist, self.tstats, verify=verify)
         if self.tstats is not None:
             self.tstats.stat_end_batch(status)
         return results
@@ -47,7 +47,8 @@ class JobArchiveLocal:
 
         if self.tstats is not None:
             self.tstats.stat_beg_batch('home2job', self.home['name'], 'job_scratch', self.__module__ + '.' + self.__class__.__name__)
-        (status, results) = disk_utils_local.copyfiles(absfilelist, self.tstats)
+        (status, results) = disk_utils_local.copyfiles(absfilelist, self.tstats,
+                                                       methods=disk_utils_local.INPUT_PLACEMENT)
         if self.tstats is not None:
             self.tstats.stat_end_batch(status)
         return results
@@ -65,7 +66,8 @@ class JobArchiveLocal:
             finfo['src'] = os.path.join(self.target['root'], finfo['src'])
         if self.tstats is not None:
             self.tstats.stat_beg_batch('target2job', self.target['name'], 'job_scratch', self.__module__ + '.' + self.__class__.__name__)
-        (status, results) = disk_utils_local.copyfiles(absfilelist, self.tstats)
+        (status, results) = disk_utils_local.copyfiles(absfilelist, self.tstats,
+                                                       methods=disk_utils_local.INPUT_PLACEMENT)
         if self.tstats is not None:
             self.tstats.stat_end_batch(status)
         return results
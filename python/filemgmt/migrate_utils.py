@@ -158,7 +158,8 @@ class Migration(fmutils.FileManager):
                 upsql = "update file_archive_info set path=:pth where filename=:fn and compression is NULL"
                 curs.executemany(upsql, self.results['null'])
             if self.pfwid:
-                curs.execute(f"update pfw_attempt set archive_path='{newpath}' where id={self.pfwid}")
+                curs.execute("update pfw_attempt set archive_path=:apath where id=:pfwid",
+                             {'apath': newpath, 'pfwid': self.pfwid})
                 if self.chown:
                     subp = subprocess.Popen(['sudo', f"{os.environ['FILEMGMT_DIR']}/bin/chown.sh", newarchpath])
                     while subp.poll() is None:
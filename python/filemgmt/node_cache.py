@@ -0,0 +1,259 @@
+"""
+    Node-local cache of input files shared by the jobs running on a node, so a file
+    staged in by one job (e.g., calibration files) is not fetched again by the others.
+
+    Entries are stored as <cachedir>/<md5sum or size>/<filename>, so a file is only reused
+    for a request with the same md5sum (or, when no md5sum is known, the same size).   A
+    job fetching a file holds a lock on the entry so other jobs wait for it instead of
+    fetching the same file, entries are added by atomic rename, and the least recently
+    used ones are removed when the cache grows past its size budget.
+"""
+
+import os
+import fcntl
+import time
+
+import despymisc.miscutils as miscutils
+import filemgmt.disk_utils_local as disk_utils_local
+
+# optional keys in the file movement config (mvmtinfo)
+NODE_CACHE_DIR = 'node_cache_dir'
+NODE_CACHE_SIZE = 'node_cache_size'
+
+# default size budget in bytes, eviction brings the cache down to LOW_WATER of the budget
+DEFAULT_CACHE_SIZE = 20 * 1024 ** 3
+LOW_WATER = 0.9
+
+# temporary files older than this (seconds) were left by a job that died and are removed
+STALE_TMP = 86400
+
+
+def from_config(mvmtinfo):
+    """ The NodeCache configured in the file movement config, None if there isn't one """
+    if not mvmtinfo or not mvmtinfo.get(NODE_CACHE_DIR):
+        return None
+    budget = DEFAULT_CACHE_SIZE
+    if NODE_CACHE_SIZE in mvmtinfo:
+        budget = int(mvmtinfo[NODE_CACHE_SIZE])
+    return NodeCache(mvmtinfo[NODE_CACHE_DIR], budget)
+
+
+class NodeCache:
+    """ Node-local input file cache
+
+        Parameters
+        ----------
+        cachedir : str
+            The cache directory, shared by the jobs on the node
+        budget : int
+            Max total bytes of the cached files
+    """
+    def __init__(self, cachedir, budget=DEFAULT_CACHE_SIZE):
+        self.cachedir = cachedir
+        self.budget = budget
+        os.makedirs(cachedir, exist_ok=True)
+
+    def entry_path(self, finfo):
+        """ Path of the cache entry for the file, None if it can't be cached (no md5sum or size)
+        """
+        fname = finfo.get('filename') or os.path.basename(finfo['dst'])
+        if finfo.get('md5sum'):
+            ident = finfo['md5sum']
+        elif finfo.get('filesize'):
+            ident = f"size{finfo['filesize']}"
+        else:
+            return None
+        return os.path.join(self.cachedir, ident, fname)
+
+    @staticmethod
+    def lock(entry, block):
+        """ Lock the entry (for fetching it)
+
+            Returns
+            -------
+            open lock file (close to unlock), None if not blocking and another job has it
+        """
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fh = open(entry + '.lock', 'a')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            if block:
+                raise
+            return None
+        return fh
+
+    def use(self, entry, finfo):
+        """ Put the cached copy of the file at finfo's dst
+
+            Returns
+            -------
+            bool, False if the entry isn't in the cache
+        """
+        if finfo.get('filesize') and not finfo.get('md5sum'):
+            try:
+                if os.path.getsize(entry) != finfo['filesize']:
+                    return False
+            except OSError:
+                return False
+        dst = finfo['dst']
+        path = os.path.dirname(dst)
+        if path and not os.path.exists(path):
+            miscutils.coremakedirs(path)
+        try:
+            disk_utils_local.place_file(entry, dst)
+        except FileNotFoundError:
+            return False
+        try:
+            os.utime(entry)    # most recently used
+        except OSError:
+            pass
+        return True
+
+    def add(self, entry, src):
+        """ Add a fetched file to the cache (atomically, never a partial entry) """
+        tmpname = f"{entry}.{os.getpid()}.tmp"
+        try:
+            disk_utils_local.place_file(src, tmpname)
+            os.replace(tmpname, entry)
+        except OSError as err:
+            miscutils.fwdebug_print(f"Could not add {src} to the node cache ({err})")
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+    def copyfiles(self, filelist, fetch, tstats=None):
+        """ Put the files in filelist at their dst, using the cached copies where there are
+            any and calling fetch for the rest (adding them to the cache)
+
+            Parameters
+            ----------
+            filelist : dict
+                Same as for HttpUtils.copyfiles (src, dst, filesize, md5sum per file)
+            fetch : function
+                Called with a filelist of the files not in the cache, returns (status, results)
+                like HttpUtils.copyfiles
+            tstats : object
+                Transfer stats object to report the cache hits and misses to
+
+            Returns
+            -------
+            tuple of the status and filelist, same as HttpUtils.copyfiles
+        """
+        hits = {}
+        tofetch = {}
+        waiting = {}
+        locks = {}
+        # fetching fills in missing md5sums, so remember the entries from before it
+        entries = {}
+        status = 0
+        try:
+            for fname, finfo in filelist.items():
+                entry = entries[fname] = self.entry_path(finfo)
+                if entry is None or os.path.exists(finfo['dst']):
+                    tofetch[fname] = finfo
+                elif self.use(entry, finfo):
+                    hits[fname] = finfo
+                else:
+                    locks[fname] = self.lock(entry, block=False)
+                    if locks[fname] is None:
+                        # another job is fetching it
+                        del locks[fname]
+                        waiting[fname] = finfo
+                    else:
+                        tofetch[fname] = finfo
+
+            if tofetch:
+                (status, _) = fetch(tofetch)
+                self.add_fetched(tofetch, entries, locks)
+
+            # files other jobs were fetching, should be in the cache by now.   Locks are
+            # taken in entry order and let go of right after a hit, so jobs waiting on the
+            # same entries can't each hold one the other is waiting for.
+            retry = {}
+            for fname in sorted(waiting, key=lambda x: entries[x]):
+                finfo = waiting[fname]
+                lock = self.lock(entries[fname], block=True)
+                if self.use(entries[fname], finfo):
+                    hits[fname] = finfo
+                    lock.close()
+                else:
+                    locks[fname] = lock
+                    retry[fname] = finfo
+            if retry:
+                (status2, _) = fetch(retry)
+                status = status or status2
+                self.add_fetched(retry, entries, locks)
+                tofetch.update(retry)
+        finally:
+            for fh in locks.values():
+                fh.close()
+
+        if tstats is not None:
+            tstats.stat_cache_batch(len(hits), sum(x.get('filesize') or 0 for x in hits.values()),
+                                    len(tofetch), sum(x.get('filesize') or 0 for x in tofetch.values()))
+        if miscutils.fwdebug_check(3, "NODE_CACHE_DEBUG"):
+            miscutils.fwdebug_print(f"node cache: {len(hits)} hits, {len(tofetch)} misses")
+        self.evict()
+        return (status, filelist)
+
+    def add_fetched(self, fetched, entries, locks):
+        """ Add the successfully fetched files to the cache and unlock their entries """
+        for fname, finfo in fetched.items():
+            if fname in locks:
+                if 'err' not in finfo and os.path.exists(finfo['dst']):
+                    self.add(entries[fname], finfo['dst'])
+                locks.pop(fname).close()
+
+    def evict(self):
+        """ Remove the least recently used entries if the cache is over its budget """
+        entries = []
+        total = 0
+        now = time.time()
+        for identdir in os.scandir(self.cachedir):
+            if not identdir.is_dir():
+                continue
+            # other jobs add, rename, and remove entries while this runs, skip any that go away
+            try:
+                ents = list(os.scandir(identdir.path))
+            except OSError:
+                continue
+            for ent in ents:
+                if ent.name.endswith('.lock'):
+                    continue
+                try:
+                    stat = ent.stat()
+                    if ent.name.endswith('.tmp'):
+                        if now - stat.st_mtime > STALE_TMP:
+                            os.remove(ent.path)
+                        continue
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, ent.path))
+                total += stat.st_size
+        if total <= self.budget:
+            return
+        # one job evicting at a time is enough
+        with open(os.path.join(self.cachedir, '.evict.lock'), 'a') as lockfh:
+            try:
+                fcntl.flock(lockfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            for (_, size, path) in sorted(entries):
+                if total <= self.budget * LOW_WATER:
+                    break
+                # skip entries being fetched
+                lock = self.lock(path, block=False)
+                if lock is None:
+                    continue
+                # the lock file stays, other jobs may be waiting on it (and a new lock
+                # file would let a second job lock the same entry)
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+                finally:
+                    lock.close()
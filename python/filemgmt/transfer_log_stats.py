@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+""" Summarize file transfer stats from job logs: the "Copy info:" lines http_utils prints
+    with HTTP_UTILS_DEBUG=3 and condor user logs (job run times).   Replaces the scripts in
+    transfer_stats_utils and works on whole campaigns instead of one exposure.
+
+    Logs are read a line at a time (plain or gzipped) by a pool of processes, one log file
+    per task, so memory doesn't grow with the size of the logs.   Per filename copy counts
+    (for the repeated copy histogram) could be as many as the copy lines, so workers write
+    them to partition files on disk (by hash of the filename) which are then summed one
+    partition at a time.
+
+    Example
+    -------
+        python -m filemgmt.transfer_log_stats --condor_logs 'runtime/**/runjob.log' \\
+            --wall_log runtime/uberctrl/D00229228_r1p1_mainmngr.dag.dagman.log runtime
+"""
+
+import os
+import re
+import sys
+import glob
+import gzip
+import json
+import zlib
+import shutil
+import argparse
+import datetime
+import fnmatch
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+COPY_INFO = b'Copy info:'
+DIRECTIONS = ('fromarchive', 'toarchive')
+
+# Copy info: <copyfiles call number> <filename> <filesize> <copy secs> <epoch> <direction>
+COPY_RE = re.compile(r"Copy info: (\d+) (\S+) (\S+) (\S+) (\S+) (fromarchive|toarchive)")
+
+# condor user log event: <code> (<job id>) <MM/DD or YYYY-MM-DD> <HH:MM:SS> <text>
+CONDOR_RE = re.compile(r"^(\d\d\d) \((\S+)\) (\d\d/\d\d|\d{4}-\d\d-\d\d) (\d\d:\d\d:\d\d)")
+CONDOR_EXECUTE = '001'
+CONDOR_TERMINATE = '005'
+
+DEFAULT_PARTITIONS = 64
+
+# directory and number of the partition files, set in each worker process
+_partdir = None
+_partitions = DEFAULT_PARTITIONS
+_partfhs = {}
+
+
+def open_log(filename):
+    """ Open a log file for binary reading (gzipped if it ends in .gz) """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def expand_paths(paths, pattern=None):
+    """ Files for the given files, directories (all files under them) and glob patterns
+
+        Parameters
+        ----------
+        paths : list
+            Files, directories and glob patterns (** matches any depth)
+        pattern : str
+            Only files under the directories whose names match this glob pattern
+    """
+    for path in paths:
+        for match in sorted(glob.glob(path, recursive=True)) or [path]:
+            if os.path.isdir(match):
+                for (dirpath, _, filenames) in os.walk(match):
+                    for fname in sorted(filenames):
+                        if pattern is None or fnmatch.fnmatch(fname, pattern):
+                            yield os.path.join(dirpath, fname)
+            else:
+                yield match
+
+
+def new_copy_stats():
+    """ Empty totals of copy info lines """
+    return {'log_files': 0, 'copy_lines': 0, 'bad_lines': 0, 'num_copies': 0,
+            'num_files': {d: 0 for d in DIRECTIONS},
+            'num_bytes': {d: 0 for d in DIRECTIONS},
+            'time_used': {d: 0.0 for d in DIRECTIONS}}
+
+
+def new_job_stats():
+    """ Empty totals of condor job run times """
+    return {'log_files': 0, 'num_jobs': 0, 'total_time': 0, 'max_time': 0,
+            'unmatched': 0, 'histogram': {}}
+
+
+def partition_fh(filename):
+    """ This worker's partition file for the filename """
+    part = zlib.crc32(filename.encode()) % _partitions
+    if part not in _partfhs:
+        _partfhs[part] = open(os.path.join(_partdir, f"part{part}.{os.getpid()}"), 'a',
+                              encoding='utf-8')
+    return _partfhs[part]
+
+
+def init_worker(partdir, partitions):
+    """ Process pool initializer, where to put the per filename copy counts """
+    global _partdir, _partitions
+    _partdir = partdir
+    _partitions = partitions
+    _partfhs.clear()
+
+
+def scan_copy_log(filename):
+    """ Sum the copy info lines in a log file, writing the per filename counts to the
+        partition files
+
+        Returns
+        -------
+        dict, same as new_copy_stats
+    """
+    stats = new_copy_stats()
+    stats['log_files'] = 1
+    # copyfiles call numbers seen (each call is a batch of copies)
+    calls = set()
+    # per filename (and direction) counts for this log, [num copies, bytes]
+    counts = {}
+    with open_log(filename) as logfh:
+        for line in logfh:
+            if COPY_INFO not in line:
+                continue
+            match = COPY_RE.search(line.decode('utf-8', 'replace'))
+            if match is None:
+                stats['bad_lines'] += 1
+                continue
+            (call, fname, size, secs, _, direction) = match.groups()
+            try:
+                size = int(size)
+            except ValueError:
+                size = 0    # size None when the transfer failed before it was known
+            try:
+                secs = float(secs)
+            except ValueError:
+                secs = 0.0
+            stats['copy_lines'] += 1
+            calls.add(call)
+            stats['num_files'][direction] += 1
+            stats['num_bytes'][direction] += size
+            stats['time_used'][direction] += secs
+            cnt = counts.setdefault((fname, direction), [0, 0])
+            cnt[0] += 1
+            cnt[1] += size
+    stats['num_copies'] = len(calls)
+
+    if _partdir is not None:
+        for ((fname, direction), (num, nbytes)) in counts.items():
+            partition_fh(fname).write(f"{fname}\t{direction}\t{num}\t{nbytes}\n")
+        for fh in _partfhs.values():
+            fh.flush()
+    return stats
+
+
+def event_time(date, hms):
+    """ datetime of a condor log event (year 2000 for dates without a year) """
+    if '/' in date:
+        date = f"2000-{date.replace('/', '-')}"
+    return datetime.datetime.fromisoformat(f"{date} {hms}")
+
+
+def job_time(start, end):
+    """ Seconds between start and end, allowing for a year-less end date in the next year """
+    if end < start and end.year == 2000:
+        try:
+            end = end.replace(year=2001)
+        except ValueError:
+            pass    # Feb 29
+    return max(0, int((end - start).total_seconds()))
+
+
+def scan_condor_log(filename):
+    """ Sum the run times (execute to terminate) of the jobs in a condor user log
+
+        Returns
+        -------
+        dict, same as new_job_stats plus 'first' and 'last' (isoformat times of the
+        first execute and last terminate event)
+    """
+    stats = new_job_stats()
+    stats['log_files'] = 1
+    stats['first'] = None
+    stats['last'] = None
+    # only the jobs running at a time are kept
+    start_times = {}
+    first = last = None
+    with open_log(filename) as logfh:
+        for line in logfh:
+            match = CONDOR_RE.match(line.decode('utf-8', 'replace'))
+            if match is None or match.group(1) not in (CONDOR_EXECUTE, CONDOR_TERMINATE):
+                continue
+            (code, jobid, date, hms) = match.groups()
+            when = event_time(date, hms)
+            if code == CONDOR_EXECUTE:
+                # a rerun job has several execute events, time the last run
+                start_times[jobid] = when
+                if first is None:
+                    first = when
+            elif jobid not in start_times:
+                stats['unmatched'] += 1
+            else:
+                secs = job_time(start_times.pop(jobid), when)
+                stats['num_jobs'] += 1
+                stats['total_time'] += secs
+                stats['max_time'] = max(stats['max_time'], secs)
+                # power of 2 buckets of seconds
+                bucket = str(1 << max(0, secs - 1).bit_length())
+                stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+                last = when
+    stats['unmatched'] += len(start_times)
+    if first is not None and last is not None:
+        stats['first'] = first.isoformat()
+        stats['last'] = last.isoformat()
+        stats['wall_time'] = job_time(first, last)
+    return stats
+
+
+def scan_log(task):
+    """ Pool task: (kind, filename) to scan_copy_log or scan_condor_log results """
+    (kind, filename) = task
+    try:
+        if kind == 'copy':
+            return kind, scan_copy_log(filename)
+        return kind, scan_condor_log(filename)
+    except (OSError, EOFError, zlib.error) as err:
+        print(f"Warning: could not read {filename}: {err}", file=sys.stderr)
+        return kind, None
+
+
+def merge(total, stats):
+    """ Add stats (from new_copy_stats or new_job_stats) into total """
+    for key, val in stats.items():
+        if key not in total:
+            continue
+        if key == 'max_time':
+            total[key] = max(total[key], val)
+        elif isinstance(val, dict):
+            for subkey, subval in val.items():
+                total[key][subkey] = total[key].get(subkey, 0) + subval
+        else:
+            total[key] += val
+
+
+def sum_partition(partdir, part):
+    """ Repeated copy histogram for one partition of the filenames
+
+        Returns
+        -------
+        dict of times copied to [total bytes copied, number of files]
+    """
+    perfile = {}
+    for partname in glob.glob(os.path.join(partdir, f"part{part}.*")):
+        with open(partname, 'r', encoding='utf-8') as partfh:
+            for line in partfh:
+                (fname, _, num, nbytes) = line.rstrip('\n').split('\t')
+                cnt = perfile.setdefault(fname, [0, 0])
+                cnt[0] += int(num)
+                cnt[1] += int(nbytes)
+    hist = {}
+    for (num, nbytes) in perfile.values():
+        row = hist.setdefault(num, [0, 0])
+        row[0] += nbytes
+        row[1] += 1
+    return hist
+
+
+def summarize(copy_logs, condor_logs=(), wall_log=None, processes=None,
+              partitions=DEFAULT_PARTITIONS, tmpdir=None):
+    """ Summarize the copy info lines in copy_logs and the job times in the condor logs
+
+        Parameters
+        ----------
+        copy_logs : list
+            Log files with copy info lines (e.g., job stdout)
+        condor_logs : list
+            Condor user logs of the jobs (e.g., runjob.log)
+        wall_log : str
+            Condor user log (e.g., of the dag) whose first to last event is the wall time
+        processes : int
+            Number of worker processes (default the number of cpus)
+        partitions : int
+            Number of partitions of the per filename counts
+        tmpdir : str
+            Where to put the partition files
+
+        Returns
+        -------
+        dict with the 'copies', 'repeated_copies', 'jobs' and 'wall' summaries
+    """
+    copies = new_copy_stats()
+    jobs = new_job_stats()
+    partdir = tempfile.mkdtemp(prefix='transfer_log_stats_', dir=tmpdir)
+    try:
+        tasks = [('copy', f) for f in copy_logs] + [('condor', f) for f in condor_logs]
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                 initargs=(partdir, partitions)) as pool:
+            for (kind, stats) in pool.map(scan_log, tasks, chunksize=4):
+                if stats is not None:
+                    merge(copies if kind == 'copy' else jobs, stats)
+            hist = {}
+            for parthist in pool.map(sum_partition, [partdir] * partitions, range(partitions)):
+                for (num, (nbytes, nfiles)) in parthist.items():
+                    row = hist.setdefault(num, [0, 0])
+                    row[0] += nbytes
+                    row[1] += nfiles
+    finally:
+        shutil.rmtree(partdir, ignore_errors=True)
+
+    summary = {'copies': copies,
+               'repeated_copies': [{'times_copied': num, 'total_bytes_copied': hist[num][0],
+                                    'num_files': hist[num][1]} for num in sorted(hist)],
+               'jobs': jobs,
+               'wall': None}
+    jobs['total_time_h'] = jobs['total_time'] / 3600.0
+    jobs['histogram'] = dict(sorted(jobs['histogram'].items(), key=lambda x: int(x[0])))
+    if wall_log is not None:
+        wall = scan_condor_log(wall_log)
+        summary['wall'] = {'first': wall['first'], 'last': wall['last'],
+                           'wall_time': wall.get('wall_time'),
+                           'wall_time_h': (wall.get('wall_time') or 0) / 3600.0}
+    return summary
+
+
+def print_text(summary, outfh=sys.stdout):
+    """ Print the summary as the tables the old transfer_stats_utils scripts printed """
+    jobs = summary['jobs']
+    copies = summary['copies']
+    wall = summary['wall'] or {}
+    print("num_jobs total_CPU_time(s) total_CPU_time(h) wall_time(s) wall_time(h)  "
+          "num_copies num_files num_bytes_from num_bytes_to time_used(s)", file=outfh)
+    print(f"{jobs['num_jobs']} {jobs['total_time']} {jobs['total_time_h']:.4f} "
+          f"{wall.get('wall_time')} {wall.get('wall_time_h', 0):.4f}  "
+          f"{copies['num_copies']} {copies['copy_lines']} {copies['num_bytes']['fromarchive']} "
+          f"{copies['num_bytes']['toarchive']} {sum(copies['time_used'].values()):.2f}", file=outfh)
+    print(file=outfh)
+    print("times_copied   total_bytes_copied  num_files", file=outfh)
+    for row in summary['repeated_copies']:
+        print(f"{row['times_copied']}  {row['total_bytes_copied']}  {row['num_files']}", file=outfh)
+
+
+def parse_cmd_line(argv):
+    """ Parse command line arguments
+
+        Parameters
+        ----------
+        argv : command line arguments
+
+        Returns
+        -------
+        Dictionary of the command line arguments and their values
+    """
+    parser = argparse.ArgumentParser(description='Summarize file transfer stats from job logs',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('copy_logs', nargs='*', help='Logs with "Copy info:" lines: files, directories or glob patterns')
+    parser.add_argument('--copy_name', action='store', default=None, help='Only files with names matching this glob pattern in copy log directories')
+    parser.add_argument('--condor_logs', nargs='+', default=[], help='Condor user logs of the jobs: files, directories or glob patterns')
+    parser.add_argument('--condor_name', action='store', default='*.log', help='Only files with names matching this glob pattern in condor log directories')
+    parser.add_argument('--wall_log', action='store', help='Condor user log whose first to last job event is the wall time (e.g., the dagman log)')
+    parser.add_argument('--processes', action='store', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--partitions', action='store', type=int, default=DEFAULT_PARTITIONS, help='Number of partitions for the repeated copy counts (more uses less memory)')
+    parser.add_argument('--tmpdir', action='store', default=None, help='Directory for the temporary partition files')
+    parser.add_argument('--format', action='store', choices=['json', 'text'], default='json')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """ Program entry point """
+    args = parse_cmd_line(argv)
+    summary = summarize(list(expand_paths(args.copy_logs, args.copy_name)),
+                        list(expand_paths(args.condor_logs, args.condor_name)),
+                        args.wall_log, args.processes, args.partitions, args.tmpdir)
+    if args.format == 'json':
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_text(summary)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
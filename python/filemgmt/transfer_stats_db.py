@@ -11,10 +11,20 @@
 
 __version__ = "$Rev: 48550 $"
 
+import os
+import copy
+import fcntl
+import glob
+import json
+import socket
+import datetime
 import configparser
 import despymisc.miscutils as miscutils
 import despydmdb.desdmdbi as desdmdbi
 
+# number of task ids fetched from the task sequence at a time when buffering
+TASK_ID_BLOCK = 100
+
 class TransferStatsDB(desdmdbi.DesDmDbi):
     """
         Class with functionality for tracking transfer statistics in DB
@@ -27,6 +37,7 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
         return {'use_db':'opt', 'des_services':'opt', 'des_db_section':'req',
                 'parent_task_id':'req', 'root_task_id':'req',
                 'transfer_stats_per_file':'opt',
+                'transfer_stats_buffered':'opt', 'transfer_stats_spill_dir':'opt',
                 'connection':'opt', 'threaded':'opt'}
 
 
@@ -67,6 +78,17 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
         else:
             self.transfer_stats_per_file = False
 
+        # columns of the stats tables, timing and cache values only go in the ones that exist
+        self.table_cols = {}
+
+        # buffered: per file stats are kept in memory (and a spill file if there is a spill
+        # dir) and written in one commit at the end of the batch instead of 2 commits per file
+        self.buffered = miscutils.convertBool(config.get('transfer_stats_buffered', False))
+        self.spill_dir = config.get('transfer_stats_spill_dir')
+        self.task_ids = []
+        if self.buffered and self.transfer_stats_per_file and self.spill_dir is not None:
+            self.load_spills()
+
     def __initialize_values__(self):
         self.currvals = {}
         self.currvals['batch_task_id'] = 0
@@ -76,6 +98,12 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
         self.currvals['transfer_name'] = None
         self.currvals['src'] = None
         self.currvals['dst'] = None
+        self.currvals['cache'] = None
+        # buffered mode: rows of files started and finished, spill file
+        self.currvals['openfiles'] = {}
+        self.currvals['taskrows'] = []
+        self.currvals['filerows'] = []
+        self.currvals['spill'] = None
 
     def __str__(self):
         mydict = {'batch_task_id': self.currvals['batch_task_id'],
@@ -88,6 +116,39 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
 
         return str(mydict)
 
+    def batch_copy(self):
+        """ Copy with its own batch state, for a batch running at the same time as
+            others (e.g., uploads in a background thread).   It has its own DB connection
+            (DB connections can't be used by 2 threads at once), closed by end_batch_copy.
+        """
+        other = copy.copy(self)
+        other.__initialize_values__()
+        other.task_ids = []
+        try:
+            desdmdbi.DesDmDbi.__init__(other, self.desservices, self.section)
+        except (configparser.NoSectionError, IOError) as err:
+            miscutils.fwdie(f"Error: problem connecting to database: {err}\n" \
+                                "\tCheck desservices file and environment variables", 1)
+        return other
+
+    def end_batch_copy(self):
+        """ Done with a copy from batch_copy """
+        self.close()
+
+
+    def known_columns(self, table, values):
+        """ Only the values for columns the table has (the optional timing and cache columns
+            may not exist in every schema)
+        """
+        if table not in self.table_cols:
+            curs = self.cursor()
+            curs.execute(f"select * from {table} where 0=1")
+            self.table_cols[table] = {desc[0].lower() for desc in curs.description}
+            curs.close()
+            if miscutils.fwdebug_check(3, 'TRANSFERSTATS_DEBUG'):
+                miscutils.fwdebug_print(f"{table} columns: {sorted(self.table_cols[table])}")
+        return {key: val for key, val in values.items() if key.lower() in self.table_cols[table]}
+
 
     def stat_beg_batch(self, transfer_name, src, dst, transclass=None):
         """ Starting a batch transfer between src and dst (archive or job scratch) """
@@ -127,6 +188,8 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
             task_id = self.currvals['batch_task_id']
         if miscutils.fwdebug_check(3, 'TRANSFERSTATS_DEBUG'):
             miscutils.fwdebug_print(f'before end_task, info: {self}')
+        if self.currvals['taskrows'] or self.currvals['openfiles']:
+            self.write_buffered()
         self.end_task(task_id, status)
         wherevals = {'task_id': task_id}
 
@@ -136,13 +199,32 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
             numfiles = self.currvals['numfiles']
         updatevals = {'total_num_bytes': totbytes,
                       'total_num_files': numfiles}
+        if self.currvals['cache'] is not None:
+            updatevals.update(self.known_columns('transfer_batch', self.currvals['cache']))
 
         self.basic_update_row('transfer_batch', updatevals, wherevals)
         self.commit()
+        if self.currvals['spill'] is not None:
+            # removed while still locked so that no other job can load it
+            try:
+                os.remove(os.path.join(self.spill_dir, f"transfer_stats_{self.currvals['batch_task_id']}.spill"))
+            except FileNotFoundError:
+                pass
+            self.currvals['spill'].close()
         self.__initialize_values__()
         if miscutils.fwdebug_check(3, 'TRANSFERSTATS_DEBUG'):
             miscutils.fwdebug_print("end")
 
+    def stat_cache_batch(self, hitfiles, hitbytes, missfiles, missbytes):
+        """ Save how many of the batch's files were found in a node cache (saved with the
+            end of the batch)
+        """
+        self.currvals['cache'] = {'cache_hit_files': hitfiles,
+                                  'cache_hit_bytes': hitbytes,
+                                  'cache_miss_files': missfiles,
+                                  'cache_miss_bytes': missbytes}
+
+
     def stat_beg_file(self, filename):
         """ Insert a row into a file transfer stats table (and task table) and commit """
 
@@ -155,6 +237,12 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
             if self.currvals['batch_task_id'] is None:
                 raise Exception('Cannot call this function without prior calling stat_beg_batch')
 
+            if self.buffered:
+                self.currvals['file_task_id'] = self.next_task_id()
+                self.currvals['openfiles'][self.currvals['file_task_id']] = \
+                    {'filename': filename, 'start_time': datetime.datetime.now()}
+                return self.currvals['file_task_id']
+
             row = {'filename': filename}
             row['task_id'] = self.create_task(name='transfer_file',
                                               info_table='transfer_file',
@@ -175,8 +263,13 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
 
 
 
-    def stat_end_file(self, status, nbytes=0, task_id=None):
-        """ Update rows for end of file transfer and commit """
+    def stat_end_file(self, status, nbytes=0, task_id=None, timing=None):
+        """ Update rows for end of file transfer and commit
+
+            timing is an optional dict of per transfer timing info, the keys are
+            transfer_file column names (e.g., connect_time, speed_download, retries).
+            Keys without a column in the table are dropped.
+        """
 
         if nbytes is not None:
             self.currvals['totbytes'] += nbytes
@@ -187,12 +280,118 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
 
             if task_id is None:
                 task_id = self.currvals['file_task_id']
+            if self.buffered:
+                self.buffer_file(task_id, status, nbytes, timing)
+                return
             self.end_task(task_id, status)
             wherevals = {'task_id': task_id}
             updatevals = {'bytes': nbytes}
+            if timing:
+                updatevals.update(self.known_columns('transfer_file', timing))
 
             self.basic_update_row('transfer_file', updatevals, wherevals)
             self.commit()
 
             if miscutils.fwdebug_check(3, 'TRANSFERSTATS_DEBUG'):
                 miscutils.fwdebug_print("end")
+
+
+    def next_task_id(self):
+        """ A task id from the block fetched ahead from the task sequence """
+        if not self.task_ids:
+            curs = self.cursor()
+            curs.execute(f"select task_seq.nextval from dual connect by level <= {TASK_ID_BLOCK:d}")
+            self.task_ids = [row[0] for row in curs]
+            curs.close()
+        return self.task_ids.pop(0)
+
+
+    def buffer_file(self, task_id, status, nbytes, timing):
+        """ Keep the rows for a finished file transfer until the end of the batch (and append
+            them to the spill file in case the job dies first) """
+        start = self.currvals['openfiles'].pop(task_id, {'filename': None, 'start_time': None})
+        taskrow = {'id': task_id, 'name': 'transfer_file', 'info_table': 'transfer_file',
+                   'parent_task_id': self.currvals['batch_task_id'], 'root_task_id': self.root_task_id,
+                   'label': None, 'exec_host': socket.gethostname(), 'status': status,
+                   'start_time': start['start_time'], 'end_time': datetime.datetime.now()}
+        filerow = {'task_id': task_id, 'filename': start['filename'],
+                   'batch_task_id': self.currvals['batch_task_id'], 'bytes': nbytes}
+        if timing:
+            filerow.update(timing)
+        self.currvals['taskrows'].append(taskrow)
+        self.currvals['filerows'].append(filerow)
+
+        if self.spill_dir is None:
+            return
+        if self.currvals['spill'] is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            spillname = os.path.join(self.spill_dir, f"transfer_stats_{self.currvals['batch_task_id']}.spill")
+            # locked while the batch is active so that load_spills skips it, and locked under
+            # a temporary name first so that another job can't load (and remove) it before then
+            tmpname = f"{spillname}.{os.getpid()}.tmp"
+            spillfh = open(tmpname, 'w', encoding='utf-8')
+            fcntl.flock(spillfh, fcntl.LOCK_EX)
+            os.rename(tmpname, spillname)
+            self.currvals['spill'] = spillfh
+        self.currvals['spill'].write(json.dumps({'task': taskrow, 'file': filerow}, default=str) + '\n')
+        self.currvals['spill'].flush()
+
+
+    def write_buffered(self):
+        """ Insert the buffered rows with array inserts (committed with the end of the batch) """
+        # files started but not finished
+        for task_id in list(self.currvals['openfiles']):
+            self.buffer_file(task_id, None, None, None)
+        self.insert_rows(self.currvals['taskrows'], self.currvals['filerows'])
+
+
+    def insert_rows(self, taskrows, filerows):
+        """ Array insert of task and transfer_file rows (without commit) """
+        for (table, rows) in (('task', taskrows), ('transfer_file', filerows)):
+            if rows:
+                # timing columns can differ between rows
+                cols = sorted(self.known_columns(table, dict.fromkeys(set().union(*rows))))
+                self.insert_many(table, cols, [{c: row.get(c) for c in cols} for row in rows])
+
+
+    def load_spills(self):
+        """ Insert the rows spilled by earlier jobs that died before the end of their batch
+            (the spill files of batches still running are locked and skipped)
+        """
+        for spillname in sorted(glob.glob(os.path.join(self.spill_dir, 'transfer_stats_*.spill'))):
+            try:
+                spillfh = open(spillname, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                continue    # finished or loaded by another job
+            with spillfh:
+                try:
+                    fcntl.flock(spillfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                # removed by its batch or another job between the open and the lock
+                if os.fstat(spillfh.fileno()).st_nlink == 0:
+                    continue
+                self.load_spill(spillname, spillfh)
+
+
+    def load_spill(self, spillname, spillfh):
+        """ Insert the rows of one locked spill file and remove it """
+        taskrows = []
+        filerows = []
+        for line in spillfh:
+            try:
+                rows = json.loads(line)
+            except ValueError:
+                continue    # partial last line
+            for key in ('start_time', 'end_time'):
+                if rows['task'][key] is not None:
+                    rows['task'][key] = datetime.datetime.fromisoformat(rows['task'][key])
+            taskrows.append(rows['task'])
+            filerows.append(rows['file'])
+        try:
+            self.insert_rows(taskrows, filerows)
+            self.commit()
+            os.remove(spillname)
+        except Exception as err:
+            self.rollback()
+            miscutils.fwdebug_print(f"Could not load transfer stats spill file {spillname}: {err}")
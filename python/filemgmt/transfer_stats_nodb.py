@@ -9,8 +9,14 @@
 
 __version__ = "$Rev: 48052 $"
 
+import os
+import json
 import time
+import copy
+import socket
 import datetime
+import itertools
+import threading
 import configparser
 
 import despymisc.miscutils as miscutils
@@ -25,7 +31,8 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
     def requested_config_vals():
         """ return dictionary describing what values this class uses along
             with whether they are optional or required """
-        return {'transfer_stats_per_file':'opt'}
+        return {'transfer_stats_per_file':'opt', 'transfer_stats_file':'opt',
+                'parent_task_id':'opt', 'root_task_id':'opt'}
 
 
     def __init__(self, config):
@@ -37,6 +44,17 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
 
         self.batchvals = {}
         self.filevals = {}
+        # start info of files whose transfers overlap, keyed by the id returned by stat_beg_file
+        self.openfiles = {}
+
+        # optional per job file of JSON lines (see write_stats), loaded into the DB later
+        # by load_transfer_stats.py.   Shared with batch copies, so lines are written under lock.
+        self.statsfile = config.get('transfer_stats_file')
+        self.statsinfo = {'parent_task_id': config.get('parent_task_id'),
+                          'root_task_id': config.get('root_task_id')}
+        self.statsfh = None
+        self.statslock = threading.Lock()
+        self.batchnums = itertools.count(1)
         self.__initialize_values__()
 
     def __initialize_values__(self):
@@ -48,19 +66,33 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
                           'dst': None,
                           'start_time': None,
                           'end_time': None,
-                          'status': None
+                          'status': None,
+                          'batchnum': None,
+                          'cache': None
                           }
 
         self.filevals = {'filename': None,
                          'numbytes': None,
                          'start_time': None,
                          'end_time': None,
-                         'status': None
+                         'status': None,
+                         'timing': None
                          }
 
     def __str__(self):
         return str(self.batchvals) + " ; " + str(self.filevals)
 
+    def batch_copy(self):
+        """ Copy with its own batch state, for a batch running at the same time as
+            others (e.g., uploads in a background thread) """
+        other = copy.copy(self)
+        other.openfiles = {}
+        other.__initialize_values__()
+        return other
+
+    def end_batch_copy(self):
+        """ Done with a copy from batch_copy (the stats file stays open for the others) """
+
 
     ############################################################
     def print_batch_stats(self):
@@ -75,7 +107,35 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
         """ Print stats for transfer file """
 
         # current epoch time, file number, filename, filesize, trans secs, status
-        print(f"TRANS_STATS_FILE: {time.time()} {self.batchvals['numfiles']} {self.filevals['filename']} {self.filevals['numbytes']} {self.filevals['end_time'] - self.filevals['start_time']} {self.filevals['status']}")
+        # followed by name:value for any timing info from the transfer
+        line = f"TRANS_STATS_FILE: {time.time()} {self.batchvals['numfiles']} {self.filevals['filename']} {self.filevals['numbytes']} {self.filevals['end_time'] - self.filevals['start_time']} {self.filevals['status']}"
+        if self.filevals['timing']:
+            line += ' ' + ' '.join(f"{key}:{val}" for key, val in self.filevals['timing'].items())
+        print(line)
+
+    ############################################################
+    def write_stats(self, line, sync=False):
+        """ Append a line to the transfer stats file (if there is one)
+
+            The first line in the file is the job's info, then there is a line per file
+            transfer ("t": "file") and per batch ("t": "batch", written at the end of the
+            batch).   File lines have the number of their batch in "b".   Lines are buffered
+            and the file is only flushed and synced at the end of a batch.
+        """
+        if self.statsfile is None:
+            return
+        with self.statslock:
+            if self.statsfh is None:
+                self.statsfh = open(self.statsfile, 'a', encoding='utf-8')
+                job = {'t': 'job', 'host': socket.gethostname(), 'pid': os.getpid(),
+                       'time': time.time()}
+                job.update(self.statsinfo)
+                self.statsfh.write(json.dumps(job, separators=(',', ':')) + '\n')
+            self.statsfh.write(json.dumps(line, separators=(',', ':'), default=str) + '\n')
+            if sync:
+                self.statsfh.flush()
+                os.fsync(self.statsfh.fileno())
+
 
     ############################################################
     def stat_beg_batch(self, transfer_name, src, dst, transclass=None):
@@ -88,6 +148,7 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
         self.batchvals['dst'] = dst
         self.batchvals['transfer_class'] = transclass
         self.batchvals['start_time'] = datetime.datetime.now()
+        self.batchvals['batchnum'] = next(self.batchnums)
 
         if miscutils.fwdebug_check(3, 'TRANSFERSTATS_DEBUG'):
             miscutils.fwdebug_print("end")
@@ -109,12 +170,34 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
             self.batchvals['numfiles'] = numfiles
 
         #print_batch("Batch Copy info:")
-
+        self.write_stats({'t': 'batch', 'b': self.batchvals['batchnum'],
+                          'name': self.batchvals['transfer_name'],
+                          'class': self.batchvals['transfer_class'],
+                          'src': self.batchvals['src'], 'dst': self.batchvals['dst'],
+                          'start': self.batchvals['start_time'].timestamp() if self.batchvals['start_time'] else None,
+                          'end': self.batchvals['end_time'].timestamp(),
+                          'status': status, 'files': self.batchvals['numfiles'],
+                          'bytes': self.batchvals['totbytes'], 'cache': self.batchvals['cache']},
+                         sync=True)
+
+        self.openfiles = {}
         self.__initialize_values__()
         if miscutils.fwdebug_check(3, 'TRANSFERSTATS_DEBUG'):
             miscutils.fwdebug_print("end")
 
 
+    ############################################################
+    def stat_cache_batch(self, hitfiles, hitbytes, missfiles, missbytes):
+        """ Print how many of the batch's files were found in a node cache """
+
+        self.batchvals['cache'] = {'cache_hit_files': hitfiles,
+                                   'cache_hit_bytes': hitbytes,
+                                   'cache_miss_files': missfiles,
+                                   'cache_miss_bytes': missbytes}
+        # current epoch time, transfer name, hit files, hit bytes, miss files, miss bytes
+        print(f"TRANS_STATS_CACHE: {time.time()} {self.batchvals['transfer_name']} {hitfiles} {hitbytes} {missfiles} {missbytes}")
+
+
     ############################################################
     def stat_beg_file(self, filename):
         """ save file transfer start info """
@@ -122,15 +205,24 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
         self.batchvals['numfiles'] += 1
         self.filevals['filename'] = filename
         self.filevals['start_time'] = time.time()
+        self.openfiles[self.batchvals['numfiles']] = {'filename': filename,
+                                                      'start_time': self.filevals['start_time']}
 
-        return -1
+        return self.batchvals['numfiles']
 
     ############################################################
-    def stat_end_file(self, status, nbytes=0, task_id=None):
-        """ save file transfer end info and print info """
+    def stat_end_file(self, status, nbytes=0, task_id=None, timing=None):
+        """ save file transfer end info and print info
+
+            timing is an optional dict of per transfer timing info (e.g., curl connect time,
+            transfer speed, number of retries)
+        """
 
+        if task_id in self.openfiles:
+            self.filevals.update(self.openfiles.pop(task_id))
         self.filevals['end_time'] = time.time()
         self.filevals['status'] = status
+        self.filevals['timing'] = timing
 
         if nbytes != 0:
             self.filevals['numbytes'] = nbytes
@@ -138,3 +230,44 @@ class TransferStatsDB(desdmdbi.DesDmDbi):
 
         if self.transfer_stats_per_file:
             self.print_file_stats()
+            line = {'t': 'file', 'b': self.batchvals['batchnum'],
+                    'name': self.filevals['filename'], 'bytes': nbytes,
+                    'start': self.filevals['start_time'], 'end': self.filevals['end_time'],
+                    'status': status}
+            if timing:
+                line['timing'] = timing
+            self.write_stats(line)
+
+
+############################################################
+def read_stats_file(filename):
+    """ Read a transfer stats file written by TransferStatsDB.write_stats
+
+        A job run again with the same file appends to it, starting with a new job line and
+        numbering its batches from 1 again, so batches are kept per job line.
+
+        Returns
+        -------
+        list, per job line, of a tuple of the job info dict and list of batch dicts (in the
+        order they started), each with its files in 'filelist'.   A batch the job didn't
+        finish (no batch line) only has the info from its files.
+    """
+    runs = []
+    batches = None
+    with open(filename, 'r', encoding='utf-8') as statsfh:
+        for line in statsfh:
+            try:
+                info = json.loads(line)
+            except ValueError:
+                continue    # partial line from a job that died
+            kind = info.pop('t', None)
+            if kind == 'job' or (batches is None and kind in ('batch', 'file')):
+                batches = {}
+                runs.append((info if kind == 'job' else {}, batches))
+            if kind in ('batch', 'file'):
+                batch = batches.setdefault(info.pop('b'), {'filelist': []})
+                if kind == 'batch':
+                    batch.update(info)
+                else:
+                    batch['filelist'].append(info)
+    return [(jobinfo, [batches[num] for num in sorted(batches)]) for (jobinfo, batches) in runs]
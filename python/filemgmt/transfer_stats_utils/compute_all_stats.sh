@@ -1,24 +1,30 @@
 #!/bin/bash
 
-# OSG/FNAL User Support, December 2013
-
 # Usage example:
-#     ./compute_all_stats.sh ms4_finalcut_xxxx_fringe_20131210143120
+#     ./compute_all_stats.sh ms4_finalcut_xxxx_fringe_20131210143120 [more run directories]
 #
-# This prints all of the statistics for a particular run
-# in a form that is easy to cut-and-paste into the spreadsheet.
+# Prints the statistics for the runs (summed over all of them) as text tables.
+# Run python3 -m filemgmt.transfer_log_stats directly for the JSON summary.
+
+if [ $# -eq 0 ]; then
+    echo "Usage: $0 run_directory [run_directory ...]"
+    exit 1
+fi
+
+condor_logs=()
+copy_logs=()
+for run in "$@"; do
+    condor_logs+=("$run/runtime/**/runjob.log")
+    copy_logs+=("$run/runtime")
+done
 
-cd $1/runtime
-JL=$(../../compute_job_length.py -w  uberctrl/D00229228_r*p*_mainmngr.dag.dagman.log  $(find . -name runjob.log) | tail -n 1)
-echo "num_jobs total_CPU_time(s) total_CPU_time(h) wall_time(s) wall_time(h)"
-# echo $JL
-# exit 0
-readarray CS < <(grep -nH -e 'Copy info:' -r . | ../../compute_copy_stats.py)
+wall=()
+if [ $# -eq 1 ]; then
+    dagman=$(ls "$1"/runtime/uberctrl/*_mainmngr.dag.dagman.log 2>/dev/null | head -n 1)
+    if [ -n "$dagman" ]; then
+        wall=(--wall_log "$dagman")
+    fi
+fi
 
-echo "num_jobs total_CPU_time(s) total_CPU_time(h) wall_time(s) wall_time(h)  num_copies num_files num_bytes_from num_bytes_to time_used(s)  directory"
-last_line=$(echo "${CS[${#CS[@]}-1]}" | tr '\n' ' ')
-echo "$JL  $last_line  $1"
-echo
-unset CS[${#CS[@]}-1]
-unset CS[${#CS[@]}-1]
-echo "${CS[@]}"
+exec python3 -m filemgmt.transfer_log_stats --format text "${wall[@]}" \
+    --condor_logs "${condor_logs[@]}" -- "${copy_logs[@]}"
@@ -13,6 +13,7 @@ setup(name='FileMgmt',
       author = "Michelle Gower",
       author_email = "mgower@illinois.edu",
       packages = ['filemgmt'],
+      requires = ['numpy'],
       package_dir = {'': 'python'},
       scripts = bin_files,
       data_files=[('ups',['ups/FileMgmt.table']),
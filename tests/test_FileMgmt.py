@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
 import unittest
+import argparse
+import email.utils
+import errno
+import hashlib
+import importlib.util
+import json
 import os
 import stat
 import sys
+import shutil
+import threading
+import time
 import mock
 from contextlib import contextmanager
 from io import StringIO
@@ -12,6 +21,20 @@ from MockDBI import MockConnection
 
 import filemgmt.utils as utils
 import filemgmt.disk_utils_local as dul
+import filemgmt.http_utils as hu
+from filemgmt.http_test_server import WebDavServer
+import filemgmt.node_cache as nc
+import filemgmt.job_mvmt_http as jmh
+import filemgmt.transfer_stats_nodb as tsnodb
+import filemgmt.transfer_stats_db as tsdb
+import filemgmt.transfer_log_stats as tls
+import filemgmt.compare_utils as cu
+import filemgmt.fmutils as fmutils
+import filemgmt.db_utils_local as dbutils
+import filemgmt.compact_utils as compact_utils
+import filemgmt.migrate_utils as migrate_utils
+import filemgmt.archive_transfer_utils as atu
+import filemgmt.archive_transfer_local as atl
 
 @contextmanager
 def capture_output():
@@ -23,6 +46,24 @@ def capture_output():
     finally:
         sys.stdout, sys.stderr = old_out, old_err
 
+def load_script(name):
+    """ Import one of the scripts in bin """
+    filename = os.path.join(os.path.dirname(tsnodb.__file__), '..', '..', 'bin', name)
+    spec = importlib.util.spec_from_file_location(name[:-3], filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def manager_args(**kwargs):
+    """ Command line args of a FileManager (a mocked DB connection unless dbh is given) """
+    args = argparse.Namespace(dbh=mock.Mock(), des_services=None, section=None, archive='testarch',
+                              verbose=False, debug=False, script=False, pfwid=None, silent=True,
+                              tag=None)
+    for key, val in kwargs.items():
+        setattr(args, key, val)
+    return args
+
+
 class TestUtils(unittest.TestCase):
     def test_get_config_vals(self):
         arch = {"home" : "desar2",
@@ -103,6 +144,88 @@ class TestUtils(unittest.TestCase):
             output = out.getvalue().strip()
             self.assertTrue('Filesystem' in output)
 
+    def test_transfer_stats_file(self):
+        statsfile = 'transfer_stats_test.jsonl'
+        try:
+            tstats = tsnodb.TransferStatsDB({'transfer_stats_per_file': 'True',
+                                             'transfer_stats_file': statsfile,
+                                             'root_task_id': 12})
+            with capture_output():
+                tstats.stat_beg_batch('home2job', 'home', 'job', 'cls')
+                for name in ['a.fits', 'b.fits']:
+                    tid = tstats.stat_beg_file(name)
+                    tstats.stat_end_file(0, 10, tid, timing={'retries': 1})
+                tstats.stat_end_batch(0)
+                # a batch the job didn't finish
+                tstats.stat_beg_batch('job2home', 'job', 'home')
+                tid = tstats.stat_beg_file('c.fits')
+                tstats.stat_end_file(1, 0, tid)
+            tstats.statsfh.close()
+
+            # the job run again, appending to the same file
+            rerun = tsnodb.TransferStatsDB({'transfer_stats_per_file': 'True',
+                                            'transfer_stats_file': statsfile,
+                                            'root_task_id': 13})
+            with capture_output():
+                rerun.stat_beg_batch('home2job', 'home', 'job', 'cls')
+                rerun.stat_end_file(0, 10, rerun.stat_beg_file('d.fits'))
+                rerun.stat_end_batch(0)
+
+            runs = tsnodb.read_stats_file(statsfile)
+            self.assertEqual(len(runs), 2)
+            self.assertEqual(runs[1][0]['root_task_id'], 13)
+            self.assertEqual(len(runs[1][1]), 1)
+            self.assertEqual([f['name'] for f in runs[1][1][0]['filelist']], ['d.fits'])
+            # a batch without its batch line whose files have no start time
+            loader = load_script('load_transfer_stats.py')
+            rows = loader.make_rows(runs[1][0], [{'filelist': [{'name': 'e.fits', 'start': None}]}],
+                                    range(2), argparse.Namespace(parent_task_id=1, root_task_id=None))
+            self.assertIsNone(rows['task'][0]['start_time'])
+            self.assertEqual(rows['task'][0]['root_task_id'], 13)
+            (jobinfo, batches) = runs[0]
+            self.assertEqual(jobinfo['root_task_id'], 12)
+            self.assertEqual(len(batches), 2)
+            self.assertEqual(batches[0]['name'], 'home2job')
+            self.assertEqual(batches[0]['bytes'], 20)
+            self.assertEqual([f['name'] for f in batches[0]['filelist']], ['a.fits', 'b.fits'])
+            self.assertEqual(batches[0]['filelist'][0]['timing'], {'retries': 1})
+            self.assertNotIn('name', batches[1])
+            self.assertEqual(batches[1]['filelist'][0]['status'], 1)
+        finally:
+            if os.path.exists(statsfile):
+                os.unlink(statsfile)
+
+    def test_transfer_log_stats(self):
+        logdir = 'logstatstest'
+        os.makedirs(logdir, exist_ok=True)
+        try:
+            with open(os.path.join(logdir, 'job1.out'), 'w') as fh:
+                fh.write("x - Copy info: 0 a.fits 100 1.5 1700000000.0 fromarchive\n"
+                         "other output\n"
+                         "x - Copy info: 0 b.fits 50 0.5 1700000000.0 fromarchive\n"
+                         "x - Copy info: 1 out.fits 70 0.25 1700000000.0 toarchive\n")
+            with open(os.path.join(logdir, 'job2.out'), 'w') as fh:
+                fh.write("x - Copy info: 0 a.fits 100 1.0 1700000000.0 fromarchive\n")
+            with open(os.path.join(logdir, 'runjob.log'), 'w') as fh:
+                fh.write("001 (123.000.000) 02/25 10:00:05 Job executing on host: <1.2.3.4>\n"
+                         "005 (123.000.000) 02/25 10:03:30 Job terminated.\n"
+                         "001 (124.000.000) 12/31 23:59:00 Job executing on host: <1.2.3.4>\n"
+                         "005 (124.000.000) 01/01 00:00:10 Job terminated.\n")
+
+            summary = tls.summarize(list(tls.expand_paths([logdir], '*.out')),
+                                    [os.path.join(logdir, 'runjob.log')], processes=2,
+                                    partitions=4)
+            self.assertEqual(summary['copies']['copy_lines'], 4)
+            self.assertEqual(summary['copies']['num_copies'], 3)
+            self.assertEqual(summary['copies']['num_bytes'], {'fromarchive': 250, 'toarchive': 70})
+            self.assertEqual(summary['repeated_copies'],
+                             [{'times_copied': 1, 'total_bytes_copied': 120, 'num_files': 2},
+                              {'times_copied': 2, 'total_bytes_copied': 200, 'num_files': 1}])
+            self.assertEqual(summary['jobs']['num_jobs'], 2)
+            self.assertEqual(summary['jobs']['total_time'], 205 + 70)
+        finally:
+            shutil.rmtree(logdir)
+
 class Testdisk_utils_local(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -202,6 +325,31 @@ class Testdisk_utils_local(unittest.TestCase):
         dul.remove_file_if_exists('test.junk')
         self.assertFalse(os.path.exists('test.junk'))
 
+    def test_place_file(self):
+        os.mkdir('placetest')
+        try:
+            shutil.copy(self.fname[0], 'placetest/src.test')
+            mode = os.stat('placetest/src.test').st_mode
+            method = dul.place_file('placetest/src.test', 'placetest/input.test')
+            # the job's own files are never hardlinked
+            self.assertIn(method, (dul.PLACE_REFLINK, dul.PLACE_COPY))
+            self.assertEqual(dul.get_md5sum_file('placetest/input.test'), self.md5[0])
+            self.assertEqual(os.stat('placetest/src.test').st_mode, mode)
+
+            # EPERM from one hardlink doesn't rule out hardlinks for other files
+            with mock.patch.object(dul, 'hardlink_file', side_effect=OSError(errno.EPERM, 'not permitted')):
+                method = dul.place_file('placetest/src.test', 'placetest/link.test',
+                                        (dul.PLACE_HARDLINK, dul.PLACE_COPY))
+            self.assertEqual(method, dul.PLACE_COPY)
+            pair = (os.stat('placetest/src.test').st_dev, os.stat('placetest').st_dev)
+            self.assertNotIn(dul.PLACE_HARDLINK, dul._unsupported[pair])
+
+            method = dul.place_file('placetest/src.test', 'placetest/copy.test', (dul.PLACE_COPY,))
+            self.assertEqual(method, dul.PLACE_COPY)
+            self.assertNotEqual(os.stat('placetest/copy.test').st_ino, os.stat('placetest/src.test').st_ino)
+        finally:
+            shutil.rmtree('placetest')
+
     def test_get_files_from_disk(self):
         with capture_output() as (out, _):
             res = dul.get_files_from_disk('tester', os.getcwd(), debug=True)
@@ -209,6 +357,1323 @@ class Testdisk_utils_local(unittest.TestCase):
             output = out.getvalue().strip()
             self.assertTrue('Getting' in output)
 
+class FakeDbh:
+    """ DB connection that records the statements run on it and answers them from canned
+        results, a dict of sql fragment -> (columns, rows) or a function of the binds
+        returning them (the first fragment found in the sql is used) """
+    def __init__(self, results=None):
+        self.results = results or {}
+        self.executed = []
+        self.gtts = []
+        self.commit = mock.Mock()
+        self.rollback = mock.Mock()
+        self.close = mock.Mock()
+
+    @staticmethod
+    def get_named_bind_string(name):
+        return ':' + name
+
+    def load_id_gtt(self, ids):
+        self.gtts.append(list(ids))
+        return 'gtt_id'
+
+    def load_filename_gtt(self, filelist):
+        self.gtts.append(list(filelist))
+        return 'gtt_filename'
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def answer(self, sql, binds):
+        for fragment, result in self.results.items():
+            if fragment in sql:
+                return result(binds) if callable(result) else result
+        return ([], [])
+
+    def statements(self, fragment):
+        """ The (sql, binds) of the executed statements containing fragment """
+        return [(sql, binds) for (sql, binds) in self.executed if fragment in sql]
+
+class FakeCursor:
+    def __init__(self, dbh):
+        self.dbh = dbh
+        self.sql = None
+        self.description = None
+        self.rows = []
+        self.rowcount = 0
+        self.arraysize = 100
+
+    def prepare(self, sql):
+        self.sql = sql
+
+    def execute(self, sql, binds=None):
+        # like a real cursor, other sql replaces the prepared statement
+        sql = self.sql = sql or self.sql
+        self.dbh.executed.append((sql, binds))
+        (columns, rows) = self.dbh.answer(sql, binds)
+        self.description = [(col.upper(),) for col in columns]
+        self.rows = list(rows)
+        self.rowcount = len(self.rows)
+
+    def executemany(self, sql, seq):
+        sql = self.sql = sql or self.sql
+        self.dbh.executed.append((sql, list(seq)))
+        self.rowcount = len(self.dbh.executed[-1][1])
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+ATTEMPT_COLUMNS = ['id', 'archive_path', 'data_state', 'operator', 'reqnum', 'unitname', 'attnum']
+
+class TestFileMgmtQueries(unittest.TestCase):
+    def setUp(self):
+        # archive roots are cached for the life of the process
+        patcher = mock.patch.dict(fmutils.ARCHIVE_ROOTS, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prefetch_attempt_info(self):
+        dbh = FakeDbh({'from ops_archive': (['root'], [('/arch',)]),
+                       'from pfw_attempt pfw, attempt_state ats, gtt_id': (
+                           ATTEMPT_COLUMNS, [(1, 'p/1', 'ACTIVE', 'op1', 10, 'D1', 1),
+                                             (2, 'p/2', 'JUNK', 'op2', 10, 'D2', 3)])})
+        manager = fmutils.FileManager(None, manager_args(dbh=dbh), [1, 2], None)
+        manager.prefetch_attempt_info()
+        # all of the pfw_attempt_ids in one query
+        self.assertEqual(dbh.gtts, [[1, 2]])
+        for (pfwid, relpath, state, unitname, attnum) in [(2, 'p/2', 'JUNK', 'D2', 3),
+                                                           (1, 'p/1', 'ACTIVE', 'D1', 1)]:
+            manager.relpath = None
+            manager.pfwid = pfwid
+            with capture_output():
+                manager.gather_data()
+            self.assertEqual(manager.relpath, relpath)
+            self.assertEqual(manager.state, state)
+            self.assertEqual((manager.reqnum, manager.unitname, manager.attnum), (10, unitname, attnum))
+            self.assertEqual(manager.archive_path, os.path.join('/arch', relpath))
+        # the archive root is queried once for the process, the attempts are never queried again
+        other = fmutils.FileManager(None, manager_args(dbh=dbh, pfwid=1), [1], None)
+        other.attempt_info = manager.attempt_info
+        with capture_output():
+            other.gather_data()
+        self.assertEqual(len(dbh.statements('from ops_archive')), 1)
+        self.assertEqual(len(dbh.statements('from pfw_attempt')), 1)
+        self.assertEqual(dbh.statements('from ops_archive')[0][1], {'name': 'testarch'})
+
+        # an attempt that wasn't prefetched is loaded on its own
+        manager.relpath = None
+        manager.pfwid = 3
+        dbh.results['from pfw_attempt pfw, attempt_state ats, gtt_id'] = (
+            ATTEMPT_COLUMNS, [(3, 'p/3', 'ACTIVE', 'op3', 11, 'D3', 1)])
+        with capture_output():
+            manager.gather_data()
+        self.assertEqual(manager.relpath, 'p/3')
+        self.assertEqual(dbh.gtts, [[1, 2], [3]])
+
+    def test_get_paths_by_path(self):
+        dbh = FakeDbh({'from ops_archive': (['root'], [('/arch',)]),
+                       'from pfw_attempt pfw, attempt_state ats where': (
+                           ['operator', 'id', 'data_state', 'reqnum', 'unitname', 'attnum'],
+                           [('op1', 1, 'ACTIVE', 10, 'D1', 1)])})
+        manager = fmutils.FileManager(None, manager_args(dbh=dbh, relpath='p/1'), [], None)
+        with capture_output():
+            manager.gather_data()
+        self.assertEqual((manager.operator, manager.pfwid, manager.state), ('op1', 1, 'ACTIVE'))
+        self.assertEqual((manager.reqnum, manager.unitname, manager.attnum), (10, 'D1', 1))
+        # attempt_state comes with the pfw_attempt row
+        self.assertEqual([binds for (_, binds) in dbh.executed],
+                         [{'name': 'testarch'}, {'apath': 'p/1'}])
+
+    def test_attempt_inventory(self):
+        files = {1: [('p/1/', 'a.fits', '.fz', 11, 'm1', 5), ('p/1', 'b.fits', None, 12, 'm2', 6)],
+                 2: [('p/2', 'c.fits', None, 13, 'm3', 7)],
+                 4: [('p/4', 'd.fits', None, 14, 'm4', 8)]}
+        dbh = FakeDbh()
+        dbh.results['from desfile art, file_archive_info fai, gtt_id'] = lambda binds: (
+            ['pfw_attempt_id', 'path', 'filename', 'compression', 'id', 'md5sum', 'filesize'],
+            [(pid,) + row for pid in dbh.gtts[-1] for row in files.get(pid, [])])
+        with mock.patch.object(fmutils, 'INVENTORY_CHUNK', 2):
+            inventory = fmutils.AttemptInventory('testarch', [1, 2, 3, 4], 'red')
+            (desc, rows) = inventory.get(dbh, 1)
+            self.assertEqual(desc, ['path', 'filename', 'compression', 'id', 'md5sum', 'filesize'])
+            self.assertEqual(rows, files[1])
+            # fetched with the one before it
+            self.assertEqual(inventory.get(dbh, 2)[1], files[2])
+            self.assertEqual(dbh.gtts, [[1, 2]])
+            # an attempt without files
+            self.assertEqual(inventory.get(dbh, 3)[1], [])
+            self.assertEqual(inventory.get(dbh, 4)[1], files[4])
+            self.assertEqual(dbh.gtts, [[1, 2], [3, 4]])
+            # one not in the list is fetched on its own
+            self.assertEqual(inventory.get(dbh, 9)[1], [])
+            self.assertEqual(dbh.gtts, [[1, 2], [3, 4], [9]])
+        for (sql, binds) in dbh.executed:
+            self.assertEqual(binds, {'archive': 'testarch', 'filetype': 'red'})
+            self.assertNotIn('testarch', sql)
+
+        # FileManager gets the files of each attempt from the inventory
+        dbh.gtts = []
+        dbh.executed = []
+        manager = fmutils.FileManager(None, manager_args(dbh=dbh), [1, 2], None)
+        manager.file_inventory = None
+        for pid in (1, 2):
+            manager.pfwid = pid
+            manager.get_files_from_db()
+            self.assertEqual(sorted(manager.files_from_db),
+                             sorted(row[1] + (row[2] or '') for row in files[pid]))
+            self.assertEqual({finfo['path'] for finfo in manager.files_from_db.values()}, {f"p/{pid}"})
+        self.assertEqual(len(dbh.statements('from desfile art, file_archive_info fai, gtt_id')), 1)
+        self.assertEqual(dbh.gtts[0], [1, 2])
+
+    def test_delete_db_run(self):
+        delete = load_script('delete_db_run.py')
+        catname = 'D0042_r10p01_cat.fits'
+        logname = 'D0042_r10p01.log'
+        dbh = FakeDbh({'from wgb,': (['metadata_table', 'filename'], [('CATALOG', catname)]),
+                       'select log from pfw_wrapper': (['log'], [(logname,)]),
+                       'select junktar from pfw_job': (['junktar'], [(None,)]),
+                       'select id from pfw_exec': (['id'], [(7,)]),
+                       'from opm_artifact': (['id'], [(8,)]),
+                       'select id from pfw_wrapper': (['id'], [(9,)])})
+        with mock.patch.object(delete, 'IN_CHUNK', 3):
+            delete.delete_db_run(dbh, 'D0042', '10', '1')
+        # the values are all bound
+        for (sql, _) in dbh.executed:
+            self.assertNotIn('D0042', sql)
+            self.assertNotIn("'", sql)
+        run = {'unitname': 'D0042', 'reqnum': '10', 'attnum': '1'}
+        self.assertEqual(dbh.statements('from wgb,')[0][1], run)
+        self.assertEqual(dbh.statements('delete from pfw_attempt where'),
+                         [('delete from pfw_attempt where unitname=:unitname and reqnum=:reqnum and attnum=:attnum', run)])
+        # the in-list is padded to a fixed size
+        self.assertEqual(dbh.statements('from opm_artifact'),
+                         [('select id from opm_artifact where name in (:v0,:v1,:v2)',
+                           {'v0': catname, 'v1': logname, 'v2': None})])
+        self.assertEqual(dbh.statements('delete from opm_used '),
+                         [('delete from opm_used where opm_process_id=:val', [{'val': '7'}])])
+        self.assertEqual(dbh.statements('delete from opm_was_derived_from ')[0][1], [{'val': '8'}])
+        self.assertEqual(dbh.statements('delete from qc_processed_value ')[0][1], [{'val': '9'}])
+        self.assertEqual(dbh.statements('delete from catalog ')[0][1], [{'val': catname}])
+        self.assertEqual(dbh.statements('delete from genfile ')[0][1], [{'val': logname}])
+        self.assertEqual(dbh.statements('delete from file_archive_info ')[0][1],
+                         [{'val': catname}, {'val': logname}, {'val': logname}])
+
+    def test_del_part_files_from_db_by_name(self):
+        dbh = FakeDbh()
+        for (relpath, fname) in (('p/1', 'a.fits'), ('p/2', 'b.fits')):
+            with capture_output():
+                dbutils.del_part_files_from_db_by_name(dbh, relpath, 'testarch', [fname])
+        # the cached cursor still runs the delete the second time
+        sql = "delete from file_archive_info where archive_name=:archive and path like :relpath and filename=:filename"
+        self.assertEqual(dbh.executed,
+                         [(sql, [{'archive': 'testarch', 'relpath': 'p/1%', 'filename': 'a.fits'}]),
+                          (sql, [{'archive': 'testarch', 'relpath': 'p/2%', 'filename': 'b.fits'}])])
+        self.assertEqual(dbh.commit.call_count, 2)
+
+    def test_compact_logs(self):
+        root = os.path.abspath('compacttest')
+        logdir = os.path.join(root, 'p', '1', 'log')
+        os.makedirs(os.path.join(logdir, 'j1'))
+        for name in ('a.log', 'j1/b.log'):
+            with open(os.path.join(logdir, name), 'w') as fh:
+                fh.write(name)
+        dbh = FakeDbh({'from ops_archive': (['root'], [(root,)]),
+                       'from pfw_attempt pfw, attempt_state ats, gtt_id': (
+                           ATTEMPT_COLUMNS, [(1, 'p/1', 'ACTIVE', 'op1', 10, 'D0042', 1)]),
+                       'from desfile art, file_archive_info fai, gtt_id': (
+                           ['pfw_attempt_id', 'path', 'filename', 'compression', 'id', 'md5sum', 'filesize'],
+                           [(1, 'p/1/log', 'a.log', None, 21, 'm1', 5), (1, 'p/1/log/j1', 'b.log', None, 22, 'm2', 8)]),
+                       'select id from desfile': (['id'], [(55,)])})
+        compact = compact_utils.CompactLogs(None, manager_args(dbh=dbh, pfwid=1, tarfile=None, live=False),
+                                            [1], None)
+        try:
+            self.assertEqual(compact.do_task(), 0)
+            self.assertEqual(os.listdir(logdir), ['log.D0042_r10p01.tar.gz'])
+        finally:
+            shutil.rmtree(root)
+        for (sql, _) in dbh.executed:
+            self.assertNotIn('D0042', sql)
+            self.assertNotIn('testarch', sql)
+        self.assertEqual(dbh.statements('from desfile art')[0][1], {'archive': 'testarch', 'filetype': 'log'})
+        self.assertEqual(dbh.statements('delete from file_archive_info')[0][1], [{'fid': 21}, {'fid': 22}])
+        self.assertEqual(dbh.statements('select id from desfile')[0][1],
+                         {'fname': 'log.D0042_r10p01.tar', 'comp': '.gz'})
+        self.assertEqual(dbh.statements('insert into file_archive_info')[0][1],
+                         {'fname': 'log.D0042_r10p01.tar', 'comp': '.gz', 'archive': 'testarch',
+                          'path': 'p/1/log', 'fid': 55})
+        dbh.commit.assert_called_once()
+
+    def test_migrate(self):
+        root = os.path.abspath('migratetest')
+        os.makedirs(os.path.join(root, 'p', '1'))
+        md5sums = {}
+        for (name, text) in (('a.fits', 'aaa'), ('b.fits.fz', 'bb')):
+            with open(os.path.join(root, 'p', '1', name), 'w') as fh:
+                fh.write(text)
+            md5sums[name] = dul.get_md5sum_file(os.path.join(root, 'p', '1', name))
+        dbh = FakeDbh({'from ops_archive': (['root'], [(root,)]),
+                       'from pfw_attempt pfw, attempt_state ats, gtt_id': (
+                           ATTEMPT_COLUMNS, [(1, 'p/1', 'ACTIVE', 'op1', 10, 'D0042', 1)])})
+
+        def inventory(binds):
+            # the files are at the new path once it has been updated
+            path = 'q/1' if dbh.statements('update pfw_attempt') else 'p/1'
+            return (['pfw_attempt_id', 'path', 'filename', 'compression', 'id', 'md5sum', 'filesize'],
+                    [(1, path, 'a.fits', None, 31, md5sums['a.fits'], 3),
+                     (1, path, 'b.fits', '.fz', 32, md5sums['b.fits.fz'], 2)])
+        dbh.results['from desfile art, file_archive_info fai, gtt_id'] = inventory
+        migration = migrate_utils.Migration(None, manager_args(dbh=dbh, pfwid=1, destination='q/', current='p/'),
+                                            [1], None, [])
+        try:
+            self.assertEqual(migration.do_task(), 0)
+            self.assertEqual(sorted(os.listdir(os.path.join(root, 'q', '1'))), ['a.fits', 'b.fits.fz'])
+            self.assertFalse(os.path.exists(os.path.join(root, 'p', '1')))
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(dbh.statements('update file_archive_info set path=:pth where filename=:fn and compression=:comp')[0][1],
+                         [{'pth': 'q/1', 'fn': 'b.fits', 'comp': '.fz'}])
+        self.assertEqual(dbh.statements('compression is NULL')[0][1], [{'pth': 'q/1', 'fn': 'a.fits'}])
+        self.assertEqual(dbh.statements('update pfw_attempt'),
+                         [('update pfw_attempt set archive_path=:apath where id=:pfwid', {'apath': 'q/1', 'pfwid': 1})])
+        dbh.commit.assert_called_once()
+
+
+class TestArchiveTransferSession(unittest.TestCase):
+    def setUp(self):
+        self.fmclass = mock.Mock()
+        self.fmclass.requested_config_vals.return_value = {'des_services': 'opt', 'des_db_section': 'req'}
+        self.fmclass.side_effect = lambda config: mock.Mock(
+            get_file_archive_info=mock.Mock(side_effect=self.archive_info),
+            register_file_in_archive=mock.Mock(return_value={}))
+        self.transclass = mock.Mock()
+        self.transclass.requested_config_vals.return_value = {}
+        self.transclass.return_value.blocking_transfer.side_effect = lambda files: files
+        self.classes = {'test.FileMgmt': self.fmclass, 'test.Transfer': self.transclass}
+        self.transinfo = {'src': {'dst': {'transfer': 'test.Transfer'}}}
+        self.srcinfo = {'name': 'src', 'filemgmt': 'test.FileMgmt', 'des_db_section': 'db-test'}
+        self.dstinfo = {'name': 'dst', 'filemgmt': 'test.FileMgmt', 'des_db_section': 'db-test'}
+        self.otherinfo = {'name': 'other', 'filemgmt': 'test.FileMgmt', 'des_db_section': 'db-other'}
+        patchers = [mock.patch.object(atu.miscutils, 'dynamically_load_class', side_effect=self.classes.get),
+                    mock.patch.object(atu, '_session', None)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def archive_info(filelist, archive, _):
+        """ every file is in the src archive, none in the others """
+        if archive != 'src':
+            return {}
+        return {fname: {'rel_filename': f"d/{fname}"} for fname in filelist}
+
+    def test_reuse(self):
+        config = {}
+        with capture_output():
+            for fname in ('a.txt', 'b.txt'):
+                self.assertEqual(atu.archive_copy(self.srcinfo, self.dstinfo, self.transinfo,
+                                                  [fname], config), {})
+        session = atu._session
+        # src and dst use the same DB, so share a connection, and the transfer object is reused
+        self.fmclass.assert_called_once_with(config={'des_db_section': 'db-test'})
+        self.transclass.assert_called_once()
+        self.assertEqual(self.transclass.return_value.blocking_transfer.call_count, 2)
+        fmobj = session.get_filemgmt(self.dstinfo)
+        self.assertIs(session.get_filemgmt(self.srcinfo), fmobj)
+        self.assertEqual(fmobj.commit.call_count, 2)
+        # a different DB section gets a connection of its own
+        self.assertIsNot(session.get_filemgmt(self.otherinfo), fmobj)
+        self.assertEqual(self.fmclass.call_count, 2)
+
+        # other config values start a new session, closing the old one's connections
+        with capture_output():
+            atu.archive_copy(self.srcinfo, self.dstinfo, self.transinfo, ['c.txt'], {})
+        self.assertIsNot(atu._session, session)
+        fmobj.close.assert_called_once()
+        self.assertEqual(session.filemgmts, {})
+        self.assertEqual(self.fmclass.call_count, 3)
+        self.assertEqual(self.transclass.call_count, 2)
+
+        # the session as a context manager closes its connections at the end
+        with atu.ArchiveTransferSession(self.transinfo, config) as session:
+            fmobj = session.get_filemgmt(self.srcinfo)
+        fmobj.close.assert_called_once()
+
+    def test_chunked_registrar(self):
+        config = {atu.REGISTER_CHUNK: 1}
+        with capture_output():
+            for names in (['a.txt', 'b.txt'], ['c.txt', 'd.txt']):
+                self.assertEqual(atu.archive_copy(self.srcinfo, self.dstinfo, self.transinfo,
+                                                  names, config), {})
+        session = atu._session
+        # one connection for the lookups and one for registering in the background, each
+        # made once for all of the chunks of both copies
+        self.assertEqual(self.fmclass.call_count, 2)
+        registrar = session.registrars['dst']
+        self.assertIsNot(registrar, session.get_filemgmt(self.dstinfo))
+        self.assertEqual(registrar.register_file_in_archive.call_count, 4)
+        self.assertEqual(registrar.commit.call_count, 4)
+        registrar.close.assert_not_called()
+        session.close()
+        registrar.close.assert_called_once()
+
+class TestArchiveAudit(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # a/b-c sorts between a/b and a/b/c
+        cls.root = 'audittest'
+        for (path, size) in [('a/b/f0', 1), ('a/b/c/f1', 2), ('a/b-c/f2', 3)]:
+            os.makedirs(os.path.join(cls.root, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(cls.root, path), 'w') as fh:
+                fh.write('x' * size)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def test_disk_inventory_stream(self):
+        res = [ent[0] for ent in cu.disk_inventory_stream(self.root)]
+        self.assertEqual(res, [('a/b', 'f0'), ('a/b-c', 'f2'), ('a/b/c', 'f1')])
+        res = [ent[0] for ent in cu.disk_inventory_stream(self.root, start_after='a/b')]
+        self.assertEqual(res, [('a/b-c', 'f2'), ('a/b/c', 'f1')])
+        res = [ent[0] for ent in cu.disk_inventory_stream(self.root, start_after='a/b-c')]
+        self.assertEqual(res, [('a/b/c', 'f1')])
+        res = [ent[0] for ent in cu.disk_inventory_stream(self.root, start_after='a/b/c')]
+        self.assertEqual(res, [])
+
+    def test_merge_inventories(self):
+        db = [(('a', 'f0'), 1, 'm0'), (('a', 'f1'), 2, 'm1'), (('b', 'f2'), 3, 'm2'),
+              (('c', 'f3'), 4, 'm3')]
+        disk = [(('a', 'f0'), 1, 'm0'), (('a', 'f1'), 2, 'xx'), (('b', 'f2'), 5, 'm2'),
+                (('b', 'f4'), 1, 'm4')]
+        res = [(kind, name) for (kind, name, _, _) in cu.merge_inventories(iter(db), iter(disk), True)]
+        self.assertEqual(res, [('equal', ('a', 'f0')), ('md5sum', ('a', 'f1')),
+                               ('filesize', ('b', 'f2')), ('diskonly', ('b', 'f4')),
+                               ('dbonly', ('c', 'f3'))])
+        res = [kind for (kind, _, _, _) in cu.merge_inventories(iter(db[:2]), iter(disk[:2]))]
+        self.assertEqual(res, ['equal', 'equal'])
+
+    def test_audit_resume(self):
+        checkpoint = 'audittest.checkpoint'
+        with open(checkpoint, 'w') as fh:
+            fh.write('a/b-c\n')
+        curs = mock.MagicMock()
+        # the DB only returns the rows after the checkpoint
+        curs.__iter__.return_value = iter([('a/b/c', 'f1', None, 5, None),
+                                           ('a/b/c', 'f9', None, 1, None)])
+        dbh = mock.Mock()
+        dbh.cursor.return_value = curs
+        dbh.get_named_bind_string.side_effect = lambda name: ':' + name
+        args = argparse.Namespace(dbh=dbh, archive='testarch', relpath=None, md5sum=False,
+                                  checkpoint=checkpoint, silent=True)
+        try:
+            with mock.patch.object(cu.fmutils, 'get_archive_root', return_value=self.root), \
+                 capture_output() as (out, _):
+                audit = cu.ArchiveAudit(args)
+                self.assertEqual(audit.run(), 1)
+                output = out.getvalue()
+            (sql, binds) = curs.execute.call_args[0]
+            self.assertEqual(binds['start'], 'a/b-c')
+            self.assertIn('NLS_SORT=BINARY', sql)
+            self.assertEqual(audit.counts['filesize'], 1)
+            self.assertEqual(audit.counts['dbonly'], 1)
+            self.assertEqual(audit.counts['diskonly'], 0)
+            self.assertIn('filesize  a/b/c/f1 5 2', output)
+            self.assertIn('dbonly    a/b/c/f9', output)
+            # a completed audit doesn't leave a checkpoint behind
+            self.assertFalse(os.path.exists(checkpoint))
+        finally:
+            if os.path.exists(checkpoint):
+                os.unlink(checkpoint)
+
+    def test_audit_interrupted(self):
+        checkpoint = 'audittest.checkpoint'
+        args = argparse.Namespace(dbh=mock.Mock(), archive='testarch', relpath=None, md5sum=False,
+                                  checkpoint=checkpoint, silent=True)
+        rows = [(('a/b', 'f0'), 9, None), (('a/b-c', 'f2'), 3, None), (('a/b/c', 'f1'), 2, None)]
+
+        def stream(dbh, archive, relpath, start_after, stop=None):
+            for row in rows:
+                if start_after is not None and row[0][0] <= start_after:
+                    continue
+                if row[0][0] == stop:
+                    raise KeyboardInterrupt()
+                yield row
+        try:
+            with mock.patch.object(cu.fmutils, 'get_archive_root', return_value=self.root), \
+                 mock.patch.object(cu, 'CHECKPOINT_EVERY', 1), capture_output():
+                # the mismatch in a/b is found, then the audit is stopped
+                with mock.patch.object(cu, 'stream_files_from_db',
+                                       side_effect=lambda *x: stream(*x, stop='a/b/c')):
+                    with self.assertRaises(KeyboardInterrupt):
+                        cu.ArchiveAudit(args).run()
+                with open(checkpoint) as fh:
+                    self.assertEqual(json.load(fh), {'path': 'a/b', 'counts': {
+                        'equal': 0, 'dbonly': 0, 'diskonly': 0, 'filesize': 1, 'md5sum': 0}})
+                # the rest of the archive agrees, but the audit as a whole doesn't
+                with mock.patch.object(cu, 'stream_files_from_db', side_effect=stream):
+                    audit = cu.ArchiveAudit(args)
+                    self.assertEqual(audit.run(), 1)
+            self.assertEqual(audit.counts['equal'], 2)
+            self.assertEqual(audit.counts['filesize'], 1)
+            self.assertFalse(os.path.exists(checkpoint))
+        finally:
+            if os.path.exists(checkpoint):
+                os.unlink(checkpoint)
+
+class TestFileManager(unittest.TestCase):
+    def make_manager(self, **kwargs):
+        return fmutils.FileManager(None, manager_args(pfwid=1, **kwargs), [1], None)
+
+    def test_compare_db_disk(self):
+        root = os.path.abspath('fmtest')
+        # a copy of moved.fits at its DB path, next to (not below) the walked a/b
+        os.makedirs(os.path.join(root, 'a', 'b-c'))
+        with open(os.path.join(root, 'a', 'b-c', 'moved.fits'), 'w') as fh:
+            fh.write('x')
+        try:
+            manager = self.make_manager(relpath='a/b', md5sum=True)
+            manager.archive_root = root
+            manager.duplicates = {}
+            manager.files_from_db = {
+                'eq.fits': {'path': 'a/b', 'filesize': 1, 'md5sum': 'm1'},
+                'size.fits': {'path': 'a/b', 'filesize': 2, 'md5sum': 'm2'},
+                'md5.fits': {'path': 'a/b', 'filesize': 1, 'md5sum': 'm3'},
+                'dbonly.fits': {'path': 'a/b', 'filesize': 1, 'md5sum': 'm4'},
+                'moved.fits': {'path': 'a/b-c', 'filesize': 1, 'md5sum': dul.get_md5sum_file(
+                    os.path.join(root, 'a', 'b-c', 'moved.fits'))},
+                'inside.fits': {'path': 'a/b/c', 'filesize': 1, 'md5sum': 'm5'}}
+            manager.files_from_disk = {
+                'eq.fits': {'relpath': 'a/b', 'filesize': 1, 'md5sum': 'm1'},
+                'size.fits': {'relpath': 'a/b', 'filesize': 3, 'md5sum': 'm2'},
+                'md5.fits': {'relpath': 'a/b', 'filesize': 1, 'md5sum': 'xx'},
+                'diskonly.fits': {'relpath': 'a/b', 'filesize': 1, 'md5sum': 'm6'},
+                'moved.fits': {'relpath': 'a/b', 'filesize': 1, 'md5sum': 'm7'},
+                'inside.fits': {'relpath': 'a/b', 'filesize': 1, 'md5sum': 'm5'}}
+            manager.compare_db_disk()
+            info = manager.comparison_info
+            self.assertEqual(info['equal'], ['eq.fits'])
+            self.assertEqual(info['filesize'], ['size.fits'])
+            self.assertEqual(info['md5sum'], ['md5.fits'])
+            self.assertEqual(info['dbonly'], ['dbonly.fits'])
+            self.assertEqual(info['diskonly'], ['diskonly.fits'])
+            # the copy found at the DB path outside of the walked tree is a duplicate
+            self.assertEqual(info['duplicates'], ['moved.fits'])
+            self.assertEqual(manager.files_from_disk['moved.fits']['relpath'], 'a/b-c')
+            # a DB path inside the walked tree would have been seen
+            self.assertEqual(info['path'], ['inside.fits'])
+        finally:
+            shutil.rmtree(root)
+
+    def test_inventory_to_array(self):
+        arr = fmutils.inventory_to_array({'b.fits': {'path': 'p', 'filesize': None, 'md5sum': None},
+                                          'a.fits': {'path': 'q', 'filesize': 5, 'md5sum': 'm'}}, 'path')
+        self.assertEqual(arr['name'].tolist(), ['a.fits', 'b.fits'])
+        self.assertEqual(arr['filesize'].tolist(), [5, -1])
+        self.assertEqual(arr['md5sum'].tolist(), ['m', ''])
+
+    def test_parallel_failures(self):
+        args = manager_args(start_at=1, end_at=0, date_range=None, pipeline=None, parallel=3)
+        comp = cu.FileCompare(args, [1, 2, 3, 4])
+        comp.attempt_info = {}
+        comp.file_inventory = None
+        real_init = cu.FileCompare.__init__
+
+        def init(self, args, pfwids):
+            if pfwids == [3]:
+                self.dbh = None
+                raise ValueError('no connection')
+            real_init(self, args, pfwids)
+
+        def do_task(self):
+            if self.pfwid == 2:
+                raise ValueError('bad attempt')
+            return 0
+
+        with mock.patch.object(cu.desdmdbi, 'DesDmDbi'), \
+             mock.patch.object(cu.FileCompare, '__init__', init), \
+             mock.patch.object(cu.FileCompare, 'do_task', do_task):
+            with capture_output() as (out, _):
+                ret = comp.parallel_task(0, 4)
+        self.assertEqual(ret, 2)
+        self.assertIn('2  ERROR (bad attempt)', out.getvalue())
+        self.assertIn('3  ERROR (no connection)', out.getvalue())
+
+        # the exit status can't wrap around to 0
+        compare_db = load_script('compare_db.py')
+        for (ret, status) in [(0, 0), (1, 1), (256, 1), (None, 1)]:
+            with mock.patch.object(compare_db.compare, 'FileCompare') as filecompare, \
+                 mock.patch.object(compare_db.fmutils, 'determine_ids', side_effect=lambda x: (x, [1])), \
+                 mock.patch.object(sys, 'argv', ['compare_db.py']):
+                filecompare.return_value.run.return_value = ret
+                with self.assertRaises(SystemExit) as cm:
+                    compare_db.main()
+            self.assertEqual(cm.exception.code, status)
+
+
+class TestArchiveTransfer(unittest.TestCase):
+    def setUp(self):
+        self.root = 'transfertest'
+        self.srcinfo = {'name': 'src', 'root': os.path.join(self.root, 'src')}
+        self.dstinfo = {'name': 'dst', 'root': os.path.join(self.root, 'dst')}
+        os.makedirs(os.path.join(self.srcinfo['root'], 'd'))
+        for name in ('a.txt', 'b.txt'):
+            with open(os.path.join(self.srcinfo['root'], 'd', name), 'w') as fh:
+                fh.write(f"{name}\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_session(self, config=None):
+        """ Session with a local transfer between the test archives and a mocked dst filemgmt """
+        session = atu.ArchiveTransferSession({}, config)
+        session.transfers[('src', 'dst')] = atl.ArchiveTransferLocal(self.srcinfo, self.dstinfo, {})
+        session.filemgmts['dst'] = mock.Mock()
+        session.filemgmts['dst'].register_file_in_archive.return_value = {}
+        return session
+
+    def test_sync_dir(self):
+        session = self.make_session({atu.SYNC_MANIFEST_DIR: os.path.join(self.root, 'manifests')})
+        fmobj = session.filemgmts['dst']
+        # nothing in the dst archive yet, then the md5sums of the registered files
+        fmobj.get_file_archive_info.side_effect = [
+            {}, {x: {'rel_filename': f"d/{x}", 'md5sum': f"sum_{x}"} for x in ('a.txt', 'b.txt')}]
+        with capture_output():
+            self.assertEqual(session.sync_dir(self.srcinfo, self.dstinfo, 'd'), {})
+        fmobj.register_file_in_archive.assert_called_once()
+        manifest = atu.load_manifest(session.manifest_name(self.srcinfo, self.dstinfo, 'd'))
+        self.assertEqual(manifest['d/a.txt'][2], 'sum_a.txt')
+
+        # a changed file replaces the registered one, with its DB filesize and md5sum updated
+        with open(os.path.join(self.srcinfo['root'], 'd', 'a.txt'), 'w') as fh:
+            fh.write('changed\n')
+        with capture_output():
+            self.assertEqual(session.sync_dir(self.srcinfo, self.dstinfo, 'd'), {})
+        with open(os.path.join(self.dstinfo['root'], 'd', 'a.txt')) as fh:
+            self.assertEqual(fh.read(), 'changed\n')
+        # no temporary copy left behind
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dstinfo['root'], 'd'))), ['a.txt', 'b.txt'])
+        md5sum = dul.get_md5sum_file(os.path.join(self.srcinfo['root'], 'd', 'a.txt'))
+        fmobj.update_file_size_md5.assert_called_once_with(
+            [{'filename': 'a.txt', 'compression': None, 'filesize': 8, 'md5sum': md5sum}])
+        self.assertEqual(fmobj.get_file_archive_info.call_count, 2)
+        manifest = atu.load_manifest(session.manifest_name(self.srcinfo, self.dstinfo, 'd'))
+        self.assertEqual(manifest['d/a.txt'][2], md5sum)
+
+    def test_copy_dir_problems(self):
+        session = self.make_session()
+        fmobj = session.filemgmts['dst']
+        fmobj.register_file_in_archive.side_effect = \
+            lambda files, archive: {f: 'no desfile' for f in files if f.endswith('a.txt')}
+        with capture_output():
+            with self.assertRaisesRegex(SystemExit, '1'):
+                session.copy_dir(self.srcinfo, self.dstinfo, 'd')
+            problems = session.copy_dir(self.srcinfo, self.dstinfo, 'd', return_problems=True)
+        self.assertEqual(list(problems), ['d/a.txt'])
+        self.assertIn('no desfile', problems['d/a.txt']['err'])
+
+    def test_copy_multi(self):
+        session = self.make_session()
+        dst2info = {'name': 'dst2', 'root': os.path.join(self.root, 'dst2')}
+        session.transfers[('src', 'dst2')] = atl.ArchiveTransferLocal(self.srcinfo, dst2info, {})
+        session.filemgmts['dst2'] = mock.Mock()
+        session.filemgmts['dst2'].register_file_in_archive.return_value = {}
+        session.filemgmts['src'] = mock.Mock()
+        session.filemgmts['src'].get_file_archive_info.return_value = {'a.txt': {'rel_filename': 'd/a.txt'}}
+        for name in ('dst', 'dst2'):
+            session.filemgmts[name].get_file_archive_info.return_value = {}
+        # partial copy left in dst, a different file of the same size in dst2
+        for (info, text) in ((self.dstinfo, 'a'), (dst2info, 'x.txt\n')):
+            os.makedirs(os.path.join(info['root'], 'd'))
+            with open(os.path.join(info['root'], 'd', 'a.txt'), 'w') as fh:
+                fh.write(text)
+        with capture_output():
+            problems = session.copy_multi(self.srcinfo, [self.dstinfo, dst2info], ['a.txt'])
+        self.assertEqual(problems, {'dst': {}, 'dst2': {}})
+        for info in (self.dstinfo, dst2info):
+            with open(os.path.join(info['root'], 'd', 'a.txt')) as fh:
+                self.assertEqual(fh.read(), 'a.txt\n')
+
+        # transfers set up differently can't be done by one of them
+        session.transfers[('src', 'dst2')] = atl.ArchiveTransferLocal(self.srcinfo, dst2info, {'x': 1})
+        os.remove(os.path.join(dst2info['root'], 'd', 'a.txt'))
+        with mock.patch.object(atl.ArchiveTransferLocal, 'fanout_transfer') as fanout, capture_output():
+            problems = session.copy_multi(self.srcinfo, [self.dstinfo, dst2info], ['a.txt'])
+        fanout.assert_not_called()
+        self.assertTrue(os.path.exists(os.path.join(dst2info['root'], 'd', 'a.txt')))
+
+    def test_manifest_name(self):
+        session = self.make_session()
+        # never inside the archive
+        name = session.manifest_name(self.srcinfo, self.dstinfo, 'd')
+        self.assertFalse(os.path.abspath(name).startswith(os.path.abspath(self.dstinfo['root'])))
+
+
+# columns of the stats tables in the mocked DB (no optional timing or cache columns)
+STATS_COLUMNS = {'task': ['id', 'name', 'info_table', 'parent_task_id', 'root_task_id', 'label',
+                          'start_time', 'end_time', 'status', 'exec_host'],
+                 'transfer_batch': ['task_id', 'src', 'dst', 'transfer_class', 'parent_task_id',
+                                    'total_num_bytes', 'total_num_files'],
+                 'transfer_file': ['task_id', 'filename', 'batch_task_id', 'bytes']}
+
+class StatsCursor:
+    """ Cursor of the mocked stats DB: table columns and task sequence values """
+    def __init__(self, seq):
+        self.seq = seq
+        self.description = None
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        words = sql.split()
+        if words[:3] == ['select', '*', 'from']:
+            self.description = [(col.upper(),) for col in STATS_COLUMNS[words[3]]]
+        elif 'task_seq.nextval' in sql:
+            self.rows = [(next(self.seq),) for _ in range(int(words[-1]))]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+class TestTransferStatsDB(unittest.TestCase):
+    def make_stats(self, **config):
+        cfg = {'use_db': 'True', 'des_db_section': 'db-test', 'parent_task_id': 1,
+               'root_task_id': 1, 'transfer_stats_per_file': 'True'}
+        cfg.update(config)
+        seq = iter(range(100, 10000))
+        with mock.patch.object(tsdb.desdmdbi.DesDmDbi, '__init__', return_value=None), \
+             mock.patch.object(tsdb.TransferStatsDB, 'cursor', create=True,
+                               side_effect=lambda: StatsCursor(seq)), \
+             mock.patch.object(tsdb.TransferStatsDB, 'insert_many', create=True) as self.init_insert, \
+             mock.patch.object(tsdb.TransferStatsDB, 'commit', create=True), \
+             mock.patch.object(tsdb.TransferStatsDB, 'rollback', create=True):
+            stats = tsdb.TransferStatsDB(cfg)
+        stats.cursor = lambda: StatsCursor(seq)
+        for method in ['create_task', 'end_task', 'basic_insert_row', 'basic_update_row',
+                       'insert_many', 'commit', 'rollback']:
+            setattr(stats, method, mock.Mock())
+        stats.create_task.side_effect = lambda **kwargs: next(seq)
+        return stats
+
+    def test_unknown_columns(self):
+        stats = self.make_stats()
+        stats.stat_beg_batch('home2job', 'home', 'job')
+        tid = stats.stat_beg_file('a.fits')
+        stats.stat_end_file(0, 10, tid, timing={'retries': 1, 'connect_time': 0.1})
+        stats.basic_update_row.assert_called_with('transfer_file', {'bytes': 10}, {'task_id': tid})
+        stats.stat_cache_batch(1, 10, 0, 0)
+        stats.stat_end_batch(0)
+        stats.basic_update_row.assert_called_with('transfer_batch',
+                                                  {'total_num_bytes': 10, 'total_num_files': 1},
+                                                  {'task_id': 100})
+
+    def test_load_unknown_columns(self):
+        loader = load_script('load_transfer_stats.py')
+        dbh = mock.Mock()
+        dbh.cursor.side_effect = lambda: StatsCursor(iter([]))
+        loader.insert_rows(dbh, {'task': [], 'transfer_batch': [],
+                                 'transfer_file': [{'task_id': 1, 'bytes': 5, 'retries': 2}]})
+        dbh.insert_many.assert_called_once_with('transfer_file', ['bytes', 'task_id'],
+                                                [{'bytes': 5, 'task_id': 1}])
+
+    def test_batch_copy(self):
+        stats = self.make_stats()
+        with mock.patch.object(tsdb.desdmdbi.DesDmDbi, '__init__', return_value=None) as init:
+            other = stats.batch_copy()
+        # a connection of its own for the other thread
+        init.assert_called_once_with(other, stats.desservices, 'db-test')
+        self.assertIsNot(other.currvals, stats.currvals)
+        self.assertIsNot(other.task_ids, stats.task_ids)
+        with mock.patch.object(tsdb.TransferStatsDB, 'close', create=True) as close:
+            other.end_batch_copy()
+        close.assert_called_once_with()
+
+    def test_buffered(self):
+        spilldir = 'statsspill'
+        try:
+            stats = self.make_stats(transfer_stats_buffered='True', transfer_stats_spill_dir=spilldir)
+            stats.stat_beg_batch('home2job', 'home', 'job')
+            tid = stats.stat_beg_file('a.fits')
+            stats.stat_end_file(0, 10, tid, timing={'retries': 1})
+            stats.stat_beg_file('b.fits')
+            stats.basic_insert_row.assert_called_once()
+            spillname = os.path.join(spilldir, 'transfer_stats_100.spill')
+            self.assertTrue(os.path.exists(spillname))
+
+            # another job starting meanwhile leaves the active batch's spill file alone
+            self.make_stats(transfer_stats_buffered='True', transfer_stats_spill_dir=spilldir)
+            self.init_insert.assert_not_called()
+            self.assertTrue(os.path.exists(spillname))
+
+            stats.stat_end_batch(0)
+            calls = {args[0]: args[1:] for (args, _) in stats.insert_many.call_args_list}
+            self.assertEqual([row['id'] for row in calls['task'][1]], [tid, tid + 1])
+            self.assertEqual([row['status'] for row in calls['task'][1]], [0, None])
+            # no retries column
+            self.assertEqual(calls['transfer_file'][0], ['batch_task_id', 'bytes', 'filename', 'task_id'])
+            self.assertEqual(calls['transfer_file'][1][0]['bytes'], 10)
+            stats.commit.assert_called()
+            self.assertFalse(os.path.exists(spillname))
+        finally:
+            shutil.rmtree(spilldir, ignore_errors=True)
+
+    def test_spill_locked(self):
+        spilldir = 'statsspill'
+        try:
+            stats = self.make_stats(transfer_stats_buffered='True', transfer_stats_spill_dir=spilldir)
+            stats.stat_beg_batch('home2job', 'home', 'job')
+            # the spill file is locked before another job can see (and load) it
+            visible = []
+            real_flock = tsdb.fcntl.flock
+            def flock(fh, operation):
+                visible.append(os.listdir(spilldir))
+                return real_flock(fh, operation)
+            with mock.patch.object(tsdb.fcntl, 'flock', side_effect=flock):
+                tid = stats.stat_beg_file('a.fits')
+                stats.stat_end_file(0, 10, tid)
+            self.assertEqual(len(visible), 1)
+            self.assertFalse([x for x in visible[0] if x.endswith('.spill')])
+            self.assertEqual(os.listdir(spilldir), ['transfer_stats_100.spill'])
+            # a spill file already gone doesn't fail the end of the batch
+            os.remove(os.path.join(spilldir, 'transfer_stats_100.spill'))
+            stats.stat_end_batch(0)
+            self.assertIsNone(stats.currvals['spill'])
+        finally:
+            shutil.rmtree(spilldir, ignore_errors=True)
+
+    def test_spill_recovery(self):
+        spilldir = 'statsspill'
+        os.makedirs(spilldir)
+        try:
+            spillname = os.path.join(spilldir, 'transfer_stats_7.spill')
+            with open(spillname, 'w') as fh:
+                fh.write('{"task": {"id": 8, "status": 0, "start_time": "2024-01-01T10:00:00", '
+                         '"end_time": null}, "file": {"task_id": 8, "bytes": 5}}\n{"task": {"id"')
+            self.make_stats(transfer_stats_buffered='True', transfer_stats_spill_dir=spilldir)
+            calls = {args[0]: args[1:] for (args, _) in self.init_insert.call_args_list}
+            self.assertEqual(len(calls['task'][1]), 1)
+            self.assertEqual(calls['task'][1][0]['start_time'].hour, 10)
+            self.assertEqual(calls['transfer_file'][1], [{'bytes': 5, 'task_id': 8}])
+            self.assertFalse(os.path.exists(spillname))
+        finally:
+            shutil.rmtree(spilldir, ignore_errors=True)
+
+
+class TestHttpUtils(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.makedirs('httptester/served/home')
+        with open('httptester/served/home/hello.txt', 'w') as fh:
+            fh.write('Hello World!\n')
+        cls.server = WebDavServer('httptester/served', user='tester', passwd='testpw').start()
+        cls.desfile = cls.server.write_desservices('httptester/.desservices.ini')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        shutil.rmtree('httptester')
+
+    def test_copyfiles_get_put(self):
+        hutils = hu.HttpUtils(self.desfile, 'file-http', dircache=None)
+        flist = {'hello.txt': {'src': self.server.url + 'home/hello.txt',
+                               'dst': 'httptester/job/hello.txt'}}
+        with capture_output() as (out, _):
+            (status, res) = hutils.copyfiles(flist, None)
+        self.assertEqual(status, 0)
+        self.assertEqual(res['hello.txt']['md5sum'], '8ddd8be4b179a529afa5f2ffae4b9858')
+        with open('httptester/job/hello.txt') as fh:
+            self.assertEqual(fh.read(), 'Hello World!\n')
+
+        flist = {'hello.txt': {'src': 'httptester/job/hello.txt',
+                               'dst': self.server.url + 'home/new/dir/hello.txt'}}
+        with capture_output() as (out, _):
+            (status, res) = hutils.copyfiles(flist, None, verify=True)
+        self.assertEqual(status, 0)
+        self.assertTrue(os.path.exists('httptester/served/home/new/dir/hello.txt'))
+
+    def test_copyfiles_retry(self):
+        hutils = hu.HttpUtils(self.desfile, 'file-http', dircache=None)
+        flist = {'hello.txt': {'src': self.server.url + 'home/hello.txt',
+                               'dst': 'httptester/retry/hello.txt'}}
+        self.server.fail_next(500)
+        with capture_output() as (out, _):
+            (status, res) = hutils.copyfiles(flist, None, secondsBetweenRetriesC=0.01)
+            output = out.getvalue().strip()
+        self.assertEqual(status, 0)
+        self.assertTrue('2 tries' in output)
+
+        flist = {'junk.txt': {'src': self.server.url + 'home/junk.txt',
+                              'dst': 'httptester/retry/junk.txt'}}
+        with capture_output() as (out, _):
+            (status, res) = hutils.copyfiles(flist, None, numTriesC=1)
+        self.assertEqual(status, 1)
+        self.assertTrue('404' in res['junk.txt']['err'])
+        self.assertFalse(os.path.exists('httptester/retry/junk.txt'))
+
+    def test_backoff_delay(self):
+        for ntry in range(1, 6):
+            full = 2 * 2 ** (ntry - 1)
+            delays = [hu.backoff_delay(2, ntry) for _ in range(50)]
+            # the upper half is randomized
+            self.assertTrue(all(full / 2 <= x <= full for x in delays))
+            self.assertGreater(len(set(delays)), 1)
+        self.assertTrue(hu.MAX_BACKOFF / 2 <= hu.backoff_delay(2, 30) <= hu.MAX_BACKOFF)
+        # the server may ask for longer, up to MAX_BACKOFF
+        self.assertEqual(hu.backoff_delay(0.1, 1, 5.0), 5.0)
+        self.assertEqual(hu.backoff_delay(0.1, 1, 1e6), hu.MAX_BACKOFF)
+        self.assertTrue(1 <= hu.backoff_delay(2, 1, 0.5) <= 2)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(hu.parse_retry_after({'retry-after': '7'}), 7.0)
+        self.assertEqual(hu.parse_retry_after({'retry-after': '-3'}), 0.0)
+        later = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertTrue(28 <= hu.parse_retry_after({'retry-after': later}) <= 30)
+        earlier = email.utils.formatdate(time.time() - 30, usegmt=True)
+        self.assertEqual(hu.parse_retry_after({'retry-after': earlier}), 0.0)
+        self.assertIsNone(hu.parse_retry_after({'retry-after': 'soon'}))
+        self.assertIsNone(hu.parse_retry_after({}))
+
+    def test_copyfiles_retry_after(self):
+        # a 429 is retried no sooner than the server asked
+        for (numparallel, subdir) in [(1, 'serial'), (3, 'multi')]:
+            hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=numparallel)
+            flist = {f"hello{i}.txt": {'src': self.server.url + 'home/hello.txt',
+                                       'dst': f"httptester/after/{subdir}/hello{i}.txt"} for i in range(2)}
+            self.server.fail_next(429)
+            start = time.time()
+            with capture_output() as (out, _):
+                (status, res) = hutils.copyfiles(flist, None, secondsBetweenRetriesC=0.01)
+            self.assertEqual(status, 0)
+            self.assertGreaterEqual(time.time() - start, self.server.retry_after)
+            self.assertTrue('2 tries' in out.getvalue())
+
+    def test_copyfiles_retry_budget(self):
+        # a file does not wait past the retry budget, the rest of the batch goes on
+        self.server.retry_after = 30
+        try:
+            for (numparallel, subdir) in [(1, 'serial'), (3, 'multi')]:
+                hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=numparallel, retrybudget=5)
+                flist = {f"hello{i}.txt": {'src': self.server.url + 'home/hello.txt',
+                                           'dst': f"httptester/budget/{subdir}/hello{i}.txt"} for i in range(2)}
+                self.server.fail_next(429)
+                before = self.server.requests['GET']
+                start = time.time()
+                with capture_output():
+                    (status, res) = hutils.copyfiles(flist, None, secondsBetweenRetriesC=0.01)
+                self.assertEqual(status, 1)
+                self.assertLess(time.time() - start, 5)
+                self.assertEqual(self.server.requests['GET'] - before, 2)
+                failed = [x for x in res if 'err' in res[x]]
+                self.assertEqual(len(failed), 1)
+                self.assertTrue('429' in res[failed[0]]['err'])
+                self.assertFalse(os.path.exists(res[failed[0]]['dst']))
+        finally:
+            self.server.retry_after = 1
+
+    def test_copyfiles_error_body(self):
+        # an error page must not be kept and resumed after (the result would be the page
+        # and the end of the file, the size of the file)
+        data = ''.join(f"line {i}\n" for i in range(100))
+        with open('httptester/served/home/lines.txt', 'w') as fh:
+            fh.write(data)
+        for (numparallel, subdir) in [(1, 'serial'), (3, 'multi')]:
+            hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=numparallel, dircache=None)
+            flist = {'lines.txt': {'src': self.server.url + 'home/lines.txt',
+                                   'dst': f"httptester/{subdir}/lines.txt", 'filesize': len(data)}}
+            self.server.fail_next(500, body=b'<html>oops</html>')
+            with capture_output() as (out, _):
+                (status, res) = hutils.copyfiles(flist, None, secondsBetweenRetriesC=0.01)
+            self.assertEqual(status, 0)
+            with open(f"httptester/{subdir}/lines.txt") as fh:
+                self.assertEqual(fh.read(), data)
+
+    def test_copyfiles_parallel(self):
+        hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=3, dircache=None)
+        flist = {f"hello{i}.txt": {'src': self.server.url + 'home/hello.txt',
+                                   'dst': f"httptester/par/hello{i}.txt"} for i in range(5)}
+        with capture_output() as (out, _):
+            (status, res) = hutils.copyfiles(flist, None)
+        self.assertEqual(status, 0)
+        self.assertEqual(len(os.listdir('httptester/par')), 5)
+
+    def test_copyfiles_ranges(self):
+        data = os.urandom(10000)
+        md5sum = hashlib.md5(data).hexdigest()
+        with open('httptester/served/home/big.bin', 'wb') as fh:
+            fh.write(data)
+        for (numparallel, subdir) in [(1, 'serial'), (3, 'multi')]:
+            hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=numparallel,
+                                  splitranges=4, splitsize=4000)
+            flist = {'big.bin': {'src': self.server.url + 'home/big.bin',
+                                 'dst': f"httptester/ranges/{subdir}/big.bin",
+                                 'filesize': len(data), 'md5sum': md5sum},
+                     'hello.txt': {'src': self.server.url + 'home/hello.txt',
+                                   'dst': f"httptester/ranges/{subdir}/hello.txt"}}
+            before = self.server.requests['GET']
+            # a failed range is retried by itself
+            self.server.fail_next(500)
+            with mock.patch.object(hu, 'SPLIT_MIN_RANGE', 1000), capture_output():
+                (status, res) = hutils.copyfiles(flist, None, secondsBetweenRetriesC=0.01)
+            self.assertEqual(status, 0)
+            self.assertEqual(self.server.requests['GET'] - before, 4 + 1 + 1)
+            with open(f"httptester/ranges/{subdir}/big.bin", 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+
+        # bad data is not kept
+        hutils = hu.HttpUtils(self.desfile, 'file-http', splitranges=4, splitsize=4000)
+        flist = {'big.bin': {'src': self.server.url + 'home/big.bin',
+                             'dst': 'httptester/ranges/bad/big.bin',
+                             'filesize': len(data), 'md5sum': '0' * 32}}
+        with mock.patch.object(hu, 'SPLIT_MIN_RANGE', 1000), capture_output():
+            (status, res) = hutils.copyfiles(flist, None)
+        self.assertEqual(status, 1)
+        self.assertTrue('md5sum mismatch' in res['big.bin']['err'])
+        self.assertEqual(os.listdir('httptester/ranges/bad'), [])
+
+    def test_copyfiles_resume(self):
+        data = os.urandom(20000)
+        with open('httptester/served/home/resume.bin', 'wb') as fh:
+            fh.write(data)
+        os.makedirs('httptester/resume')
+        hutils = hu.HttpUtils(self.desfile, 'file-http')
+        flist = {'resume.bin': {'src': self.server.url + 'home/resume.bin',
+                                'dst': 'httptester/resume/resume.bin', 'filesize': len(data)}}
+        # a partial file left by an earlier try is continued
+        with open('httptester/resume/resume.bin' + hu.PARTIAL_SUFFIX, 'wb') as fh:
+            fh.write(data[:8000])
+        with capture_output():
+            (status, res) = hutils.copyfiles(flist, None)
+        self.assertEqual(status, 0)
+        self.assertEqual(hutils.stream.start, 8000)
+        with open('httptester/resume/resume.bin', 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertEqual(os.listdir('httptester/resume'), ['resume.bin'])
+
+        # one that does not match the file is caught by the md5sum and started over
+        os.remove('httptester/resume/resume.bin')
+        flist['resume.bin']['md5sum'] = hashlib.md5(data).hexdigest()
+        with open('httptester/resume/resume.bin' + hu.PARTIAL_SUFFIX, 'wb') as fh:
+            fh.write(b'x' * 8000)
+        with capture_output() as (out, _):
+            (status, res) = hutils.copyfiles(flist, None, secondsBetweenRetriesC=0.01)
+        self.assertEqual(status, 0)
+        self.assertTrue('2 tries' in out.getvalue())
+        with open('httptester/resume/resume.bin', 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+
+    def test_copyfiles_no_ranges(self):
+        # a server ignoring Range gets the whole file in one stream
+        data = os.urandom(10000)
+        with open('httptester/served/home/noranges.bin', 'wb') as fh:
+            fh.write(data)
+        os.makedirs('httptester/noranges')
+        hutils = hu.HttpUtils(self.desfile, 'file-http', splitranges=4, splitsize=4000)
+        flist = {'split.bin': {'src': self.server.url + 'home/noranges.bin',
+                               'dst': 'httptester/noranges/split.bin', 'filesize': len(data)},
+                 'resume.bin': {'src': self.server.url + 'home/noranges.bin',
+                                'dst': 'httptester/noranges/resume.bin', 'filesize': len(data)}}
+        with open('httptester/noranges/resume.bin' + hu.PARTIAL_SUFFIX, 'wb') as fh:
+            fh.write(data[:5000])
+        self.server.ranges = False
+        try:
+            with mock.patch.object(hu, 'SPLIT_MIN_RANGE', 1000), capture_output() as (out, _):
+                (status, res) = hutils.copyfiles(flist, None)
+        finally:
+            self.server.ranges = True
+        self.assertEqual(status, 0)
+        self.assertTrue('ignored range request' in out.getvalue())
+        for fname in flist:
+            with open(f"httptester/noranges/{fname}", 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+        self.assertEqual(sorted(os.listdir('httptester/noranges')), sorted(flist))
+
+    def test_copyfiles_stall(self):
+        # a download trickling in below the low speed limit is stopped and resumed
+        data = os.urandom(20000)
+        with open('httptester/served/home/stall.bin', 'wb') as fh:
+            fh.write(data)
+        for (numparallel, subdir) in [(1, 'serial'), (3, 'multi')]:
+            hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=numparallel,
+                                  lowspeedlimit=1000, lowspeedtime=1)
+            flist = {'stall.bin': {'src': self.server.url + 'home/stall.bin',
+                                   'dst': f"httptester/{subdir}/stall.bin", 'filesize': len(data)},
+                     'hello.txt': {'src': self.server.url + 'home/hello.txt',
+                                   'dst': f"httptester/{subdir}/hello.txt"}}
+            self.server.throttle_next('home/stall.bin', 200)
+            tstats = mock.Mock()
+            with capture_output() as (out, _):
+                (status, res) = hutils.copyfiles(flist, tstats, secondsBetweenRetriesC=0.01)
+            self.assertEqual(status, 0)
+            self.assertTrue('stalled' in out.getvalue())
+            with open(f"httptester/{subdir}/stall.bin", 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+            call = [x for x in tstats.stat_end_file.call_args_list if x.args[1] == len(data)][0]
+            timing = call.kwargs.get('timing') or call.args[3]
+            self.assertEqual(timing['stalls'], 1)
+
+    def test_copyfiles_hedge(self):
+        # the download straggling behind the rest gets a duplicate request, which wins
+        data = os.urandom(20000)
+        with open('httptester/served/home/slow.bin', 'wb') as fh:
+            fh.write(data)
+        hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=3, hedgesize=1 << 20)
+        flist = {'slow.bin': {'src': self.server.url + 'home/slow.bin',
+                              'dst': 'httptester/hedge/slow.bin', 'filesize': len(data)}}
+        for i in range(hu.HEDGE_MIN_SAMPLES):
+            flist[f"hello{i}.txt"] = {'src': self.server.url + 'home/hello.txt',
+                                      'dst': f"httptester/hedge/hello{i}.txt", 'filesize': 13}
+        # 40 seconds at this rate
+        self.server.throttle_next('home/slow.bin', 500)
+        tstats = mock.Mock()
+        before = self.server.requests['GET']
+        start = time.time()
+        with capture_output():
+            (status, res) = hutils.copyfiles(flist, tstats)
+        self.assertEqual(status, 0)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(self.server.requests['GET'] - before, len(flist) + 1)
+        with open('httptester/hedge/slow.bin', 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertEqual(len(os.listdir('httptester/hedge')), len(flist))
+        call = [x for x in tstats.stat_end_file.call_args_list if x.args[1] == len(data)][0]
+        self.assertEqual(call.args[3]['hedges'], 1)
+
+    def test_create_dirs(self):
+        hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=3)
+        self.assertIsNone(hutils.dircache)
+        url = self.server.url
+        hutils.existing_directories.add(url + 'home')
+        levels = hutils.plan_directories([url + 'home/mk/a/f1.txt', url + 'home/mk/b/f2.txt',
+                                          url + 'home/mk/a/c/f3.txt'])
+        self.assertEqual(levels, [[url + 'home/mk'], [url + 'home/mk/a', url + 'home/mk/b'],
+                                  [url + 'home/mk/a/c']])
+        self.server.fail_next(500)
+        hutils.secondsBetweenRetries = 0.01
+        with capture_output():
+            for level in levels:
+                hutils.mkcol_multi(level)
+        for dname in ('mk', 'mk/a', 'mk/b', 'mk/a/c'):
+            self.assertTrue(os.path.isdir(f"httptester/served/home/{dname}"))
+
+    def test_stale_dir_cache(self):
+        # a directory removed after it went in the cache makes the PUT fail with 409, the
+        # directory is then created again
+        dircache = 'httptester/dircache'
+        for (numparallel, subdir) in [(1, 'serial'), (3, 'multi')]:
+            url = f"{self.server.url}home/stale/{subdir}"
+            with open(dircache, 'w') as fh:
+                fh.write(f"{time.time():.0f} {self.server.url}home\n")
+                fh.write(f"{time.time():.0f} {self.server.url}home/stale\n")
+                fh.write(f"{time.time():.0f} {url}\n")
+            hutils = hu.HttpUtils(self.desfile, 'file-http', numparallel=numparallel, dircache=dircache)
+            flist = {f"hello{i}.txt": {'src': 'httptester/served/home/hello.txt',
+                                       'dst': f"{url}/hello{i}.txt"} for i in range(numparallel)}
+            with capture_output():
+                (status, res) = hutils.copyfiles(flist, None, secondsBetweenRetriesC=0.01)
+            self.assertEqual(status, 0)
+            self.assertEqual(len(os.listdir(f"httptester/served/home/stale/{subdir}")), numparallel)
+
+    def test_node_cache(self):
+        hutils = hu.HttpUtils(self.desfile, 'file-http', dircache=None)
+        cache = nc.NodeCache('httptester/cache')
+        fetch = lambda files: hutils.copyfiles(files, None)
+        for job in ('job1', 'job2'):
+            flist = {'hello.txt': {'src': self.server.url + 'home/hello.txt',
+                                   'dst': f"httptester/{job}/hello.txt",
+                                   'md5sum': '8ddd8be4b179a529afa5f2ffae4b9858'}}
+            before = self.server.requests['GET']
+            with capture_output() as (out, _):
+                (status, res) = cache.copyfiles(flist, fetch)
+            self.assertEqual(status, 0)
+            with open(f"httptester/{job}/hello.txt") as fh:
+                self.assertEqual(fh.read(), 'Hello World!\n')
+        # second job got it from the cache
+        self.assertEqual(self.server.requests['GET'], before)
+        self.assertTrue(os.path.exists('httptester/cache/8ddd8be4b179a529afa5f2ffae4b9858/hello.txt'))
+
+        cache.budget = 1
+        cache.evict()
+        self.assertFalse(os.path.exists('httptester/cache/8ddd8be4b179a529afa5f2ffae4b9858/hello.txt'))
+        # other jobs may be waiting on the lock file
+        self.assertTrue(os.path.exists('httptester/cache/8ddd8be4b179a529afa5f2ffae4b9858/hello.txt.lock'))
+
+    def test_node_cache_waiting(self):
+        # jobs waiting on the same entries in different orders must not deadlock
+        cache = nc.NodeCache('httptester/waitcache')
+        def flist(job, names):
+            return {name: {'src': name, 'dst': f"httptester/{job}/{name}", 'md5sum': f"sum{name}"}
+                    for name in names}
+        # another job is fetching both files
+        entries = [cache.entry_path(finfo) for finfo in flist('other', ['y', 'z']).values()]
+        held = [cache.lock(entry, block=True) for entry in entries]
+        results = {}
+        def run_job(job, names):
+            results[job] = cache.copyfiles(flist(job, names), lambda files: (1, files))
+        threads = [threading.Thread(target=run_job, args=('wait1', ['y', 'z']), daemon=True),
+                   threading.Thread(target=run_job, args=('wait2', ['z', 'y']), daemon=True)]
+        for thread in threads:
+            thread.start()
+        with open('httptester/fetched', 'w') as fh:
+            fh.write('data\n')
+        # let the jobs get to waiting on the locks, then finish the fetches one at a time
+        time.sleep(0.3)
+        for (entry, lock) in zip(entries, held):
+            cache.add(entry, 'httptester/fetched')
+            lock.close()
+            time.sleep(0.3)
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(results['wait1'][0], 0)
+        self.assertEqual(results['wait2'][0], 0)
+        self.assertTrue(os.path.exists('httptester/wait2/y'))
+
+    def test_node_cache_evict(self):
+        cache = nc.NodeCache('httptester/evictcache', budget=13)
+        now = time.time()
+        def make(name, age, text='12345\n'):
+            path = os.path.join(cache.cachedir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fh:
+                fh.write(text)
+            os.utime(path, (now - age, now - age))
+            return path
+        oldest = make('s1/old.txt', 300)
+        older = make('s2/older.txt', 200)
+        newest = make('s3/new.txt', 100, 'ab\n')
+        stale = make('s1/x.1.tmp', nc.STALE_TMP + 10)
+        fresh = make('s2/y.1.tmp', 10)
+        # oldest is being fetched again by another job, so is kept
+        lock = cache.lock(oldest, block=True)
+        try:
+            cache.evict()
+        finally:
+            lock.close()
+        self.assertEqual([os.path.exists(x) for x in (oldest, older, newest, stale, fresh)],
+                         [True, False, True, False, True])
+        self.assertTrue(os.path.exists(older + '.lock'))
+        # under budget again, nothing is removed
+        cache.evict()
+        self.assertTrue(os.path.exists(oldest))
+
+        # entries another job removes while the cache is scanned are skipped
+        make('s2/older.txt', 200)
+        gone = make('s4/gone.txt', 400)
+        real_scandir = os.scandir
+        def scandir(path):
+            ents = list(real_scandir(path))
+            if path == os.path.dirname(gone) and os.path.exists(gone):
+                os.remove(gone)
+            return iter(ents)
+        with mock.patch.object(nc.os, 'scandir', side_effect=scandir):
+            cache.evict()
+        self.assertEqual([os.path.exists(x) for x in (oldest, older, newest)], [False, True, True])
+
+    def test_job2home_async(self):
+        jobarch = jmh.JobArchiveHttp({'name': 'test', 'root_http': self.server.url}, None,
+                                     {'http_dir_cache': ''}, None,
+                                     {'des_services': self.desfile, 'des_http_section': 'file-http'})
+        os.makedirs('httptester/async')
+        with open('httptester/async/out.txt', 'w') as fh:
+            fh.write('output\n')
+        with capture_output() as (out, _):
+            future = jobarch.job2home_async({'out.txt': {'src': 'httptester/async/out.txt',
+                                                         'dst': 'home/async/out.txt'}})
+            # waits for the upload before fetching it
+            res = jobarch.home2job({'out.txt': {'src': 'home/async/out.txt',
+                                                'dst': 'httptester/async/in/out.txt'}})
+        self.assertTrue(future.done())
+        self.assertFalse('err' in future.result()['out.txt'])
+        self.assertFalse('err' in res['out.txt'])
+        self.assertEqual(jobarch.wait_job2home(), {})
+
+        def upload(filelist, verify):
+            if 'a.txt' in filelist:
+                raise RuntimeError('upload failed')
+            time.sleep(0.3)
+            return {'b.txt': {}}
+        with mock.patch.object(jmh.JobArchiveHttp, 'job2home', side_effect=upload):
+            jobarch.job2home_async({'a.txt': {'src': 'a.txt', 'dst': 'home/async/a.txt'}})
+            future = jobarch.job2home_async({'b.txt': {'src': 'b.txt', 'dst': 'home/async/b.txt'}})
+            with self.assertRaisesRegex(RuntimeError, 'upload failed'):
+                jobarch.wait_job2home()
+        # the error is raised only after every upload waited for is done
+        self.assertTrue(future.done())
+        self.assertEqual(jobarch.wait_job2home(), {})
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def setUp(self):
+        self.clock = [1000.0]
+        patcher = mock.patch.object(hu.time, 'time', side_effect=lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_window(self, ctl, rate, latency, nbytes=1000):
+        """ Complete one window of transfers at rate B/s in all, returns the new limit """
+        count = ctl.limit
+        self.clock[0] += count * nbytes / rate
+        for _ in range(count):
+            limit = ctl.completed(nbytes, latency)
+        return limit
+
+    def test_latency_noise(self):
+        # ms jitter on a fast link is not congestion (it used to collapse the limit to 1)
+        ctl = hu.ConcurrencyController('host', 16)
+        with capture_output():
+            for i in range(50):
+                self.run_window(ctl, 1e6, [0.0003, 0.002, 0.0005, 0.004][i % 4])
+        self.assertEqual(ctl.limit, 8)
+
+    def test_latency_congestion(self):
+        ctl = hu.ConcurrencyController('host', 16)
+        with capture_output() as (out, _):
+            for _ in range(5):
+                self.assertEqual(self.run_window(ctl, 1e6, 0.1), 8)
+            self.assertEqual(self.run_window(ctl, 1e6, 0.5), 4)
+        self.assertTrue('time to first byte' in out.getvalue())
+        # slower first bytes but more throughput is not congestion
+        ctl = hu.ConcurrencyController('host', 16)
+        for _ in range(5):
+            self.run_window(ctl, 1e6, 0.1)
+        self.assertEqual(self.run_window(ctl, 2e6, 0.5), 9)
+
+    def test_recover(self):
+        ctl = hu.ConcurrencyController('host', 16)
+        self.run_window(ctl, 1e6, 0.01)
+        with capture_output():
+            self.assertEqual(ctl.overloaded(429), 4)
+            # transfers started before the cut do not cut again
+            self.assertEqual(ctl.overloaded(429), 4)
+        # clean windows climb back to the limit before the cut, then need more throughput
+        limits = [self.run_window(ctl, 1e6, 0.01) for _ in range(6)]
+        self.assertEqual(limits, [5, 6, 7, 8, 8, 8])
+        self.assertEqual(self.run_window(ctl, 2e6, 0.01), 9)
+
+    def test_save(self):
+        statefile = 'conc_state.txt'
+        self.addCleanup(lambda: os.path.exists(statefile) and os.remove(statefile))
+        ctl = hu.ConcurrencyController('host', 8, statefile=statefile)
+        self.run_window(ctl, 1e6, 0.01)
+        self.assertEqual(self.run_window(ctl, 2e6, 0.01), 5)
+        # too few transfers to go by
+        ctl.save()
+        self.assertFalse(os.path.exists(statefile))
+        for _ in range(4):
+            self.run_window(ctl, 1e6, 0.01)
+        ctl.save()
+        self.assertEqual(hu.ConcurrencyController('host', 8, statefile=statefile).limit, 5)
+        self.assertEqual(hu.ConcurrencyController('other', 8, statefile=statefile).limit, 4)
+
 
 if __name__ == '__main__':
     unittest.main()
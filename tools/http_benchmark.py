@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+""" Measure http file transfer throughput against a local WebDAV stand-in
+    (filemgmt.http_test_server), for HttpUtils.copyfiles, JobArchiveHttp and JobArchiveHttpCp
+    with several file size mixes and numbers of simultaneous transfers.   Needs no network.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import io
+
+import filemgmt.http_utils as http_utils
+import filemgmt.job_mvmt_http as job_mvmt_http
+import filemgmt.job_mvmt_http_cp as job_mvmt_http_cp
+from filemgmt.http_test_server import WebDavServer
+
+MIB = 1024 * 1024
+
+# name: list of (number of files, file size in bytes)
+MIXES = {'small': [(200, 64 * 1024)],
+         'mixed': [(100, 64 * 1024), (20, 4 * MIB), (2, 64 * MIB)],
+         'large': [(4, 128 * MIB)]}
+
+ENGINES = ['copyfiles', 'JobArchiveHttp', 'JobArchiveHttpCp']
+
+
+def parse_cmd_line(argv):
+    """ Parse command line arguments
+
+        Parameters
+        ----------
+        argv : command line arguments
+
+        Returns
+        -------
+        Dictionary containing the command line arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark http file transfers against a local WebDAV stand-in')
+    parser.add_argument('--mix', action='store', default='small,mixed,large',
+                        help=f"comma separated file size mixes ({', '.join(MIXES)})")
+    parser.add_argument('--parallel', action='store', default='1,4,16',
+                        help='comma separated numbers of simultaneous transfers')
+    parser.add_argument('--engine', action='store', default=','.join(ENGINES),
+                        help=f"comma separated classes to test ({', '.join(ENGINES)})")
+    parser.add_argument('--scale', action='store', type=float, default=1.0,
+                        help='multiply the file sizes by this (e.g., 0.1 for a quick run)')
+    parser.add_argument('--latency', action='store', type=float, default=0.0,
+                        help='seconds the server adds to every request')
+    parser.add_argument('--bandwidth', action='store', type=float, default=0,
+                        help='max bytes/sec per transfer, 0 for no cap')
+    parser.add_argument('--error_rate', action='store', type=float, default=0.0,
+                        help='fraction of requests answered with 429 or 500 (retries use the normal backoff, starting at 30 secs)')
+    parser.add_argument('--split_ranges', action='store', type=int, default=1,
+                        help='fetch large files in this many byte ranges at once')
+    parser.add_argument('--workdir', action='store', default=None,
+                        help='directory for the served and downloaded files (default is a temp dir)')
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help="don't delete the workdir at the end")
+    return vars(parser.parse_args(argv))
+
+
+def make_files(rootdir, mix, scale):
+    """ Create the files of a mix under rootdir/home/<mix> (once)
+
+        Returns
+        -------
+        dict of relative path to size
+    """
+    files = {}
+    block = os.urandom(MIB)
+    for (num, size) in MIXES[mix]:
+        size = max(1, int(size * scale))
+        for i in range(num):
+            relpath = f"home/{mix}/f{size}_{i}.dat"
+            files[relpath] = size
+            fullpath = os.path.join(rootdir, relpath)
+            if os.path.exists(fullpath) and os.path.getsize(fullpath) == size:
+                continue
+            os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+            with open(fullpath, 'wb') as fh:
+                left = size
+                while left > 0:
+                    fh.write(block[:min(left, MIB)])
+                    left -= MIB
+    return files
+
+
+def run_engine(engine, server, desfile, files, jobdir, nparallel, args):
+    """ Download then upload the files with the given class
+
+        Returns
+        -------
+        list of (direction, seconds, status, number of requests)
+    """
+    mvmt = {http_utils.HTTP_PARALLEL: nparallel,
+            http_utils.HTTP_DIR_CACHE: '',
+            http_utils.HTTP_SPLIT_RANGES: args['split_ranges']}
+    config = {job_mvmt_http.DES_SERVICES: desfile, job_mvmt_http.DES_HTTP_SECTION: 'file-http'}
+    home = {'name': 'bench', 'root_http': server.url}
+    upload = f"up/{engine}/{nparallel}"
+
+    getlist = {}
+    putlist = {}
+    for relpath, size in files.items():
+        fname = os.path.basename(relpath)
+        getlist[fname] = {'filename': fname, 'filesize': size,
+                          'src': relpath, 'dst': os.path.join(jobdir, fname)}
+        putlist[fname] = {'filename': fname, 'filesize': size,
+                          'src': os.path.join(jobdir, fname), 'dst': f"{upload}/{fname}"}
+
+    if engine == 'copyfiles':
+        hutils = http_utils.HttpUtils(desfile, 'file-http', **http_utils.options_from_config(mvmt))
+        for finfo in getlist.values():
+            finfo['src'] = server.url + finfo['src']
+        for finfo in putlist.values():
+            finfo['dst'] = server.url + finfo['dst']
+        get = lambda: hutils.copyfiles(getlist, None)[0]
+        put = lambda: hutils.copyfiles(putlist, None)[0]
+    else:
+        mod = job_mvmt_http if engine == 'JobArchiveHttp' else job_mvmt_http_cp
+        jobarch = getattr(mod, engine)(home, None, mvmt, None, config)
+        get = lambda: int(any('err' in x for x in jobarch.home2job(getlist).values()))
+        put = lambda: int(any('err' in x for x in jobarch.job2home(putlist).values()))
+
+    results = []
+    for (direction, func) in (('get', get), ('put', put)):
+        before = sum(server.requests.values())
+        start = time.time()
+        # keep the per batch copy summaries out of the table
+        with contextlib.redirect_stdout(io.StringIO()):
+            status = func()
+        results.append((direction, time.time() - start, status, sum(server.requests.values()) - before))
+    return results
+
+
+def main(argv):
+    """ Main program module
+
+    """
+    args = parse_cmd_line(argv)
+    workdir = args['workdir'] or tempfile.mkdtemp(prefix='http_benchmark.')
+    rootdir = os.path.join(workdir, 'served')
+    os.makedirs(rootdir, exist_ok=True)
+
+    server = WebDavServer(rootdir, user='bench', passwd='bench', latency=args['latency'],
+                          bandwidth=args['bandwidth'], error_rate=args['error_rate'])
+    desfile = server.write_desservices(os.path.join(workdir, '.desservices.ini'))
+    print(f"{'engine':18s} {'mix':6s} {'par':>3s} {'dir':3s} {'files':>5s} {'MiB':>8s} {'secs':>8s} {'MiB/s':>8s} {'reqs':>5s} status")
+    with server:
+        for mix in args['mix'].split(','):
+            files = make_files(rootdir, mix, args['scale'])
+            totmib = sum(files.values()) / MIB
+            for nparallel in [int(x) for x in args['parallel'].split(',')]:
+                for engine in args['engine'].split(','):
+                    jobdir = os.path.join(workdir, 'job', engine, str(nparallel))
+                    shutil.rmtree(jobdir, ignore_errors=True)
+                    shutil.rmtree(os.path.join(rootdir, 'up', engine, str(nparallel)), ignore_errors=True)
+                    for (direction, secs, status, nreqs) in run_engine(engine, server, desfile, files,
+                                                                        jobdir, nparallel, args):
+                        print(f"{engine:18s} {mix:6s} {nparallel:3d} {direction:3s} {len(files):5d} {totmib:8.1f} {secs:8.2f} {totmib / secs if secs > 0 else 0:8.1f} {nreqs:5d} {status}")
+                    sys.stdout.flush()
+    if not args['keep'] and not args['workdir']:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))